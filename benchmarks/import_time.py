@@ -0,0 +1,67 @@
+"""
+benchmarks/import_time.py
+
+Measures the cost of importing each japandata subpackage, and the cost of first touching one of its
+datasets. Importing is side-effect free, so the first column should stay in the tens of milliseconds
+even on a cold cache; the second column is what every import used to pay.
+
+Each measurement runs in a fresh interpreter so that nothing is shared between runs.
+
+Usage:
+    python benchmarks/import_time.py [--repeat N] [--no-access]
+
+Author: Sam Passaglia
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+CASES = {
+    "japandata": "city_pop",
+    "japandata.maps": "AVAILABLE_MAPS",
+    "japandata.population": "japan_pop",
+    "japandata.indices": "pref",
+    "japandata.readings": "city_names",
+}
+
+SNIPPET = """
+import time
+t0 = time.perf_counter()
+import {module} as m
+t1 = time.perf_counter()
+if {access}:
+    getattr(m, "{attribute}")
+t2 = time.perf_counter()
+print(t1 - t0, t2 - t1)
+"""
+
+
+def measure(module, attribute, access):
+    snippet = SNIPPET.format(module=module, attribute=attribute, access=access)
+    out = subprocess.run(
+        [sys.executable, "-c", snippet], check=True, capture_output=True, text=True
+    ).stdout
+    import_time, access_time = (float(x) for x in out.split()[-2:])
+    return import_time, access_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--no-access", action="store_true", help="only time the import, not the first access"
+    )
+    args = parser.parse_args()
+
+    print(f"{'module':<24}{'import (ms)':>14}{'first access (ms)':>20}  attribute")
+    for module, attribute in CASES.items():
+        runs = [measure(module, attribute, not args.no_access) for _ in range(args.repeat)]
+        import_ms = 1000 * statistics.median(run[0] for run in runs)
+        access_ms = 1000 * statistics.median(run[1] for run in runs)
+        print(f"{module:<24}{import_ms:>14.1f}{access_ms:>20.1f}  {attribute}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+benchmarks/indices_aggregation.py
+
+Times population-weighted aggregations of the municipal fiscal indices over every year, for each
+grouping: the whole country, prefectures, municipality types, both, and regions.
+
+Usage:
+    python benchmarks/indices_aggregation.py [--synthetic] [--repeat N]
+
+Author: Sam Passaglia
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from japandata.indices.aggregate import aggregate, join_population
+
+# first prefecture code of each of the eight regions
+REGION_STARTS = {
+    1: "hokkaido",
+    2: "tohoku",
+    8: "kanto",
+    15: "chubu",
+    24: "kinki",
+    31: "chugoku",
+    36: "shikoku",
+    40: "kyushu",
+}
+
+
+def regions_of(codes):
+    """Region of each municipality code."""
+    starts = np.array(list(REGION_STARTS))
+    names = np.array(list(REGION_STARTS.values()))
+    prefectures = codes.str[:2].astype(int).to_numpy()
+    return dict(zip(codes, names[np.searchsorted(starts, prefectures, side="right") - 1]))
+
+
+def synthetic_indices(municipalities=1741, years=range(2005, 2023), seed=0):
+    """Indices and populations of random municipalities, to benchmark without the data."""
+    rng = np.random.default_rng(seed)
+    prefectures = rng.integers(1, 48, municipalities)
+    codes = [f"{p:02d}{rng.integers(100, 500):03d}" for p in prefectures]
+    n = municipalities * len(years)
+    return pd.DataFrame(
+        {
+            "year": np.repeat(list(years), municipalities),
+            "prefecture": np.tile([f"{p:02d}" for p in prefectures], len(years)),
+            "code": np.tile(codes, len(years)),
+            "fiscal-strength-index": rng.lognormal(-0.8, 0.5, n),
+            "regular-expense-rate": rng.normal(90, 5, n),
+            "debt-service-rate": rng.normal(10, 4, n),
+            "future-burden-rate": rng.normal(40, 30, n),
+            "laspeyres": rng.normal(97, 2, n),
+            "total-pop": rng.lognormal(9.5, 1.5, n).round(),
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "--synthetic", action="store_true", help="use random indices rather than the data"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs per grouping")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    df = synthetic_indices() if args.synthetic else join_population()
+    print(
+        f"{len(df):,} municipality-years over {df['year'].nunique()} years"
+        f" loaded in {time.perf_counter() - t0:.1f} s"
+    )
+    regions = regions_of(df["code"].dropna().drop_duplicates())
+
+    groupings = {
+        "japan": [],
+        "prefecture": ["prefecture"],
+        "type": ["type"],
+        "prefecture x type": ["prefecture", "type"],
+        "region": ["region"],
+    }
+    stats = ["mean", "std", "min", "max", "count"]
+    for name, by in groupings.items():
+        times = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            result = aggregate(df, by=by, stats=stats, quantiles=[0.1, 0.5, 0.9], regions=regions)
+            times.append(time.perf_counter() - t0)
+        print(
+            f"{name:>18}: {len(result):>6,} groups x {result.shape[1]} statistics"
+            f" in {min(times) * 1000:.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
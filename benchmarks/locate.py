@@ -0,0 +1,89 @@
+"""
+benchmarks/locate.py
+
+Times the reverse geocoding of random points in Japan to the municipalities containing them,
+against a spatial join of the same points.
+
+Usage:
+    python benchmarks/locate.py [--points N] [--quality Q] [--synthetic]
+
+Author: Sam Passaglia
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from japandata.maps import load_map, locate
+
+# bounds of the main islands, in degrees
+LON_RANGE = (129.5, 145.5)
+LAT_RANGE = (31.0, 45.5)
+
+
+def synthetic_map(municipalities=1741, seed=0):
+    """Voronoi cells of random seeds labelled as municipalities, to benchmark without the data."""
+    import geopandas as gpd
+    import shapely
+
+    rng = np.random.default_rng(seed)
+    seeds = shapely.points(
+        rng.uniform(*LON_RANGE, municipalities), rng.uniform(*LAT_RANGE, municipalities)
+    )
+    extent = shapely.box(LON_RANGE[0], LAT_RANGE[0], LON_RANGE[1], LAT_RANGE[1])
+    cells = shapely.get_parts(
+        shapely.voronoi_polygons(shapely.multipoints(seeds), extend_to=extent)
+    )
+    return gpd.GeoDataFrame(
+        {"code": [f"{i:05d}" for i in range(len(cells))]},
+        geometry=shapely.intersection(cells, extent),
+        crs="EPSG:4326",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--points", type=int, default=1_000_000, help="number of points")
+    parser.add_argument("--quality", default="coarse", help="map quality")
+    parser.add_argument(
+        "--synthetic", action="store_true", help="use a random map rather than the data"
+    )
+    args = parser.parse_args()
+
+    import geopandas as gpd
+
+    t0 = time.perf_counter()
+    map_df = synthetic_map() if args.synthetic else load_map(2022, "jp_city_dc", args.quality)
+    print(f"{len(map_df):,} municipalities loaded in {time.perf_counter() - t0:.1f} s")
+
+    rng = np.random.default_rng(1)
+    lats = rng.uniform(*LAT_RANGE, args.points)
+    lons = rng.uniform(*LON_RANGE, args.points)
+
+    t0 = time.perf_counter()
+    codes = locate(lats, lons, map_df=map_df)
+    elapsed = time.perf_counter() - t0
+    print(
+        f"locate: {args.points:,} points in {elapsed:.2f} s, {args.points / elapsed:,.0f} points/s,"
+        f" {pd.notna(codes).mean():.0%} in a municipality"
+    )
+
+    sample = min(args.points, 100_000)
+    t0 = time.perf_counter()
+    points = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy(lons[:sample], lats[:sample]), crs=map_df.crs
+    )
+    joined = gpd.sjoin(points, map_df[["code", "geometry"]], predicate="intersects", how="left")
+    elapsed = time.perf_counter() - t0
+    joined = joined[~joined.index.duplicated()]
+    agree = np.mean(joined["code"].to_numpy(dtype=object) == codes[:sample])
+    print(
+        f"sjoin: {sample:,} points in {elapsed:.2f} s, {sample / elapsed:,.0f} points/s,"
+        f" agreeing with locate on {agree:.2%}"
+    )
+
+
+if __name__ == "__main__":
+    main()
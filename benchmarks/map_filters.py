@@ -0,0 +1,116 @@
+"""
+benchmarks/map_filters.py
+
+Times loading one prefecture, a bounding box, and a few municipalities of a high-quality map from
+its GeoParquet cache, against loading the whole map.
+
+Usage:
+    python benchmarks/map_filters.py [--quality Q] [--prefecture P] [--repeat N] [--synthetic]
+
+Author: Sam Passaglia
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from japandata.maps import clear_map_cache, load_map
+from japandata.maps.maps import _read_cleaned, _write_cleaned
+
+# around central Tokyo, in degrees
+BBOX = (139.6, 35.6, 139.85, 35.75)
+
+
+def synthetic_map(municipalities=1900, vertices=2000, seed=0):
+    """Finely drawn random municipalities in 47 prefectures laid out on a grid, to benchmark
+    without the data."""
+    import geopandas as gpd
+    import shapely
+
+    rng = np.random.default_rng(seed)
+    prefectures = np.sort(rng.integers(1, 48, municipalities))
+    lons = 129.5 + (prefectures % 7) * 2 + rng.uniform(0, 2, municipalities)
+    lats = 31 + (prefectures // 7) * 2 + rng.uniform(0, 2, municipalities)
+    return gpd.GeoDataFrame(
+        {
+            "prefecture": [f"p{p:02d}" for p in prefectures],
+            "city": [f"c{i}" for i in range(municipalities)],
+            "code": [f"{p:02d}{i % 1000:03d}" for i, p in enumerate(prefectures)],
+        },
+        geometry=[
+            shapely.Point(lon, lat).buffer(0.05, vertices // 4) for lon, lat in zip(lons, lats)
+        ],
+        crs="EPSG:6668",
+    )
+
+
+def best_time(load, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        map_df = load()
+        times.append(time.perf_counter() - t0)
+    return map_df, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--quality", default="high", help="map quality")
+    parser.add_argument("--prefecture", default="東京都", help="prefecture loaded alone")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per load")
+    parser.add_argument(
+        "--synthetic", action="store_true", help="use a random map rather than the data"
+    )
+    args = parser.parse_args()
+
+    if args.synthetic:
+        folder = tempfile.TemporaryDirectory()
+        path = Path(folder.name, "map.parquet")
+        synthetic = synthetic_map()
+        _write_cleaned(synthetic, path)
+        prefecture = synthetic["prefecture"].iloc[len(synthetic) // 2]
+        codes = synthetic["code"].iloc[:5].tolist()
+        bbox = tuple(synthetic.loc[synthetic["prefecture"] == prefecture].total_bounds)
+
+        def load(**filters):
+            return _read_cleaned(path, **filters)
+
+    else:
+        prefecture, bbox = args.prefecture, BBOX
+        t0 = time.perf_counter()
+        codes = load_map(2022, "jp_city", args.quality)["code"].dropna().iloc[:5].tolist()
+        print(f"map cached in {time.perf_counter() - t0:.1f} s")
+
+        def load(**filters):
+            # from the GeoParquet cache rather than the in-memory one
+            clear_map_cache()
+            return load_map(
+                2022,
+                "jp_city",
+                args.quality,
+                bbox=filters.get("bbox"),
+                prefectures=filters.get("prefecture"),
+                codes=filters.get("code"),
+            )
+
+    loads = {
+        "whole map": {},
+        "one prefecture": {"prefecture": prefecture},
+        "bbox": {"bbox": bbox},
+        "five codes": {"code": codes},
+    }
+    whole = None
+    for name, filters in loads.items():
+        map_df, elapsed = best_time(lambda: load(**filters), args.repeat)
+        whole = whole or elapsed
+        print(
+            f"{name:>15}: {len(map_df):>5,} features in {elapsed * 1000:7.1f} ms,"
+            f" {whole / elapsed:5.1f}x faster than the whole map"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+benchmarks/memory_layout.py
+
+Compares the memory taken by the population and indices dataframes in the default layout and in the
+compact layout of japandata.dtypes (categorical names, integer codes, int32 counts, int16 years).
+
+Usage:
+    python benchmarks/memory_layout.py
+
+Author: Sam Passaglia
+"""
+
+from japandata import indices, population
+
+
+def _mb(df):
+    return df.memory_usage(deep=True).sum() / 2**20
+
+
+def main():
+    print(f"{'dataframe':<24}{'default MB':>12}{'compact MB':>12}{'ratio':>8}")
+    totals = [0, 0]
+    for module in [population, indices]:
+        default = module.fetch_dataframes()
+        compact = module.fetch_dataframes(compact=True)
+        for name, default_df, compact_df in zip(module.DATAFRAME_NAMES, default, compact):
+            sizes = _mb(default_df), _mb(compact_df)
+            totals = [total + size for total, size in zip(totals, sizes)]
+            print(
+                f"{module.__name__.split('.')[-1] + '.' + name:<24}"
+                f"{sizes[0]:>12.1f}{sizes[1]:>12.1f}{sizes[0] / sizes[1]:>7.1f}x"
+            )
+    print(f"{'total':<24}{totals[0]:>12.1f}{totals[1]:>12.1f}{totals[0] / totals[1]:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+benchmarks/population_ingest.py
+
+Times the cold build of the population tables, parsing the Excel files serially and over a process
+pool, and checks that both give identical dataframes.
+
+Usage:
+    python benchmarks/population_ingest.py [--jobs N]
+
+Author: Sam Passaglia
+"""
+
+import argparse
+import os
+import time
+
+import pandas as pd
+
+from japandata.population.population import fetch_data, load_age, load_pop
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count(), help="worker processes (default: all cores)"
+    )
+    args = parser.parse_args()
+
+    fetch_data()  # time the parsing, not the download
+
+    for loader in [load_pop, load_age]:
+        t0 = time.perf_counter()
+        serial = loader(jobs=1)
+        t1 = time.perf_counter()
+        parallel = loader(jobs=args.jobs)
+        t2 = time.perf_counter()
+
+        for serial_df, parallel_df in zip(serial, parallel):
+            pd.testing.assert_frame_equal(serial_df, parallel_df, check_exact=True)
+        print(
+            f"{loader.__name__}: serial {t1 - t0:.1f} s, {args.jobs} jobs {t2 - t1:.1f} s"
+            f" ({(t1 - t0) / (t2 - t1):.1f}x), outputs identical"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+benchmarks/projection.py
+
+Times cohort-component projections of every municipality over many scenarios, each scaling the
+fitted fertility, mortality, and migration rates.
+
+Usage:
+    python benchmarks/projection.py [--scenarios N] [--steps N] [--synthetic]
+
+Author: Sam Passaglia
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from japandata.population.projection import (
+    CohortModel,
+    fit_cohort_model,
+    project,
+)
+
+
+def synthetic_model(municipalities=1741, brackets=17, seed=0):
+    """Model of random rates on the scale of the real one, to benchmark without the data."""
+    rng = np.random.default_rng(seed)
+    shape = (municipalities, 2, brackets)
+    return CohortModel(
+        codes=np.arange(municipalities),
+        edges=np.arange(0, 5 * brackets, 5),
+        base_year=2023,
+        interval=5,
+        base=rng.lognormal(7, 1.5, shape),
+        survival=rng.uniform(0.5, 1, shape),
+        migration=rng.normal(0, 0.05, shape),
+        child_ratio=rng.uniform(0.15, 0.3, municipalities),
+        male_share=np.full(municipalities, 0.51),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--scenarios", type=int, default=10000, help="number of scenarios")
+    parser.add_argument("--steps", type=int, default=6, help="5-year steps per projection")
+    parser.add_argument(
+        "--synthetic", action="store_true", help="use random rates rather than fitting the data"
+    )
+    args = parser.parse_args()
+
+    if args.synthetic:
+        model = synthetic_model()
+    else:
+        t0 = time.perf_counter()
+        model = fit_cohort_model()
+        print(f"Fitted {model} in {time.perf_counter() - t0:.1f} s")
+
+    rng = np.random.default_rng(0)
+    scenarios = dict(
+        fertility=rng.uniform(0.8, 1.2, args.scenarios),
+        mortality=rng.uniform(0.9, 1.1, args.scenarios),
+        migration=rng.uniform(0, 2, args.scenarios),
+    )
+    t0 = time.perf_counter()
+    totals = project(model, steps=args.steps, by_age=False, **scenarios)
+    elapsed = time.perf_counter() - t0
+    print(
+        f"{args.scenarios} scenarios x {args.steps} steps of {len(model.codes)} municipalities in"
+        f" {elapsed:.1f} s ({args.scenarios / elapsed * 60:,.0f} scenarios/minute),"
+        f" {totals.nbytes / 2**20:,.0f} MB of totals"
+    )
+
+
+if __name__ == "__main__":
+    main()
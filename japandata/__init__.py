@@ -0,0 +1,37 @@
+import importlib
+
+# Attributes re-exported from the subpackages. They are resolved on first access so that importing
+# japandata does not fetch or load any dataset.
+_LAZY_ATTRIBUTES = {
+    "DOWNLOAD_INFO": "download",
+    "download_progress": "download",
+    "capital": "indices",
+    "city": "indices",
+    "designatedcity": "indices",
+    "pref": "indices",
+    "prefmean": "indices",
+    "AVAILABLE_DATES": "maps",
+    "AVAILABLE_MAPS": "maps",
+    "add_df_to_map": "maps",
+    "load_map": "maps",
+    "city_age": "population",
+    "city_pop": "population",
+    "japan_age": "population",
+    "japan_pop": "population",
+    "pref_age": "population",
+    "pref_pop": "population",
+    "city_names": "readings",
+    "pref_names": "readings",
+}
+
+
+def __getattr__(name):
+    try:
+        subpackage = _LAZY_ATTRIBUTES[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
+    return getattr(importlib.import_module(f"{__name__}.{subpackage}"), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
@@ -0,0 +1,3 @@
+from japandata.cli import main
+
+main()
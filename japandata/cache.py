@@ -0,0 +1,619 @@
+"""
+cache.py
+
+Integrity-checked cache of downloaded and generated files, shared by every japandata module.
+
+All modules cache under one root folder, by default the user cache directory (e.g.
+~/.cache/japandata), which can be changed with the JAPANDATA_CACHE_DIR environment variable or
+`set_cache_root`. Each module gets its own folder under the root.
+
+Every cache folder keeps an index recording, for each entry (a file or a folder of files), the SHA-256,
+size and modification time of its files, and a content hash of the whole entry. Entries are only
+recorded once completely written, so a truncated download or a half-extracted archive is never
+mistaken for a valid entry.
+
+Checking an entry on read is a stat per file against the index. Rehashing is only done on demand,
+e.g. by `japandata cache verify --full`.
+
+Downloads, extractions, generated tables and index updates are guarded by inter-process file locks
+under .locks/ in each cache folder, so that when several processes miss the same entry one builds
+it while the others wait and then read the result.
+
+Map files and generated tables are recorded as evictable. If a size budget is set, with the
+JAPANDATA_CACHE_MAX_BYTES environment variable or `set_cache_budget`, the least recently used
+evictable entries are deleted whenever the cache grows beyond it.
+
+Author: Sam Passaglia
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from filelock import FileLock, Timeout
+
+from japandata.utils import logger
+
+INDEX_NAME = "index.json"
+
+_cache_root = None
+_cache_budget = None
+
+
+def _parse_size(size):
+    if size is None or isinstance(size, int):
+        return size
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    size = str(size).strip().upper().removesuffix("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def set_cache_root(path):
+    """Sets the root folder under which every module caches its data.
+
+    Args:
+        path (Path or None): cache root. None restores the default.
+    """
+    global _cache_root
+    _cache_root = Path(path) if path is not None else None
+
+
+def get_cache_root():
+    """Returns the root folder under which every module caches its data.
+
+    In order of precedence: the folder set with `set_cache_root`, the JAPANDATA_CACHE_DIR environment
+    variable, or japandata/ under the user cache directory ($XDG_CACHE_HOME, by default ~/.cache).
+
+    Returns:
+        Path: cache root
+    """
+    if _cache_root is not None:
+        return _cache_root
+    if os.environ.get("JAPANDATA_CACHE_DIR"):
+        return Path(os.environ["JAPANDATA_CACHE_DIR"])
+    xdg_cache = os.environ.get("XDG_CACHE_HOME") or Path(Path.home(), ".cache")
+    return Path(xdg_cache, "japandata")
+
+
+def cache_dir(dataset):
+    """Returns the cache folder of a module.
+
+    Args:
+        dataset (str): module name, e.g. "maps"
+
+    Returns:
+        Path: cache folder
+    """
+    return Path(get_cache_root(), dataset)
+
+
+def set_cache_budget(max_bytes):
+    """Sets the size budget of the cache, evicting least recently used entries to meet it.
+
+    Args:
+        max_bytes (int, str, or None): budget in bytes, or with a K/M/G/T suffix e.g. "20G". None
+            removes the budget.
+    """
+    global _cache_budget
+    _cache_budget = _parse_size(max_bytes)
+    enforce_budget()
+
+
+def get_cache_budget():
+    """Returns the size budget of the cache in bytes, or None if unbounded.
+
+    Set with `set_cache_budget` or the JAPANDATA_CACHE_MAX_BYTES environment variable.
+    """
+    if _cache_budget is not None:
+        return _cache_budget
+    return _parse_size(os.environ.get("JAPANDATA_CACHE_MAX_BYTES") or None)
+
+
+def sha256sum(path, chunk_size=2**20):
+    """Computes the SHA-256 of a file.
+
+    Args:
+        path (Path): file to hash
+        chunk_size (int, optional): bytes read at a time.
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@contextmanager
+def atomic_path(path):
+    """Yields a temporary path next to `path`, which is renamed to `path` if the block succeeds.
+
+    Readers of `path` therefore never see a partially written file.
+
+    Args:
+        path (Path): final path
+    """
+    path = Path(path)
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _file_lock(folder, name):
+    lock_path = Path(folder, ".locks", name.replace("/", "_") + ".lock")
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    return FileLock(lock_path)
+
+
+@contextmanager
+def cache_lock(folder, name):
+    """Holds an inter-process lock on a cache entry, waiting for it if another process holds it.
+
+    Args:
+        folder (Path): cache folder
+        name (str): name of the locked entry
+    """
+    lock = _file_lock(folder, name)
+    try:
+        lock.acquire(timeout=0)
+    except Timeout:
+        logger.info(f"Waiting for another process to build {name} in {folder}")
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def _file_info(path, sha256=None):
+    stat = path.stat()
+    return {
+        "sha256": sha256 if sha256 is not None else sha256sum(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _stat_matches(path, info):
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return False
+    return stat.st_size == info["size"] and stat.st_mtime_ns == info["mtime_ns"]
+
+
+def source_info(path):
+    """Hash, size, and mtime of a source file, recorded in a build manifest.
+
+    Args:
+        path (Path): source file
+
+    Returns:
+        dict: sha256, size, and mtime_ns
+    """
+    return _file_info(Path(path))
+
+
+def sources_current(recorded, folder):
+    """Whether source files are unchanged since their info was recorded. Files whose stat changed
+    are rehashed, and the recorded stat is updated if their content did not change.
+
+    Args:
+        recorded (dict): `source_info` of each source, by path relative to folder
+        folder (Path): folder of the sources
+
+    Returns:
+        bool: whether every source is unchanged
+    """
+    for relpath, info in recorded.items():
+        path = Path(folder, relpath)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return False
+        if (stat.st_size, stat.st_mtime_ns) == (info["size"], info["mtime_ns"]):
+            continue
+        if sha256sum(path) != info["sha256"]:
+            return False
+        # same content, e.g. extracted again: remember the new stat for the next write
+        info.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    return True
+
+
+def _entry_size(entry):
+    return sum(info["size"] for info in entry["files"].values())
+
+
+class CacheIndex:
+    """Index of the entries of one cache folder.
+
+    Entries are keyed by their path relative to the folder. Each records the SHA-256, size and
+    mtime of its files, a content hash of the entry as a whole, whether it may be evicted, and when
+    it was last used. The index also counts cache hits and misses.
+
+    Hits, misses and access times are kept in memory and written with the next update of the index,
+    or when the process exits, so that reading from a warm cache never writes to disk.
+
+    Entries recorded or found valid by this process are in use: they may be read at any time, so
+    they are never evicted by it to meet the size budget.
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.path = Path(self.folder, INDEX_NAME)
+        self._entries = None
+        self._stats = None
+        self._stat = None
+        self._pending = {"hits": 0, "misses": 0, "accessed": {}}
+        self.in_use = set()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self.reload()
+        return self._entries
+
+    @property
+    def stats(self):
+        """Hits and misses, including those not yet written to disk."""
+        if self._stats is None:
+            self.reload()
+        return {
+            "hits": self._stats.get("hits", 0) + self._pending["hits"],
+            "misses": self._stats.get("misses", 0) + self._pending["misses"],
+        }
+
+    def reload(self):
+        """Rereads the index from disk if it changed, picking up entries recorded by other
+        processes."""
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            self._entries, self._stats, self._stat = {}, {}, None
+            return
+        if self._entries is not None and (stat.st_mtime_ns, stat.st_size) == self._stat:
+            return
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except json.JSONDecodeError:
+            data = {}
+        self._entries = data.get("entries", {})
+        self._stats = data.get("stats", {})
+        self._stat = (stat.st_mtime_ns, stat.st_size)
+
+    def _update(self, entries):
+        # held only for the read-modify-write, so waiting for it is not worth reporting
+        with _file_lock(self.folder, INDEX_NAME):
+            self._locked_update(entries)
+
+    def _locked_update(self, entries):
+        # read-modify-write so that entries recorded by other processes are kept
+        self.reload()
+        for key, entry in entries.items():
+            if entry is None:
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = entry
+        for key, accessed in self._pending["accessed"].items():
+            if key in self._entries:
+                self._entries[key]["accessed"] = max(self._entries[key]["accessed"], accessed)
+        self._stats = {
+            "hits": self._stats.get("hits", 0) + self._pending["hits"],
+            "misses": self._stats.get("misses", 0) + self._pending["misses"],
+        }
+        self._pending = {"hits": 0, "misses": 0, "accessed": {}}
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with atomic_path(self.path) as tmp:
+            with open(tmp, "w") as fp:
+                json.dump(
+                    {"entries": self._entries, "stats": self._stats},
+                    fp,
+                    ensure_ascii=False,
+                    indent=1,
+                )
+        stat = self.path.stat()
+        self._stat = (stat.st_mtime_ns, stat.st_size)
+
+    def flush(self):
+        """Writes pending hits, misses and access times to disk."""
+        if self._pending["hits"] or self._pending["misses"] or self._pending["accessed"]:
+            self._update({})
+
+    def _entry(self, key, sha256=None, evictable=False):
+        path = Path(self.folder, key)
+        if path.is_dir():
+            files = {
+                file.relative_to(path).as_posix(): _file_info(file)
+                for file in sorted(path.rglob("*"))
+                if file.is_file()
+            }
+            h = hashlib.sha256()
+            for name, info in files.items():
+                h.update(f"{name}\0{info['sha256']}\n".encode())
+            sha256 = h.hexdigest()
+        else:
+            files = {"": _file_info(path, sha256)}
+            sha256 = files[""]["sha256"]
+        return {
+            "sha256": sha256,
+            "folder": path.is_dir(),
+            "files": files,
+            "evictable": evictable,
+            "accessed": time.time(),
+        }
+
+    def record(self, key, sha256=None, evictable=False):
+        """Records an entry once it is completely written.
+
+        Args:
+            key (str): path of the entry, a file or a folder, relative to the cache folder
+            sha256 (str, optional): known SHA-256 of a file entry, to skip hashing it again.
+            evictable (bool, optional): whether the entry may be evicted to meet the size budget.
+
+        Returns:
+            dict: the recorded entry
+        """
+        entry = self._entry(key, sha256, evictable)
+        self._update({key: entry})
+        self.in_use.add(key)
+        enforce_budget(protect=[(self.folder, key)])
+        return entry
+
+    def record_many(self, keys, evictable=False):
+        """Records several entries with a single write of the index.
+
+        Args:
+            keys (list): paths of the entries relative to the cache folder
+            evictable (bool, optional): whether the entries may be evicted to meet the size budget.
+        """
+        self._update({key: self._entry(key, evictable=evictable) for key in keys})
+        self.in_use.update(keys)
+        enforce_budget(protect=[(self.folder, key) for key in keys])
+
+    def is_valid(self, key, adopt=None, evictable=False, count=True):
+        """Cheap check that an entry is cached and intact. Counts as a cache hit or miss.
+
+        A file entry is valid if its size and mtime match the index. A folder entry is valid if it
+        was completely written; its files are only checked by `verify`.
+
+        Args:
+            key (str): path of the entry relative to the cache folder
+            adopt (callable, optional): for files cached before the index existed. Called with the
+                path of an unindexed file; if it returns True the file is recorded as valid.
+            evictable (bool, optional): whether an adopted entry may be evicted.
+            count (bool, optional): count as a hit or miss. False when checking again after
+                acquiring the entry's lock.
+
+        Returns:
+            bool: whether the entry can be read
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.reload()
+            entry = self.entries.get(key)
+        path = Path(self.folder, key)
+        if entry is None:
+            valid = adopt is not None and path.is_file() and adopt(path)
+            if valid:
+                self.record(key, evictable=evictable)
+        elif entry["folder"]:
+            valid = path.is_dir()
+        else:
+            valid = _stat_matches(path, entry["files"][""])
+
+        if valid:
+            self._pending["accessed"][key] = time.time()
+            self.in_use.add(key)
+        if count:
+            self._pending["hits" if valid else "misses"] += 1
+        return valid
+
+    def verify(self, key, full=False):
+        """Checks every file of an entry against the index.
+
+        Args:
+            key (str): path of the entry relative to the cache folder
+            full (bool, optional): rehash the files instead of comparing size and mtime.
+
+        Returns:
+            bool: whether the entry is intact
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        path = Path(self.folder, key)
+        for name, info in entry["files"].items():
+            file = Path(path, name) if name else path
+            if full:
+                if not file.is_file() or sha256sum(file) != info["sha256"]:
+                    return False
+            elif not _stat_matches(file, info):
+                return False
+        return True
+
+    def verify_all(self, full=False):
+        """Checks every entry of the index.
+
+        Args:
+            full (bool, optional): rehash the files instead of comparing size and mtime.
+
+        Returns:
+            list: keys of the corrupted entries
+        """
+        self.reload()
+        return [key for key in list(self.entries) if not self.verify(key, full=full)]
+
+    def discard(self, key):
+        """Deletes an entry and its files.
+
+        Args:
+            key (str): path of the entry relative to the cache folder
+        """
+        path = Path(self.folder, key)
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+        self._update({key: None})
+        self.in_use.discard(key)
+        logger.info(f"Discarded {key} from {self.folder}")
+
+
+_INDICES = {}
+
+
+def get_index(folder):
+    """Returns the index of a cache folder, shared by all callers in this process.
+
+    Args:
+        folder (Path): cache folder
+
+    Returns:
+        CacheIndex: index
+    """
+    folder = Path(folder).resolve()
+    if folder not in _INDICES:
+        _INDICES[folder] = CacheIndex(folder)
+    return _INDICES[folder]
+
+
+def _all_indices():
+    root = get_cache_root()
+    if not root.is_dir():
+        return []
+    return [
+        get_index(folder) for folder in sorted(root.iterdir()) if Path(folder, INDEX_NAME).exists()
+    ]
+
+
+@atexit.register
+def flush_all():
+    """Writes the pending hits, misses and access times of every index."""
+    for index in list(_INDICES.values()):
+        try:
+            index.flush()
+        except OSError:
+            pass  # e.g. a read-only cache
+
+
+def enforce_budget(max_bytes=None, protect=()):
+    """Evicts the least recently used evictable entries until the cache fits in its size budget.
+
+    Entries in use by this process, see `CacheIndex`, and protected entries are never evicted. If
+    the cache cannot fit in the budget without them, a warning is logged instead.
+
+    Args:
+        max_bytes (int, optional): budget. Defaults to the configured budget.
+        protect (list, optional): (folder, key) of further entries not to evict, e.g. ones about to
+            be read.
+
+    Returns:
+        list: (folder, key) of the evicted entries
+    """
+    if max_bytes is None:
+        max_bytes = get_cache_budget()
+    if max_bytes is None:
+        return []
+
+    protect = {(Path(folder).resolve(), key) for folder, key in protect}
+    indices = _all_indices()
+    for index in indices:
+        index.flush()
+    total = sum(_entry_size(entry) for index in indices for entry in index.entries.values())
+    candidates = sorted(
+        (
+            (entry["accessed"], index, key, _entry_size(entry))
+            for index in indices
+            for key, entry in index.entries.items()
+            if entry["evictable"] and key not in index.in_use and (index.folder, key) not in protect
+        ),
+        key=lambda candidate: candidate[0],
+    )
+
+    evicted = []
+    for _, index, key, size in candidates:
+        if total <= max_bytes:
+            break
+        index.discard(key)
+        total -= size
+        evicted.append((index.folder, key))
+    if total > max_bytes:
+        logger.warning(
+            f"japandata cache holds {total} bytes of non-evictable or in-use entries, over its"
+            f" budget of {max_bytes} bytes."
+        )
+    return evicted
+
+
+def cache_stats():
+    """Reports the size of the cache and its hits and misses, per module.
+
+    Returns:
+        dict: for each module folder, its bytes on disk, indexed entries, evictable bytes, hits and
+            misses
+    """
+    root = get_cache_root()
+    stats = {}
+    if not root.is_dir():
+        return stats
+    for folder in sorted(root.iterdir()):
+        if not folder.is_dir():
+            continue
+        index = get_index(folder)
+        stats[folder.name] = {
+            "bytes": sum(file.stat().st_size for file in folder.rglob("*") if file.is_file()),
+            "entries": len(index.entries),
+            "evictable_bytes": sum(
+                _entry_size(entry) for entry in index.entries.values() if entry["evictable"]
+            ),
+            **index.stats,
+        }
+    return stats
+
+
+def parquet_is_readable(path):
+    """Whether a parquet file is complete, judging from its footer. Used to adopt old caches."""
+    import pyarrow.parquet as pq
+
+    try:
+        pq.read_metadata(path)
+    except Exception:
+        return False
+    return True
+
+
+def json_is_readable(path):
+    """Whether a JSON file parses. Used to adopt old caches."""
+    try:
+        with open(path, "rb") as fp:
+            json.load(fp)
+    except Exception:
+        return False
+    return True
+
+
+def xlsx_is_readable(path):
+    """Whether an xlsx file is a complete zip archive. Used to adopt old caches."""
+    import zipfile
+
+    try:
+        with zipfile.ZipFile(path) as zf:
+            return zf.testzip() is None
+    except Exception:
+        return False
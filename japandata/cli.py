@@ -0,0 +1,156 @@
+"""
+cli.py
+
+Command line interface of japandata.
+
+Usage:
+    japandata prefetch maps --dates 1970:2022 --scales jp_city_dc --qualities c,l --jobs 16
+    japandata prefetch population
+    japandata cache verify [--full] [maps population indices readings]
+    japandata cache repair [--full] [maps population indices readings]
+    japandata cache stats
+
+Author: Sam Passaglia
+"""
+
+import argparse
+import importlib
+
+DATASETS = ["maps", "population", "indices", "readings"]
+
+
+def _split(value):
+    return value.split(",")
+
+
+def _date_range(value):
+    start, _, end = value.partition(":")
+    return (start or None, end or None)
+
+
+def prefetch(args):
+    if args.dataset == "maps":
+        from japandata.maps import prefetch as prefetch_maps
+
+        start, end = args.dates
+        prefetch_maps(
+            start=start, end=end, scales=args.scales, qualities=args.qualities, jobs=args.jobs
+        )
+    elif args.dataset == "population":
+        from japandata.population import fetch_data
+
+        fetch_data()
+    elif args.dataset == "indices":
+        from japandata.indices import fetch_data
+
+        fetch_data()
+    elif args.dataset == "readings":
+        from japandata.readings import fetch_data
+
+        fetch_data()
+
+
+def _format_bytes(n):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def cache(args):
+    from japandata.cache import (
+        cache_stats,
+        get_cache_budget,
+        get_cache_root,
+        get_index,
+    )
+
+    if args.action == "stats":
+        stats = cache_stats()
+        budget = get_cache_budget()
+        print(f"cache root: {get_cache_root()}")
+        print(f"budget: {_format_bytes(budget) if budget is not None else 'unbounded'}")
+        print(f"{'folder':<12}{'size':>12}{'evictable':>12}{'entries':>9}{'hits':>9}{'misses':>9}")
+        for folder, s in stats.items():
+            print(
+                f"{folder:<12}{_format_bytes(s['bytes']):>12}"
+                f"{_format_bytes(s['evictable_bytes']):>12}"
+                f"{s['entries']:>9}{s['hits']:>9}{s['misses']:>9}"
+            )
+        total = sum(s["bytes"] for s in stats.values())
+        print(f"{'total':<12}{_format_bytes(total):>12}")
+        return
+
+    for dataset in args.datasets or DATASETS:
+        module = importlib.import_module(f"japandata.{dataset}")
+        index = get_index(module.CACHE_FOLDER)
+        corrupted = index.verify_all(full=args.full)
+        print(f"{dataset}: {len(index.entries)} entries, {len(corrupted)} corrupted")
+        for key in corrupted:
+            print(f"    {key}")
+
+        if args.action == "repair":
+            for key in corrupted:
+                index.discard(key)
+            # refetching one entry may rebuild several, so only refetch what is still missing
+            for key in corrupted:
+                if not index.is_valid(key):
+                    module.refetch(key)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="japandata", description="Geographic data about Japan")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    prefetch_parser = commands.add_parser("prefetch", help="download data into the cache")
+    prefetch_parser.add_argument("dataset", choices=DATASETS)
+    prefetch_parser.add_argument(
+        "--dates",
+        type=_date_range,
+        default=(None, None),
+        help="maps only: START:END dates or years, either may be omitted (e.g. 1970:2022)",
+    )
+    prefetch_parser.add_argument(
+        "--scales", type=_split, help="maps only: comma-separated scales (e.g. jp_city_dc,jp_pref)"
+    )
+    prefetch_parser.add_argument(
+        "--qualities", type=_split, help="maps only: comma-separated qualities (e.g. c,l)"
+    )
+    prefetch_parser.add_argument(
+        "--jobs", type=int, default=8, help="maps only: concurrent downloads (default: 8)"
+    )
+    prefetch_parser.set_defaults(func=prefetch)
+
+    cache_parser = commands.add_parser("cache", help="check and repair the cache")
+    cache_parser.add_argument(
+        "action",
+        choices=["verify", "repair", "stats"],
+        help="verify: report corrupted entries, repair: refetch corrupted entries, stats: report"
+        " size and hit/miss counts",
+    )
+    cache_parser.add_argument(
+        "datasets",
+        nargs="*",
+        metavar="dataset",
+        help=f"any of {', '.join(DATASETS)} (default: all)",
+    )
+    cache_parser.add_argument(
+        "--full", action="store_true", help="rehash files instead of comparing size and mtime"
+    )
+    cache_parser.set_defaults(func=cache)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    unknown = [dataset for dataset in getattr(args, "datasets", []) if dataset not in DATASETS]
+    if unknown:
+        parser.error(f"unknown datasets: {', '.join(unknown)}")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,11 @@
-from .download import DOWNLOAD_INFO, download_progress  # noqa: F401
+from .download import (  # noqa: F401
+    __getattr__,
+    download_many,
+    download_progress,
+    extract_progress,
+    fetch_download_info,
+    get_checksum,
+    get_url,
+    load_bundled_download_info,
+    make_session,
+)
@@ -17,12 +17,17 @@ The above copyright notice and this permission notice shall be included in all
 copies or substantial portions of the Software.
 """
 
-from urllib.request import urlretrieve
+import hashlib
+import json
+import os
+import time
+from functools import lru_cache
+from pathlib import Path
 
-import requests
 from tqdm import tqdm
 
-from japandata.utils import logger
+from japandata.cache import cache_dir
+from japandata.utils import lazy_module_attributes, load_dict, logger
 
 # DOWNLOAD_INFO_URL = (
 #     "https://raw.githubusercontent.com/passaglia/japandata/master/downloads.json"
@@ -32,46 +37,357 @@ DOWNLOAD_INFO_URL = (
     "https://raw.githubusercontent.com/passaglia/japandata/feat-refactor/downloads.json"
 )
 
+# The download info shipped with the package. It is used as is until a cache miss requires a
+# download, at which point the remote copy is consulted.
+BUNDLED_DOWNLOAD_INFO = Path(Path(__file__).parent, "downloads.json")
 
-def get_json(url, desc):
-    r = requests.get(url)
+
+# Seconds for which a fetched copy of the remote download info is trusted without revalidation.
+DOWNLOAD_INFO_TTL = float(os.environ.get("JAPANDATA_DOWNLOAD_INFO_TTL", 24 * 60 * 60))
+
+# Never contact DOWNLOAD_INFO_URL, e.g. on air-gapped hosts with a pre-populated cache.
+OFFLINE = os.environ.get("JAPANDATA_OFFLINE", "") not in ["", "0"]
+
+
+@lru_cache(maxsize=None)
+def load_bundled_download_info():
+    """Loads the download info shipped with the package.
+
+    Returns:
+        dict: download info
+    """
+    return load_dict(BUNDLED_DOWNLOAD_INFO)
+
+
+def _write_json(data, path):
+    tmp = path.with_name(path.name + f".{os.getpid()}.tmp")
+    with open(tmp, "w") as fp:
+        json.dump(data, fp, ensure_ascii=False, indent=4)
+    os.replace(tmp, path)
+
+
+def fetch_download_info(ttl=None):
+    """Fetches the remote download info, revalidating the stored copy with ETag/If-Modified-Since.
+
+    The remote copy is stored in the cache and only revalidated once it is older than `ttl`. If the
+    remote cannot be reached, the stored copy is used, and failing that the bundled one.
+
+    Args:
+        ttl (float, optional): seconds for which the stored copy is trusted. Defaults to
+            DOWNLOAD_INFO_TTL.
+
+    Returns:
+        dict: download info
+    """
+    if ttl is None:
+        ttl = DOWNLOAD_INFO_TTL
+
+    stored = Path(cache_dir("download"), "downloads.json")
+    stored_meta = Path(stored.parent, "downloads.meta.json")
+    meta = load_dict(stored_meta) if (stored.exists() and stored_meta.exists()) else {}
+
+    if OFFLINE or (meta and time.time() - meta["fetched_at"] < ttl):
+        return load_dict(stored) if meta else load_bundled_download_info()
+
+    import requests
+
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        r = requests.get(DOWNLOAD_INFO_URL, headers=headers, timeout=10)
+    except requests.RequestException as e:
+        logger.warning(f"Couldn't fetch download info ({e}), using local copy.")
+        return load_dict(stored) if meta else load_bundled_download_info()
+
+    if r.status_code == 304:
+        meta["fetched_at"] = time.time()
+        _write_json(meta, stored_meta)
+        return load_dict(stored)
     if r.status_code != 200:
-        logger.error(
-            "Server error ({})".format(r.status_code),
-            "Couldn't fetch {}. If this error persists please open an issue."
-            " http://github.com/passaglia/japandata/issues/".format(desc),
-            exits=1,
+        logger.warning(
+            f"Server error ({r.status_code}) fetching download info, using local copy."
+            " If this error persists please open an issue."
+            " http://github.com/passaglia/japandata/issues/"
         )
-    return r.json()
-
-
-DOWNLOAD_INFO = get_json(DOWNLOAD_INFO_URL, "download info")
-
-
-# This is used to show progress when downloading.
-# see here: https://github.com/tqdm/tqdm#hooks-and-callbacks
-class TqdmUpTo(tqdm):
-    """Provides `update_to(n)` which uses `tqdm.update(delta_n)`."""
-
-    def update_to(self, b=1, bsize=1, tsize=None):
-        """
-        b  : int, optional
-            Number of blocks transferred so far [default: 1].
-        bsize  : int, optional
-            Size of each block (in tqdm units) [default: 1].
-        tsize  : int, optional
-            Total size (in tqdm units). If [default: None] remains unchanged.
-        """
-        if tsize is not None:
-            self.total = tsize
-        self.update(b * bsize - self.n)  # will also set self.n = b * bsize
-
-
-def download_progress(url, fname):
-    """Download a file and show a progress bar."""
-    with TqdmUpTo(
-        unit="B", unit_scale=True, miniters=1, desc=url.split("/")[-1]
-    ) as t:  # all optional kwargs
-        urlretrieve(url, filename=fname, reporthook=t.update_to, data=None)
-        t.total = t.n
+        return load_dict(stored) if meta else load_bundled_download_info()
+
+    info = r.json()
+    stored.parent.mkdir(parents=True, exist_ok=True)
+    _write_json(info, stored)
+    _write_json(
+        {
+            "fetched_at": time.time(),
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+        },
+        stored_meta,
+    )
+    return info
+
+
+def get_checksum(dataset, version="latest"):
+    """Returns the expected SHA-256 of a dataset download, if the download info provides one.
+
+    Args:
+        dataset (str): "maps", "readings", "indices", or "population"
+        version (str, optional): dataset version. Defaults to "latest".
+
+    Returns:
+        str or None: hex digest
+    """
+    try:
+        return fetch_download_info()[dataset][version].get("sha256")
+    except KeyError:
+        return load_bundled_download_info()[dataset][version].get("sha256")
+
+
+def get_url(dataset, version="latest"):
+    """Returns the download url of a dataset.
+
+    Only called on a cache miss, so this is the one place the remote download info is consulted.
+
+    Args:
+        dataset (str): "maps", "readings", "indices", or "population"
+        version (str, optional): dataset version. Defaults to "latest".
+
+    Returns:
+        str: url
+    """
+    try:
+        return fetch_download_info()[dataset][version]["url"]
+    except KeyError:
+        return load_bundled_download_info()[dataset][version]["url"]
+
+
+__getattr__ = lazy_module_attributes(__name__, {"DOWNLOAD_INFO": load_bundled_download_info})
+
+
+def make_session(pool_size=10):
+    """Creates an HTTP session whose connections are pooled and reused across downloads.
+
+    Args:
+        pool_size (int, optional): number of connections kept open per host. Defaults to 10.
+
+    Returns:
+        requests.Session: session
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_progress(url, fname, session=None, progress=True, chunk_size=2**16, sha256=None):
+    """Download a file and show a progress bar.
+
+    The file is written to `fname`.part and only renamed to `fname` once complete, so `fname` never
+    holds a partial download. If an earlier download was interrupted, it is resumed with a Range
+    request.
+
+    Args:
+        url (str): url to download
+        fname (Path): destination
+        session (requests.Session, optional): session to download with. Defaults to a new one.
+        progress (bool, optional): show a progress bar. Defaults to True.
+        chunk_size (int, optional): bytes read from the response at a time.
+        sha256 (str, optional): expected SHA-256 of the file. Checked before renaming into place.
+
+    Returns:
+        Path: fname
+    """
+    if session is None:
+        session = make_session(pool_size=1)
+
+    fname = Path(fname)
+    part = fname.with_name(fname.name + ".part")
+    offset = part.stat().st_size if part.exists() else 0
+    # byte ranges must refer to the file itself rather than a compressed transfer of it
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+
+    with session.get(url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code == 416:
+            # the partial download is already complete, or the remote file changed under it
+            total = r.headers.get("Content-Range", "").rpartition("/")[2]
+            if total == str(offset):
+                return _finish_download(part, fname, sha256)
+            part.unlink()
+            return download_progress(url, fname, session, progress, chunk_size, sha256)
+        r.raise_for_status()
+        if r.status_code != 206:
+            offset = 0  # the server ignored the Range header, start over
+        total = int(r.headers["Content-Length"]) + offset if "Content-Length" in r.headers else None
+
+        with tqdm(
+            unit="B",
+            unit_scale=True,
+            miniters=1,
+            desc=url.split("/")[-1],
+            total=total,
+            initial=offset,
+            disable=not progress,
+        ) as t, open(part, "ab" if offset else "wb") as fp:
+            for chunk in r.iter_content(chunk_size):
+                fp.write(chunk)
+                t.update(len(chunk))
+
+    return _finish_download(part, fname, sha256)
+
+
+def _finish_download(part, fname, sha256):
+    if sha256 is not None:
+        from japandata.cache import sha256sum
+
+        if sha256sum(part) != sha256:
+            part.unlink()
+            raise Exception(f"Checksum mismatch for {fname.name}, the download was discarded.")
+    os.replace(part, fname)
     return fname
+
+
+def _download_locked(url, fname, session, lock):
+    with lock(fname):
+        if Path(fname).exists():
+            # completed by another holder of the lock while we waited
+            return fname
+        return download_progress(url, fname, session, False)
+
+
+def download_many(downloads, jobs=8, desc="Downloading", lock=None):
+    """Downloads many files concurrently over a bounded thread pool sharing one HTTP session.
+
+    Each file is downloaded as in `download_progress`: atomically, and resuming any earlier partial
+    download, so an interrupted call can simply be repeated.
+
+    Args:
+        downloads (list): (url, fname) pairs
+        jobs (int, optional): number of concurrent downloads. Defaults to 8.
+        desc (str, optional): progress bar description.
+        lock (callable, optional): called with each fname, returns a context manager held while
+            downloading it, e.g. an inter-process lock. A file which exists once the lock is
+            acquired was completed meanwhile and is not downloaded again.
+
+    Returns:
+        list: downloaded filepaths
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    session = make_session(pool_size=jobs)
+    fetched = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor, tqdm(
+        total=len(downloads), desc=desc, unit="file"
+    ) as t:
+        futures = {
+            (
+                executor.submit(download_progress, url, fname, session, False)
+                if lock is None
+                else executor.submit(_download_locked, url, fname, session, lock)
+            ): url
+            for url, fname in downloads
+        }
+        for future in as_completed(futures):
+            try:
+                fetched.append(future.result())
+            except Exception as e:
+                logger.error(f"Failed to download {futures[future]}: {e}")
+                failed.append(futures[future])
+            t.update()
+
+    if failed:
+        raise Exception(
+            f"{len(failed)} of {len(downloads)} downloads failed. Rerun to retry, completed and"
+            " partial downloads are kept."
+        )
+    return fetched
+
+
+class _HashingReader:
+    """File-like wrapper which hashes everything read through it."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.hash = hashlib.sha256()
+
+    def read(self, *args):
+        data = self.raw.read(*args)
+        self.hash.update(data)
+        return data
+
+
+def extract_progress(url, folder, session=None, sha256=None):
+    """Download a .tar.gz archive and extract it while it downloads, showing a progress bar.
+
+    The response is streamed straight into tarfile, so members are extracted as bytes arrive and
+    the archive itself is never written to disk. The archive must hold a single top-level folder
+    with the name of `folder`. It is extracted into a temporary directory next to `folder` and
+    renamed into place once complete, so `folder` never holds a partial extraction.
+
+    Args:
+        url (str): url of the archive
+        folder (Path): destination folder
+        session (requests.Session, optional): session to download with. Defaults to a new one.
+        sha256 (str, optional): expected SHA-256 of the archive. Checked before renaming into place.
+
+    Returns:
+        Path: folder
+    """
+    import shutil
+    import tarfile
+    import tempfile
+
+    if session is None:
+        session = make_session(pool_size=1)
+
+    folder = Path(folder)
+    tmp = Path(tempfile.mkdtemp(dir=folder.parent, prefix=f".{folder.name}."))
+    try:
+        with session.get(
+            url, headers={"Accept-Encoding": "identity"}, stream=True, timeout=60
+        ) as r:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            total = int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None
+            hashing = _HashingReader(r.raw)
+            with tqdm.wrapattr(
+                hashing,
+                "read",
+                total=total,
+                desc=url.split("/")[-1],
+                unit="B",
+                unit_scale=True,
+                miniters=1,
+            ) as stream, tarfile.open(fileobj=stream, mode="r|gz") as tf:
+                if hasattr(tarfile, "data_filter"):
+                    tf.extractall(tmp, filter="data")
+                else:
+                    tf.extractall(tmp)
+                # consume any trailing padding so that the whole archive is hashed
+                while stream.read(2**16):
+                    pass
+
+        if sha256 is not None and hashing.hash.hexdigest() != sha256:
+            raise Exception(
+                f"Checksum mismatch for {url.split('/')[-1]}, the download was discarded."
+            )
+
+        if not Path(tmp, folder.name).is_dir():
+            raise Exception(f"{url} does not contain a top-level {folder.name} folder")
+        os.replace(Path(tmp, folder.name), folder)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return folder
@@ -0,0 +1,83 @@
+"""
+dtypes.py
+
+Compact in-memory layout of the population and indices tables, in which they are also cached.
+
+In the compact layout names (prefecture, city, gender, nationality...) are categoricals, codes are
+integers, counts are int32, and years are int16. This takes a fraction of the memory of the
+default layout, in which names and codes are strings and counts and years are int64.
+
+Author: Sam Passaglia
+"""
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import (
+    is_integer_dtype,
+    is_numeric_dtype,
+    is_string_dtype,
+)
+
+# columns holding zero-padded codes, with their width. None: 2 for prefectures, 5 for municipalities
+CODE_COLUMNS = {"code": None, "code6digit": 6}
+INT32 = np.iinfo(np.int32)
+
+
+def _code_width(column, codes):
+    if CODE_COLUMNS[column] is not None:
+        return CODE_COLUMNS[column]
+    # prefecture codes run up to 47, municipality codes start from 01100
+    return 5 if codes.max() >= 100 else 2
+
+
+def compact_dtypes(df):
+    """Converts a table to the compact layout.
+
+    Args:
+        df (pd.DataFrame): table in either layout
+
+    Returns:
+        pd.DataFrame: table in the compact layout
+    """
+    df = df.copy(deep=False)
+    for column in df.columns:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            continue
+        if column in CODE_COLUMNS:
+            codes = pd.to_numeric(values)
+            df[column] = codes.astype("Int32" if codes.isna().any() else "int32")
+        elif values.dtype == object or is_string_dtype(values.dtype):
+            df[column] = values.astype("category")
+        elif is_integer_dtype(values.dtype):
+            if column == "year":
+                df[column] = values.astype("int16")
+            elif len(values) == 0 or (INT32.min <= values.min() and values.max() <= INT32.max):
+                df[column] = values.astype("int32")
+    return df
+
+
+def expand_dtypes(df):
+    """Converts a table to the default layout.
+
+    Args:
+        df (pd.DataFrame): table in either layout
+
+    Returns:
+        pd.DataFrame: table in the default layout
+    """
+    df = df.copy(deep=False)
+    for column in df.columns:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            df[column] = values.astype(values.cat.categories.dtype)
+        elif column in CODE_COLUMNS and is_numeric_dtype(values.dtype):
+            valid = values.notna()
+            codes = pd.Series(np.nan, index=values.index, dtype=object)
+            if valid.any():
+                width = _code_width(column, values[valid])
+                codes[valid] = values[valid].astype("int64").astype(str).str.zfill(width)
+            df[column] = codes.infer_objects()  # the default string dtype of this pandas
+        elif is_integer_dtype(values.dtype) and values.dtype != np.int64:
+            df[column] = values.astype("int64")
+    return df
@@ -0,0 +1,341 @@
+"""
+excel.py
+
+Reading of the source spreadsheets, shared by the loaders of the modules.
+
+The cells of a sheet are read by an engine: python-calamine when it is installed, which parses both
+.xls and .xlsx files several times faster, and otherwise xlrd for .xls and openpyxl for .xlsx files,
+as in pandas. The raw cells of each sheet are cached as Arrow, keyed by the sha256 of the file, so
+that changes to how the tables are cleaned rerun without parsing any spreadsheet again. The cells
+are then turned into a dataframe by the same parser as `pd.read_excel`.
+
+Author: Sam Passaglia
+"""
+
+import math
+import os
+from datetime import date, datetime, time, timedelta
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from japandata.cache import (
+    atomic_path,
+    cache_dir,
+    cache_lock,
+    get_index,
+    sha256sum,
+)
+from japandata.utils import logger
+
+ENGINE_ENV = "JAPANDATA_EXCEL_ENGINE"
+# bump to discard the cached sheets after changing how cells are read or stored
+SHEET_VERSION = 1
+
+_engine = None
+_hashes = {}
+
+
+"""
+Engines, each reading the first sheet of a file into rows of cells as pandas does
+"""
+
+
+def _convert_number(value):
+    # Excel numbers are all floats: integers are returned as ints, as in pandas
+    if isinstance(value, float) and math.isfinite(value) and value == int(value):
+        return int(value)
+    return value
+
+
+def _read_calamine(path):
+    from python_calamine import CalamineWorkbook
+
+    rows = (
+        CalamineWorkbook.from_path(str(path)).get_sheet_by_index(0).to_python(skip_empty_area=False)
+    )
+
+    def convert(value):
+        if isinstance(value, (datetime, date)) and not isinstance(value, time):
+            return pd.Timestamp(value)
+        if isinstance(value, timedelta):
+            return pd.Timedelta(value)
+        return _convert_number(value)
+
+    return [[convert(cell) for cell in row] for row in rows]
+
+
+def _read_openpyxl(path):
+    from openpyxl import load_workbook
+    from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+
+    book = load_workbook(path, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = book.worksheets[0]
+        sheet.reset_dimensions()
+        rows = []
+        for row in sheet.rows:
+            cells = []
+            for cell in row:
+                if cell.value is None:
+                    cells.append("")
+                elif cell.data_type == TYPE_ERROR:
+                    cells.append(np.nan)
+                elif cell.data_type == TYPE_NUMERIC:
+                    cells.append(_convert_number(float(cell.value)))
+                else:
+                    cells.append(cell.value)
+            rows.append(cells)
+    finally:
+        book.close()
+    return rows
+
+
+def _read_xlrd(path):
+    import xlrd
+
+    book = xlrd.open_workbook(path)
+    sheet = book.sheet_by_index(0)
+
+    def convert(value, cell_type):
+        if cell_type == xlrd.XL_CELL_DATE:
+            try:
+                value = xlrd.xldate.xldate_as_datetime(value, book.datemode)
+            except OverflowError:
+                return value
+            # dates on the epoch are times only
+            epoch = (1904, 1, 1) if book.datemode else (1899, 12, 31)
+            if value.timetuple()[0:3] == epoch:
+                return value.time()
+            return value
+        if cell_type == xlrd.XL_CELL_ERROR:
+            return np.nan
+        if cell_type == xlrd.XL_CELL_BOOLEAN:
+            return bool(value)
+        if cell_type == xlrd.XL_CELL_NUMBER:
+            return _convert_number(value)
+        return value
+
+    return [
+        [convert(value, kind) for value, kind in zip(sheet.row_values(i), sheet.row_types(i))]
+        for i in range(sheet.nrows)
+    ]
+
+
+ENGINES = {
+    "calamine": (_read_calamine, [".xls", ".xlsx"]),
+    "xlrd": (_read_xlrd, [".xls"]),
+    "openpyxl": (_read_openpyxl, [".xlsx"]),
+}
+
+
+def set_excel_engine(engine):
+    """Sets the engine reading spreadsheets, overriding the JAPANDATA_EXCEL_ENGINE variable.
+
+    Args:
+        engine (str): "calamine", "xlrd", or "openpyxl", or None to choose automatically
+    """
+    global _engine
+    if engine is not None and engine not in ENGINES:
+        raise Exception(f"Unknown Excel engine {engine}. Expected one of {list(ENGINES)}")
+    _engine = engine
+
+
+def get_excel_engine(path):
+    """Engine reading a spreadsheet: the configured one if it reads its format, else calamine
+    if installed, else xlrd for .xls and openpyxl for .xlsx files.
+
+    Args:
+        path (Path): spreadsheet
+
+    Returns:
+        str: engine name
+    """
+    extension = Path(path).suffix.lower()
+    engine = _engine or os.environ.get(ENGINE_ENV)
+    if engine is not None and engine not in ENGINES:
+        raise Exception(f"Unknown Excel engine {engine}. Expected one of {list(ENGINES)}")
+    if engine is not None and extension in ENGINES[engine][1]:
+        return engine
+    try:
+        import python_calamine  # noqa: F401
+
+        return "calamine"
+    except ImportError:
+        return "xlrd" if extension == ".xls" else "openpyxl"
+
+
+def _trim(rows):
+    """Drops the trailing empty rows and columns and pads the rows to the same width, so that
+    every engine gives the same cells."""
+
+    def empty(cell):
+        return cell is None or (isinstance(cell, str) and cell == "")
+
+    rows = [["" if cell is None else cell for cell in row] for row in rows]
+    for row in rows:
+        while row and empty(row[-1]):
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    width = max((len(row) for row in rows), default=0)
+    return [row + [""] * (width - len(row)) for row in rows]
+
+
+def read_cells(path, engine=None):
+    """Reads the cells of the first sheet of a spreadsheet, without caching.
+
+    Args:
+        path (Path): spreadsheet
+        engine (str, optional): engine. Defaults to `get_excel_engine(path)`.
+
+    Returns:
+        list: rows of cells: str, int, float, or other values such as dates, "" if empty
+    """
+    engine = engine or get_excel_engine(path)
+    reader, _ = ENGINES[engine]
+    return _trim(reader(path))
+
+
+"""
+Raw sheet cache
+"""
+
+
+def _encode(rows):
+    """Stores each column of cells as a float64 column of its numbers and a string column of the
+    rest, other values such as dates being stored as their text."""
+    import pyarrow as pa
+
+    width = len(rows[0]) if rows else 0
+    arrays, names = [], []
+    for j in range(width):
+        cells = [row[j] for row in rows]
+        is_number = [
+            isinstance(cell, (int, float, np.integer, np.floating)) and not isinstance(cell, bool)
+            for cell in cells
+        ]
+        arrays.append(
+            pa.array(
+                [float(cell) if number else None for cell, number in zip(cells, is_number)],
+                type=pa.float64(),
+            )
+        )
+        arrays.append(
+            pa.array(
+                [None if number else str(cell) for cell, number in zip(cells, is_number)],
+                type=pa.string(),
+            )
+        )
+        names += [f"n{j}", f"s{j}"]
+    return pa.table(arrays, names=names) if arrays else pa.table({})
+
+
+def _decode(table):
+    columns = []
+    for j in range(table.num_columns // 2):
+        numbers = table.column(f"n{j}")
+        cells = np.array(table.column(f"s{j}").to_pylist(), dtype=object)
+        is_number = ~np.asarray(numbers.is_null())
+        values = numbers.to_numpy(zero_copy_only=False)[is_number]
+        converted = np.empty(len(values), dtype=object)
+        converted[:] = values.tolist()
+        integral = np.isfinite(values) & (values == np.trunc(values))
+        converted[integral] = values[integral].astype(np.int64).tolist()
+        cells[is_number] = converted
+        columns.append(cells)
+    return np.column_stack(columns).tolist() if columns else []
+
+
+def _file_hash(path):
+    stat = path.stat()
+    key = (path.resolve(), stat.st_size, stat.st_mtime_ns)
+    if key not in _hashes:
+        _hashes[key] = sha256sum(path)
+    return _hashes[key]
+
+
+def read_sheet(path, engine=None):
+    """Reads the cells of the first sheet of a spreadsheet, caching them by the hash of the file.
+
+    Args:
+        path (Path): spreadsheet
+        engine (str, optional): engine. Defaults to `get_excel_engine(path)`.
+
+    Returns:
+        list: rows of cells, see `read_cells`
+    """
+    import pyarrow.feather as feather
+
+    path = Path(path)
+    engine = engine or get_excel_engine(path)
+    key = f"sheets/{_file_hash(path)}.{engine}.v{SHEET_VERSION}.arrow"
+    cache_folder = cache_dir("excel")
+    index = get_index(cache_folder)
+    cached = Path(cache_folder, key)
+
+    if not index.is_valid(key, evictable=True):
+        with cache_lock(cache_folder, key):
+            # another process may have parsed it while we waited for the lock
+            if not index.is_valid(key, evictable=True, count=False):
+                logger.debug(f"Parsing {path.name} with {engine}")
+                table = _encode(read_cells(path, engine))
+                cached.parent.mkdir(parents=True, exist_ok=True)
+                with atomic_path(cached) as tmp:
+                    feather.write_feather(table, tmp)
+                index.record(key, evictable=True)
+                # decoded as when read from the cache, so that both give the same cells
+                return _decode(table)
+
+    return _decode(feather.read_table(cached))
+
+
+def read_excel(
+    path,
+    skiprows=None,
+    header=0,
+    names=None,
+    dtype=None,
+    usecols=None,
+    skipfooter=0,
+    na_values=None,
+    engine=None,
+):
+    """Reads the first sheet of a spreadsheet into a dataframe, as `pd.read_excel` does.
+
+    Args:
+        path (Path): spreadsheet
+        skiprows (int, optional): rows skipped at the start of the sheet
+        header (int, optional): row of the column names, None if there is none. Defaults to 0.
+        names (list, optional): column names, of the columns read if usecols is given
+        dtype (dict, optional): dtypes of some columns
+        usecols (list, optional): positions of the columns read. Defaults to every column.
+        skipfooter (int, optional): rows skipped at the end of the sheet. Defaults to 0.
+        na_values (list, optional): cell values read as missing, besides the pandas defaults
+        engine (str, optional): engine. Defaults to `get_excel_engine(path)`.
+
+    Returns:
+        pd.DataFrame: sheet
+    """
+    from pandas.io.parsers import TextParser
+
+    rows = read_sheet(path, engine)
+    if not rows:
+        return pd.DataFrame(columns=names)
+    if usecols is not None:
+        # selected before parsing, so that the other columns are never converted
+        width = len(rows[0])
+        rows = [[row[j] if j < width else "" for j in usecols] for row in rows]
+    # the arguments with which pd.read_excel parses the cells
+    parser = TextParser(
+        rows,
+        names=names,
+        header=header,
+        dtype=dtype,
+        skiprows=skiprows,
+        skipfooter=skipfooter,
+        na_values=na_values,
+        skip_blank_lines=False,
+    )
+    return parser.read()
@@ -1,7 +1,15 @@
+from .aggregate import (  # noqa: F401
+    aggregate,
+    join_population,
+    municipality_type,
+)
 from .indices import (  # noqa: F401
-    capital,
-    city,
-    designatedcity,
-    pref,
-    prefmean,
+    DATAFRAME_NAMES,
+    __getattr__,
+    fetch_data,
+    fetch_dataframes,
+    load_all,
+    load_year,
+    query,
+    refetch,
 )
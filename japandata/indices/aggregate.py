@@ -0,0 +1,207 @@
+"""
+indices/aggregate.py
+
+Weighted aggregation of the municipal fiscal indices over groups of municipalities.
+
+`prefmean` is the official mean of each prefecture. Here the indices of `city` are joined to the
+population of each municipality by code and year, and summarized over any grouping, e.g. by
+prefecture, by type of municipality, or by a user-supplied map of regions. Weighted means,
+standard deviations, and quantiles are computed for every group at once from sorted arrays,
+rather than group by group.
+
+The population of a year is that at the end of the calendar year, in the middle of the fiscal
+year of the indices.
+
+Author: Sam Passaglia
+"""
+
+import numpy as np
+import pandas as pd
+
+from japandata.indices.schema import RATES
+
+# municipality types, from the third digit of their code
+MUNICIPALITY_TYPES = {"1": "designated-city", "2": "city", "3": "town-village"}
+STATS = ["mean", "std", "min", "max", "count", "weight"]
+
+
+def municipality_type(codes):
+    """Types of municipalities from their codes: designated cities and their wards, Tokyo's
+    special wards, cities, and towns and villages.
+
+    Args:
+        codes (pd.Series): 5-digit codes
+
+    Returns:
+        pd.Series: types
+    """
+    codes = codes.astype(object)
+    # integer codes, as in the compact layout, lost their leading zero
+    codes = codes.where(codes.isna(), codes.astype(str).str.zfill(5))
+    digit = codes.str[2]
+    types = digit.where(~(digit > "3"), "3").map(MUNICIPALITY_TYPES)
+    return types.mask(codes.str[:3] == "131", "special-ward")
+
+
+def join_population(df=None, years=None, weight="total-pop"):
+    """Joins the municipal indices to the population of each municipality.
+
+    The population of all residents is used from 2013, and that of japanese residents, the only
+    one tabulated, before.
+
+    Args:
+        df (pd.DataFrame, optional): municipal indices. Defaults to `query("city", years)`.
+        years (int or list, optional): years. Defaults to all.
+        weight (str, optional): column of `population.city_pop` joined. Defaults to "total-pop".
+
+    Returns:
+        pd.DataFrame: indices with the weight column, NaN where the population is unknown
+    """
+    from japandata.indices.indices import query as query_indices
+    from japandata.population import query as query_population
+
+    if df is None:
+        df = query_indices("city", years=years)
+    pop = query_population(
+        "city_pop",
+        years=sorted(df["year"].unique().tolist()),
+        nationality=["all", "japanese"],
+        columns=["year", "code", "nationality", weight],
+    )
+    # all residents where tabulated, else japanese residents
+    pop = pop.sort_values("nationality").drop_duplicates(["year", "code"], keep="first")
+    pop = pop.drop(columns="nationality")
+    return df.merge(pop, on=["year", "code"], how="left")
+
+
+def _weighted_quantiles(groups, values, weights, n_groups, quantiles):
+    """Weighted quantiles of the values of every group, the smallest value at which the cumulative
+    weight of the group reaches each quantile of its total weight.
+
+    Args:
+        groups (np.ndarray): group of each value, in range(n_groups)
+        values (np.ndarray): values, NaN ignored
+        weights (np.ndarray): non-negative weights
+        n_groups (int): number of groups
+        quantiles (list): quantiles in [0, 1]
+
+    Returns:
+        np.ndarray: (group, quantile) values, NaN for groups without values
+    """
+    valid = ~np.isnan(values) & (weights > 0)
+    groups, values, weights = groups[valid], values[valid], weights[valid]
+    order = np.lexsort((values, groups))
+    groups, values, weights = groups[order], values[order], weights[order]
+
+    cumulative = np.cumsum(weights)
+    totals = np.bincount(groups, weights=weights, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(totals)[:-1]])
+    ends = np.concatenate([[0], np.cumsum(np.bincount(groups, minlength=n_groups))])
+    result = np.full((n_groups, len(quantiles)), np.nan)
+    if len(values) == 0:
+        return result
+    for j, quantile in enumerate(quantiles):
+        # the first value of each group whose cumulative weight reaches the quantile
+        position = np.searchsorted(cumulative, starts + quantile * totals * (1 - 1e-12))
+        position = np.clip(position, ends[:-1], np.maximum(ends[1:] - 1, 0))
+        result[:, j] = np.where(totals > 0, values[np.minimum(position, len(values) - 1)], np.nan)
+    return result
+
+
+def aggregate(
+    df=None,
+    by="prefecture",
+    columns=None,
+    weight="total-pop",
+    stats=("mean", "count"),
+    quantiles=(),
+    regions=None,
+    years=None,
+):
+    """Summarizes the municipal indices over groups of municipalities, weighted by population.
+
+    Args:
+        df (pd.DataFrame, optional): municipal indices with the weight column, e.g. from
+            `join_population`. Defaults to `join_population(years=years, weight=weight)`.
+        by (str or list, optional): grouping columns besides the year: columns of df,
+            "type" for the type of municipality (see `municipality_type`), or "region" for
+            `regions`. Defaults to "prefecture". An empty list groups the whole country.
+        columns (list, optional): indices summarized. Defaults to those present in df.
+        weight (str, optional): weight column, or None to weigh municipalities equally.
+            Defaults to "total-pop".
+        stats (list, optional): among "mean", "std", "min", "max", "count" (municipalities with
+            a value), and "weight" (their total weight). Defaults to ("mean", "count").
+        quantiles (list, optional): weighted quantiles, e.g. [0.1, 0.5, 0.9], named "q0.5" etc.
+        regions (dict or pd.Series, optional): region of each municipality code, or of each
+            prefecture name, for by="region".
+        years (int or list, optional): years loaded when df is not given. Defaults to all.
+
+    Returns:
+        pd.DataFrame: statistics indexed by year and group, with (index, statistic) columns
+    """
+    if df is None:
+        df = join_population(years=years, weight=weight or "total-pop")
+    by = [by] if isinstance(by, str) else list(by)
+    unknown = [stat for stat in stats if stat not in STATS]
+    if unknown:
+        raise Exception(f"Unknown statistics {unknown}. Expected some of {STATS}")
+    if columns is None:
+        columns = [column for column in RATES if column in df.columns]
+
+    keys = pd.DataFrame({"year": df["year"].to_numpy()}, index=df.index)
+    for key in by:
+        if key == "type":
+            keys[key] = municipality_type(df["code"])
+        elif key == "region":
+            if regions is None:
+                raise Exception("Grouping by region requires a regions mapping")
+            regions = pd.Series(regions)
+            by_code = df["code"].astype(str).map(regions)
+            keys[key] = by_code.fillna(df["prefecture"].map(regions))
+        else:
+            keys[key] = df[key]
+    grouped = keys.notna().all(axis=1).to_numpy()
+    keys = keys.loc[grouped]
+    group_index = pd.MultiIndex.from_frame(keys)
+    codes, uniques = pd.factorize(group_index, sort=True)
+    n_groups = len(uniques)
+
+    if weight is None:
+        weights = np.ones(len(keys))
+    else:
+        weights = df.loc[grouped, weight].to_numpy(dtype=np.float64)
+        weights = np.where(np.isnan(weights), 0, weights)
+
+    result = {}
+    for column in columns:
+        values = df.loc[grouped, column].to_numpy(dtype=np.float64)
+        has_value = ~np.isnan(values) & (weights > 0)
+        w = np.where(has_value, weights, 0)
+        x = np.where(has_value, values, 0)
+        total = np.bincount(codes, weights=w, minlength=n_groups)
+        mean = np.bincount(codes, weights=w * x, minlength=n_groups) / np.where(total, total, 1)
+        mean = np.where(total > 0, mean, np.nan)
+        for stat in stats:
+            if stat == "mean":
+                result[(column, stat)] = mean
+            elif stat == "std":
+                deviation = np.where(has_value, x - mean[codes], 0)
+                variance = np.bincount(codes, weights=w * deviation**2, minlength=n_groups)
+                result[(column, stat)] = np.sqrt(variance / np.where(total, total, 1))
+                result[(column, stat)][total == 0] = np.nan
+            elif stat in ["min", "max"]:
+                reduce = np.fmin if stat == "min" else np.fmax
+                extreme = np.full(n_groups, np.nan)
+                reduce.at(extreme, codes[has_value], values[has_value])
+                result[(column, stat)] = extreme
+            elif stat == "count":
+                result[(column, stat)] = np.bincount(codes[has_value], minlength=n_groups)
+            elif stat == "weight":
+                result[(column, stat)] = total
+        if quantiles:
+            values_q = _weighted_quantiles(codes, values, weights, n_groups, list(quantiles))
+            for j, quantile in enumerate(quantiles):
+                result[(column, f"q{quantile:g}")] = values_q[:, j]
+
+    index = pd.MultiIndex.from_tuples(list(uniques), names=list(keys.columns))
+    return pd.DataFrame(result, index=index)
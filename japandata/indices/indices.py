@@ -7,17 +7,33 @@ Data from https://www.soumu.go.jp/iken/shihyo_ichiran.html
 Author: Sam Passaglia
 """
 
-import os
-import tarfile
+import json
+import shutil
+from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
-from japandata.maps import load_map
-from japandata.utils import japanese_to_western, logger, western_to_japanese
-
-CACHE_FOLDER = Path(Path(__file__).parent, "cache/")
+from japandata.cache import (
+    atomic_path,
+    cache_dir,
+    cache_lock,
+    get_index,
+    source_info,
+    sources_current,
+)
+from japandata.dtypes import compact_dtypes
+from japandata.indices.schema import INDICES_SCHEMA, RATES, SCALES
+from japandata.query import ROW_GROUP_SIZE, as_list, cache_order, read_parquet
+from japandata.utils import (
+    japanese_to_western,
+    lazy_module_attributes,
+    logger,
+    western_to_japanese,
+)
+
+DATAFRAME_NAMES = ["pref", "prefmean", "city", "designatedcity", "capital"]
 
 """
 Data fetching and caching
@@ -31,28 +47,32 @@ def fetch_data():
         Path: cached filepath.
     """
 
-    cached = Path(CACHE_FOLDER, "indices/")
-    archive = Path(CACHE_FOLDER, "indices.tar.gz")
-    if not cached.exists():
-        cached.parent.mkdir(
-            parents=True, exist_ok=True
-        )  # recreate any required subdirectories cityly
-
-        logger.info("Fetching data for japandata.indices")
-
-        from japandata.download import DOWNLOAD_INFO, download_progress
-
-        url = DOWNLOAD_INFO["indices"]["latest"]["url"]
-        download_progress(url, archive)
-
-        with tarfile.open(archive, "r") as tf:
-            tf.extractall(cached.parent)
-        os.remove(archive)
+    cached = Path(cache_dir("indices"), "indices/")
+    index = get_index(cached.parent)
+    if not index.is_valid("indices"):
+        with cache_lock(cached.parent, "indices"):
+            # another process may have fetched it while we waited for the lock
+            if index.is_valid("indices", count=False):
+                return cached
+            cached.parent.mkdir(
+                parents=True, exist_ok=True
+            )  # recreate any required subdirectories cityly
+            if cached.exists():
+                shutil.rmtree(cached)  # unverifiable, e.g. extracted before the cache was indexed
+
+            logger.info("Fetching data for japandata.indices")
+
+            from japandata.download import (
+                extract_progress,
+                get_checksum,
+                get_url,
+            )
+
+            extract_progress(get_url("indices"), cached, sha256=get_checksum("indices"))
+            index.record("indices")
     return cached
 
 
-DATA_FOLDER = fetch_data()
-
 """
 Data Processing
 """
@@ -70,47 +90,11 @@ def load_year(year, scale="prefecture"):
         pd.DataFrame: cleaned data
     """
 
-    extension = ".xls"
-    skiprows = 2
-    if year >= 2016:
-        extension = ".xlsx"
-
-    forced_coltypes = {"code6digit": str, "prefecture": str}
-    cols = []
-    if (year >= 2011) and (scale == "city"):
-        cols += ["code6digit"]
-    cols += ["prefecture"]
-    if scale == "prefecturemean":
-        cols += ["useless"]
-    if scale in ["city", "designatedcity", "capital"]:
-        cols += ["city"]
-    if year <= 2007:
-        cols += [
-            "regular-expense-rate",
-            "debt-service-rate",
-            "debt-restriction-rate",
-            "fiscal-strength-index",
-        ]
-    else:
-        cols += [
-            "fiscal-strength-index",
-            "regular-expense-rate",
-            "debt-service-rate",
-            "future-burden-rate",
-        ]
-    if not ((scale == "prefecturemean") and (year == 2007)):
-        cols += ["laspeyres"]
-    if (year == 2012 or year == 2013) and (scale != "prefecturemean"):
-        cols += ["laspeyres-adjusted"]
-
+    layout = INDICES_SCHEMA.layout(year, scale)
     filelabel = western_to_japanese(year)
 
-    df = pd.read_excel(
-        Path(DATA_FOLDER, scale, filelabel + extension),
-        skiprows=skiprows,
-        header=None,
-        names=cols,
-        dtype=forced_coltypes,
+    df = INDICES_SCHEMA.read(
+        Path(fetch_data(), scale, filelabel + layout["extension"]), year, scale
     )
 
     df["prefecture"] = df["prefecture"].str.strip()
@@ -123,12 +107,6 @@ def load_year(year, scale="prefecture"):
     df.drop(df[df["prefecture"] == "政令指定都市"].index, inplace=True)
     df.drop(df[pd.isna(df["debt-service-rate"])].index, inplace=True)
 
-    if scale == "prefecturemean":
-        df.drop("useless", axis=1, errors="ignore", inplace=True)
-        df.drop("laspeyres", axis=1, errors="ignore", inplace=True)
-
-    df.drop("laspeyres-adjusted", axis=1, errors="ignore", inplace=True)
-
     if scale == "city":
         df.drop(df.loc[pd.isna(df["city"])].index, inplace=True)
         df = df.replace({r"\(": "", r"\)": ""}, regex=True)
@@ -140,16 +118,7 @@ def load_year(year, scale="prefecture"):
     df.replace("-", np.nan, inplace=True)
     df.replace("－", np.nan, inplace=True)
 
-    float_cols = [
-        "future-burden-rate",
-        "laspeyres",
-        "debt-restriction-rate",
-        "regular-expense-rate",
-        "debt-service-rate",
-        "fiscal-strength-index",
-        "laspeyres-adjusted",
-    ]
-    for col in float_cols:
+    for col in RATES:
         if col in df.columns:
             df = df.astype({col: np.float64})
 
@@ -173,112 +142,277 @@ def load_year(year, scale="prefecture"):
     return df
 
 
-def load_all():
-    """Loads all data from the data folder"""
+def source_years():
+    """Fiscal years for which tables are available in DATA_FOLDER.
 
-    files = Path(DATA_FOLDER, "city").glob("*")
-    years = [japanese_to_western(file.name.split(".")[0]) for file in files]
-    years.sort()
+    Returns:
+        list: years
+    """
+    files = Path(fetch_data(), "city").glob("*")
+    return sorted(japanese_to_western(file.name.split(".")[0]) for file in files)
 
-    df_pref_list = []
-    df_prefmean_list = []
-    df_city_list = []
-    df_designatedcity_list = []
-    df_capital_list = []
-    for year in years:
-        df_pref = load_year(year, "prefecture")
-        df_prefmean = load_year(year, "prefecturemean")
-        df_city = load_year(year, "city")
-        df_designatedcity = load_year(year, "designatedcity")
-        df_capital = load_year(year, "capital")
 
+def _year_sources(year):
+    filelabel = western_to_japanese(year)
+    return [
+        Path(scale, filelabel + INDICES_SCHEMA.layout(year, scale)["extension"]) for scale in SCALES
+    ]
+
+
+def _load_tables(tasks, jobs=1):
+    """Loads source tables, optionally in a process pool.
+
+    Args:
+        tasks (list): (year, scale) tuples
+        jobs (int, optional): number of worker processes. 1 runs serially in this process, None
+            uses every core.
+
+    Returns:
+        dict: loaded dataframe for each task
+    """
+    if jobs == 1:
+        dfs = [load_year(*task) for task in tasks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        fetch_data()  # fetch once here rather than racing in every worker
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # map returns results in task order, so merging them below is deterministic
+            dfs = list(executor.map(load_year, *zip(*tasks)))
+    return dict(zip(tasks, dfs))
+
+
+def _build_years(years, jobs=1):
+    """Loads the tables of some years.
+
+    Args:
+        years (list): years
+        jobs (int, optional): number of worker processes parsing the Excel files.
+
+    Returns:
+        dict: for each year, its dataframe for each of DATAFRAME_NAMES
+    """
+    dfs = _load_tables([(year, scale) for year in years for scale in SCALES], jobs=jobs)
+    built = {}
+    for year in years:
+        built[year] = {name: dfs[(year, scale)] for name, scale in zip(DATAFRAME_NAMES, SCALES)}
         # In early years the codes were not listed. Fetch them from the maps.
         if year < 2011:
-            map_df = load_map(year + 2)
-            alt_map_df = load_map(year - 2)
-            df_city["code"] = np.nan
-
-            def findCode(row):
-                pref = row["prefecture"]
-                city = row["city"].replace("ケ", "ヶ")
-                potentialcities = [
-                    city,
-                    city.replace("ケ", "ヶ"),
-                    city.replace("ヶ", "ケ"),
-                    city.replace("桧", "檜"),
-                    city.replace("竜", "龍"),
-                    city.replace("曾", "曽"),
-                ]
-                try:
-                    codefound = map_df.loc[
-                        (
-                            map_df["city"].isin(potentialcities)
-                            | map_df["county"].isin(potentialcities)
-                        )
-                        & (map_df["prefecture"] == pref),
-                        "code",
-                    ].values[0]
-                except IndexError:
-                    codefound = alt_map_df.loc[
-                        (
-                            alt_map_df["city"].isin(potentialcities)
-                            | alt_map_df["county"].isin(potentialcities)
-                        )
-                        & (alt_map_df["prefecture"] == pref),
-                        "code",
-                    ].values[0]
-                return codefound
-
-            df_city["code"] = df_city.apply(findCode, axis=1)
-
-        df_pref_list.append(df_pref)
-        df_prefmean_list.append(df_prefmean)
-        df_city_list.append(df_city)
-        df_designatedcity_list.append(df_designatedcity)
-        df_capital_list.append(df_capital)
-
-    df_pref = pd.concat(df_pref_list, axis=0, join="outer", ignore_index=True)
-    df_prefmean = pd.concat(df_prefmean_list, axis=0, join="outer", ignore_index=True)
-    df_city = pd.concat(df_city_list, axis=0, join="outer", ignore_index=True)
-    df_designatedcity = pd.concat(df_designatedcity_list, axis=0, join="outer", ignore_index=True)
-    df_capital = pd.concat(df_capital_list, axis=0, join="outer", ignore_index=True)
-
-    return (df_pref, df_prefmean, df_city, df_designatedcity, df_capital)
+            from japandata.maps import resolve_codes
+
+            df_city = built[year]["city"]
+            df_city["code"] = resolve_codes(df_city, [year + 2, year - 2])
+    return built
+
+
+def load_all(jobs=1):
+    """Loads all data from the data folder
+
+    Args:
+        jobs (int, optional): number of worker processes parsing the Excel files. 1 parses them
+            serially, None uses every core. The result does not depend on it.
+
+    Returns:
+        tuple: dataframes named in DATAFRAME_NAMES
+    """
+    built = _build_years(source_years(), jobs=jobs)
+    return tuple(
+        pd.concat([dfs[name] for dfs in built.values()], axis=0, join="outer", ignore_index=True)
+        for name in DATAFRAME_NAMES
+    )
 
 
 """
 Loading and caching of the cleaned data
 """
 
+# bump to regenerate every partition after changing how the tables are processed or how the
+# partitions are laid out
+CACHE_VERSION = 2
+MANIFEST_NAME = "build.json"
+
+
+def _partition_key(name, year):
+    return f"partitions/{name}/{year}.parquet"
+
+
+def _read_manifest(cache_folder):
+    try:
+        with open(Path(cache_folder, MANIFEST_NAME)) as fp:
+            manifest = json.load(fp)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+    if manifest.get("version") != CACHE_VERSION:
+        manifest = {"version": CACHE_VERSION, "years": {}}
+    return manifest
+
+
+def _stale_years(years, manifest, index, data_folder, count=True):
+    """Years whose sources or schema changed since their partitions were generated, or whose
+    partitions are missing."""
+    stale = []
+    for year in years:
+        entry = manifest["years"].get(str(year))
+        if (
+            entry is None
+            or entry["schema"] != INDICES_SCHEMA.version
+            or set(entry["sources"]) != {source.as_posix() for source in _year_sources(year)}
+            or not sources_current(entry["sources"], data_folder)
+            or not all(
+                index.is_valid(key, evictable=True, count=count) for key in entry["partitions"]
+            )
+        ):
+            stale.append(year)
+    return stale
+
+
+def _build_partitions(years, manifest, jobs=1):
+    cache_folder = cache_dir("indices")
+    index = get_index(cache_folder)
+    data_folder = fetch_data()
+    logger.info(f"Generating cache partitions of {len(years)} years for japandata.indices")
+
+    # hash before parsing, so that a source changing meanwhile is caught next time
+    sources = {
+        year: {
+            source.as_posix(): source_info(Path(data_folder, source))
+            for source in _year_sources(year)
+        }
+        for year in years
+    }
+    keys = []
+    for year, dfs in _build_years(years, jobs=jobs).items():
+        partitions = []
+        for name, df in dfs.items():
+            key = _partition_key(name, year)
+            Path(cache_folder, key).parent.mkdir(parents=True, exist_ok=True)
+            with atomic_path(Path(cache_folder, key)) as tmp:
+                compact_dtypes(cache_order(df)).to_parquet(
+                    tmp, index=False, row_group_size=ROW_GROUP_SIZE
+                )
+            partitions.append(key)
+        manifest["years"][str(year)] = {
+            "schema": INDICES_SCHEMA.version,
+            "sources": sources[year],
+            "partitions": partitions,
+        }
+        keys += partitions
+    index.record_many(keys, evictable=True)
+
+    with atomic_path(Path(cache_folder, MANIFEST_NAME)) as tmp:
+        with open(tmp, "w") as fp:
+            json.dump(manifest, fp, indent=1)
+
+    # the unpartitioned dataframes cached by earlier versions
+    for key in list(index.entries):
+        if key.endswith(".parquet") and not key.startswith("partitions/"):
+            index.discard(key)
+
+
+def _ensure_partitions(jobs=1):
+    """Generates the missing or outdated cache partitions, so that a newly published year only
+    has its own tables parsed.
+
+    Returns:
+        list: years in output order
+    """
+    cache_folder = cache_dir("indices")
+    index = get_index(cache_folder)
+    data_folder = fetch_data()
+    years = source_years()
+
+    manifest = _read_manifest(cache_folder)
+    if _stale_years(years, manifest, index, data_folder):
+        with cache_lock(cache_folder, "dataframes"):
+            # another process may have generated them while we waited for the lock
+            manifest = _read_manifest(cache_folder)
+            stale = _stale_years(years, manifest, index, data_folder, count=False)
+            if stale:
+                _build_partitions(stale, manifest, jobs=jobs)
+    return years
+
+
+def _partition_paths(name, available, years=None):
+    return [
+        Path(cache_dir("indices"), _partition_key(name, year))
+        for year in available
+        if years is None or year in years
+    ]
+
+
+def fetch_dataframes(jobs=1, compact=False):
+    """Loads the cleaned dataframes, generating and caching them on first use.
+
+    The cache is partitioned by dataframe and year, and a manifest records the hash of the source
+    files of each year. Only the years whose source files were added or changed in DATA_FOLDER,
+    or whose partitions are missing from the cache, are generated again.
+
+    Args:
+        jobs (int, optional): number of worker processes parsing the Excel files when generating
+            partitions. 1 parses them serially, None uses every core.
+        compact (bool, optional): return the dataframes in the compact layout of
+            `japandata.dtypes`, with categorical names and integer codes.
+
+    Returns:
+        tuple: dataframes named in DATAFRAME_NAMES
+    """
+    years = _ensure_partitions(jobs=jobs)
+    return tuple(
+        read_parquet(_partition_paths(name, years), compact=compact) for name in DATAFRAME_NAMES
+    )
+
+
+def query(name, years=None, codes=None, prefectures=None, columns=None, compact=False):
+    """Reads the matching rows and columns of a dataframe, without loading all of it.
+
+    Only the partitions of the requested years are opened, and within them only the requested
+    columns and the row groups which can match the filters are read.
+
+    Args:
+        name (str): dataframe, one of DATAFRAME_NAMES, e.g. "city"
+        years (int or list, optional): years, e.g. range(2015, 2023). Defaults to all.
+        codes (str or list, optional): municipality codes, e.g. "13101". Only "city" has codes.
+        prefectures (str or list, optional): prefecture names, e.g. "東京都".
+        columns (list, optional): columns to return. Defaults to all.
+        compact (bool, optional): return the compact layout of `japandata.dtypes`.
+
+    Returns:
+        pd.DataFrame: matching rows
+    """
+    if name not in DATAFRAME_NAMES:
+        raise Exception(f"Unknown dataframe {name}. Expected one of {DATAFRAME_NAMES}")
+    available = _ensure_partitions()
+    return read_parquet(
+        _partition_paths(name, available, years=as_list(years)),
+        columns=columns,
+        compact=compact,
+        code=codes,
+        prefecture=prefectures,
+    )
+
+
+def refetch(key):
+    """Refetches a cache entry, e.g. after it was found corrupted and discarded.
+
+    Args:
+        key (str): cache entry
+    """
+    if key == "indices":
+        fetch_data()
+    else:
+        fetch_dataframes()
+
+
+@lru_cache(maxsize=None)
+def _load_dataframes():
+    return dict(zip(DATAFRAME_NAMES, fetch_dataframes()))
+
 
-def fetch_dataframes():
-    PREF_CACHE = Path(CACHE_FOLDER, "pref.parquet")
-    PREFMEAN_CACHE = Path(CACHE_FOLDER, "prefmean.parquet")
-    DESIGNATEDCITY_CACHE = Path(CACHE_FOLDER, "designatedcity.parquet")
-    CAPITAL_CACHE = Path(CACHE_FOLDER, "capital.parquet")
-    CITY_CACHE = Path(CACHE_FOLDER, "city.parquet")
-
-    if not (
-        PREF_CACHE.exists()
-        and PREFMEAN_CACHE.exists()
-        and DESIGNATEDCITY_CACHE.exists()
-        and CAPITAL_CACHE.exists()
-        and CITY_CACHE.exists()
-    ):
-        logger.info("Generating cache for japandata.indices")
-        (df_pref, df_prefmean, df_city, df_designatedcity, df_capital) = load_all()
-        df_pref.to_parquet(PREF_CACHE)
-        df_prefmean.to_parquet(PREFMEAN_CACHE)
-        df_city.to_parquet(CITY_CACHE)
-        df_designatedcity.to_parquet(DESIGNATEDCITY_CACHE)
-        df_capital.to_parquet(CAPITAL_CACHE)
-
-    df_pref = pd.read_parquet(PREF_CACHE)
-    df_prefmean = pd.read_parquet(PREFMEAN_CACHE)
-    df_city = pd.read_parquet(CITY_CACHE)
-    df_designatedcity = pd.read_parquet(DESIGNATEDCITY_CACHE)
-    df_capital = pd.read_parquet(CAPITAL_CACHE)
-    return (df_pref, df_prefmean, df_city, df_designatedcity, df_capital)
-
-
-pref, prefmean, city, designatedcity, capital = fetch_dataframes()
+__getattr__ = lazy_module_attributes(
+    __name__,
+    {
+        "DATA_FOLDER": fetch_data,
+        **{name: (lambda name=name: _load_dataframes()[name]) for name in DATAFRAME_NAMES},
+    },
+    dynamic={"CACHE_FOLDER": lambda: cache_dir("indices")},
+)
@@ -0,0 +1,58 @@
+"""
+indices/schema.py
+
+Layouts of the fiscal indices source tables, per year and scale.
+
+Author: Sam Passaglia
+"""
+
+from japandata.schema import Column, Rule, Schema
+
+SCALES = ["prefecture", "prefecturemean", "city", "designatedcity", "capital"]
+CITY_SCALES = ["city", "designatedcity", "capital"]
+RATES = [
+    "regular-expense-rate",
+    "debt-service-rate",
+    "debt-restriction-rate",
+    "fiscal-strength-index",
+    "future-burden-rate",
+    "laspeyres",
+    "laspeyres-adjusted",
+]
+
+# The rates are left to inference, as the city tables hold text such as "(12.3)" or "-", which
+# the loader cleans before casting them to float.
+INDICES_SCHEMA = Schema(
+    "indices",
+    version=1,
+    columns=[
+        Column("code6digit", "str", years=(2011, None), levels=["city"]),
+        Column("prefecture", "str"),
+        Column("useless", keep=False, levels=["prefecturemean"]),
+        Column("city", "str", levels=CITY_SCALES),
+        Column("regular-expense-rate", years=(None, 2007)),
+        Column("debt-service-rate", years=(None, 2007)),
+        Column("debt-restriction-rate", years=(None, 2007)),
+        Column("fiscal-strength-index", years=(None, 2007)),
+        Column("fiscal-strength-index", years=(2008, None)),
+        Column("regular-expense-rate", years=(2008, None)),
+        Column("debt-service-rate", years=(2008, None)),
+        Column("future-burden-rate", years=(2008, None)),
+        Column("laspeyres", levels=[scale for scale in SCALES if scale != "prefecturemean"]),
+        Column("laspeyres", keep=False, years=(None, 2006), levels=["prefecturemean"]),
+        Column("laspeyres", keep=False, years=(2008, None), levels=["prefecturemean"]),
+        Column(
+            "laspeyres-adjusted",
+            keep=False,
+            years=(2012, 2013),
+            levels=[scale for scale in SCALES if scale != "prefecturemean"],
+        ),
+    ],
+    settings={
+        "skiprows": [Rule(2)],
+        "extension": [Rule(".xls"), Rule(".xlsx", years=(2016, None))],
+    },
+    # files are named by Heisei and Reiwa years
+    years=(1989, 2067),
+    levels=SCALES,
+)
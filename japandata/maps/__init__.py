@@ -1,6 +1,23 @@
+from .crosswalk import (  # noqa: F401
+    aggregation_matrix,
+    build_crosswalk,
+    load_code_history,
+    load_succession,
+    reaggregate,
+)
+from .locate import locate, locate_file  # noqa: F401
 from .maps import (  # noqa: F401
-    AVAILABLE_DATES,
-    AVAILABLE_MAPS,
+    QUALITY_ALIASES,
+    __getattr__,
     add_df_to_map,
+    clear_map_cache,
+    load_attributes,
+    load_manifest,
     load_map,
+    map_cache_stats,
+    prefetch,
+    refetch,
+    resolve_map_date,
+    set_map_cache,
 )
+from .names import name_index, normalize_names, resolve_codes  # noqa: F401
@@ -0,0 +1,391 @@
+"""
+maps/crosswalk.py
+
+Succession of municipality codes through mergers, and re-aggregation of code-keyed tables to the
+boundaries in effect at a given date.
+
+The succession is inferred from consecutive map vintages: a code which disappears from one vintage
+to the next is succeeded by the municipalities of the next vintage which cover its territory, in
+proportion to the area of it they cover. Chaining the successions gives, for every code which ever
+existed, its share in each municipality of a target date, collected in a sparse aggregation matrix
+so that a whole panel of tables is re-aggregated in one sparse product.
+
+Author: Sam Passaglia
+"""
+
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from japandata.cache import (
+    atomic_path,
+    cache_dir,
+    cache_lock,
+    get_index,
+    parquet_is_readable,
+)
+from japandata.maps.maps import (
+    load_manifest,
+    load_map,
+    prefetch,
+    resolve_map_date,
+)
+from japandata.utils import logger
+
+# first year covered by default, before the Heisei mergers and the population tables
+CROSSWALK_START = 1990
+# overlaps below this share of a municipality's area are simplification noise of the maps
+MIN_SHARE = 0.01
+
+
+"""
+Building the succession from the map vintages
+"""
+
+
+def _vintage(map_date, scale, quality):
+    """Municipalities of a map vintage, in meters coordinates."""
+    from shapely.validation import make_valid
+
+    map_df = load_map(map_date, scale, quality)
+    map_df = map_df.loc[map_df["code"].notna() & ~map_df["geometry"].is_empty]
+    map_df = map_df[["code", "prefecture", "city", "geometry"]].to_crs("EPSG:30166")
+    map_df["geometry"] = map_df["geometry"].apply(make_valid)
+    return map_df.reset_index(drop=True)
+
+
+def _successions(before, after, date):
+    """Successors of the codes of `before` absent from `after`, weighted by area.
+
+    Args:
+        before (GeoDataFrame): municipalities of a vintage
+        after (GeoDataFrame): municipalities of the next vintage
+        date (str): date of the next vintage, from which the succession is effective
+
+    Returns:
+        pd.DataFrame: successions
+    """
+    import geopandas as gpd
+
+    gone = before.loc[~before["code"].isin(after["code"])]
+    if gone.empty:
+        return None
+
+    overlap = gpd.overlay(
+        gone.rename(columns={"code": "predecessor", "city": "predecessor_city"}),
+        after[["code", "city", "geometry"]].rename(
+            columns={"code": "successor", "city": "successor_city"}
+        ),
+        how="intersection",
+        keep_geom_type=True,
+    )
+    overlap["weight"] = overlap.area
+    successions = (
+        overlap.groupby(
+            ["prefecture", "predecessor", "predecessor_city", "successor", "successor_city"],
+            dropna=False,
+        )["weight"]
+        .sum()
+        .reset_index()
+    )
+    successions["weight"] /= successions.groupby("predecessor")["weight"].transform("sum")
+    successions = successions.loc[successions["weight"] >= MIN_SHARE].copy()
+    successions["weight"] /= successions.groupby("predecessor")["weight"].transform("sum")
+
+    orphans = set(gone["code"]) - set(successions["predecessor"])
+    if orphans:
+        logger.warning(f"No successor found on {date} for codes {sorted(orphans)}")
+    successions.insert(0, "date", pd.Timestamp(date))
+    return successions
+
+
+def build_crosswalk(start=CROSSWALK_START, end=None, scale="jp_city_dc", quality="coarse"):
+    """Builds the succession of codes and their validity from the map vintages.
+
+    Args:
+        start (datetime64, str, or int, optional): first date or year. Defaults to CROSSWALK_START.
+        end (datetime64, str, or int, optional): last date or year. Defaults to the last map.
+        scale (str, optional): "jp_city_dc", in which designated cities are split into wards, or
+            "jp_city", in which they are whole. Defaults to "jp_city_dc".
+        quality (str, optional): quality of the maps compared. Defaults to "coarse".
+
+    Returns:
+        tuple: (successions, codes) dataframes, see `load_succession` and `load_code_history`
+    """
+    # fetched concurrently before being read in order
+    files = prefetch(start, end, scales=[scale], qualities=[quality])
+    map_dates = sorted({file.parent.name for file in files})
+    map_dates = [f"{date[:4]}-{date[4:6]}-{date[6:]}" for date in map_dates]
+    if not map_dates:
+        raise Exception(f"No {scale} map between {start} and {end}")
+
+    successions = []
+    first_seen, last_seen, names = {}, {}, {}
+    before = None
+    for map_date in map_dates:
+        after = _vintage(map_date, scale, quality)
+        if before is not None:
+            successions.append(_successions(before, after, map_date))
+        for code, prefecture, city in after[["code", "prefecture", "city"]].itertuples(index=False):
+            first_seen.setdefault(code, map_date)
+            last_seen[code] = map_date
+            names[code] = (prefecture, city)
+        before = after
+    logger.info(f"Compared {len(map_dates)} {scale} maps from {map_dates[0]} to {map_dates[-1]}")
+
+    successions = [df for df in successions if df is not None]
+    successions = (
+        pd.concat(successions, ignore_index=True)
+        if successions
+        else pd.DataFrame(
+            columns=[
+                "date",
+                "prefecture",
+                "predecessor",
+                "predecessor_city",
+                "successor",
+                "successor_city",
+                "weight",
+            ]
+        )
+    )
+
+    # valid until the first vintage without the code, NaT if it still exists
+    next_date = dict(zip(map_dates, map_dates[1:] + [None]))
+    codes = pd.DataFrame(
+        {
+            "code": list(first_seen),
+            "prefecture": [names[code][0] for code in first_seen],
+            "city": [names[code][1] for code in first_seen],
+            "valid_from": pd.to_datetime([first_seen[code] for code in first_seen]),
+            "valid_until": pd.to_datetime([next_date[last_seen[code]] for code in first_seen]),
+        }
+    )
+    return successions, codes.sort_values("code", ignore_index=True)
+
+
+"""
+Loading and caching
+"""
+
+
+def _crosswalk_paths(start, end, scale, quality):
+    """Generates the cached crosswalk if needed.
+
+    Returns:
+        tuple: cached (successions, codes) parquet files
+    """
+    from japandata.maps.maps import QUALITY_ALIASES, parse_date
+
+    quality = QUALITY_ALIASES.get(quality, quality)
+    # named after the maps compared, so that new vintages make a new crosswalk
+    _, available_dates = load_manifest()
+    first = resolve_map_date(np.datetime64(f"{start}-01-01") if isinstance(start, int) else start)
+    last = str(available_dates[-1]) if end is None else resolve_map_date(parse_date(end))
+    name = f"crosswalk/{scale}.{quality}.{first.replace('-', '')}-{last.replace('-', '')}"
+    keys = [f"{name}.successions.parquet", f"{name}.codes.parquet"]
+
+    cache_folder = cache_dir("maps")
+    index = get_index(cache_folder)
+    if not all(index.is_valid(key, adopt=parquet_is_readable, evictable=True) for key in keys):
+        with cache_lock(cache_folder, name):
+            # another process may have built it while we waited for the lock
+            if not all(index.is_valid(key, count=False) for key in keys):
+                logger.info(f"Building the {scale} crosswalk from {first} to {last}")
+                dfs = build_crosswalk(first, last, scale, quality)
+                Path(cache_folder, name).parent.mkdir(parents=True, exist_ok=True)
+                for df, key in zip(dfs, keys):
+                    with atomic_path(Path(cache_folder, key)) as tmp:
+                        df.to_parquet(tmp, index=False)
+                index.record_many(keys, evictable=True)
+    return tuple(Path(cache_folder, key) for key in keys)
+
+
+def load_succession(start=CROSSWALK_START, end=None, scale="jp_city_dc", quality="coarse"):
+    """Loads the succession of municipality codes, building and caching it on first use.
+
+    Each row gives a code which disappeared on a date and one of its successors, with the share of
+    its area which the successor took over. A code absorbed whole into another has one successor
+    of weight 1.
+
+    Args:
+        start (datetime64, str, or int, optional): first date or year. Defaults to CROSSWALK_START.
+        end (datetime64, str, or int, optional): last date or year. Defaults to the last map.
+        scale (str, optional): "jp_city_dc" (designated cities split into wards) or "jp_city".
+        quality (str, optional): quality of the maps compared. Defaults to "coarse".
+
+    Returns:
+        pd.DataFrame: date, prefecture, predecessor, predecessor_city, successor, successor_city,
+            weight
+    """
+    return pd.read_parquet(_crosswalk_paths(start, end, scale, quality)[0])
+
+
+def load_code_history(start=CROSSWALK_START, end=None, scale="jp_city_dc", quality="coarse"):
+    """Loads the validity of municipality codes, building and caching it on first use.
+
+    Args:
+        start (datetime64, str, or int, optional): first date or year. Defaults to CROSSWALK_START.
+        end (datetime64, str, or int, optional): last date or year. Defaults to the last map.
+        scale (str, optional): "jp_city_dc" (designated cities split into wards) or "jp_city".
+        quality (str, optional): quality of the maps compared. Defaults to "coarse".
+
+    Returns:
+        pd.DataFrame: code, latest prefecture and city names, valid_from (first map with the code),
+            and valid_until (first map without it, NaT if it still exists)
+    """
+    return pd.read_parquet(_crosswalk_paths(start, end, scale, quality)[1])
+
+
+"""
+Re-aggregation
+"""
+
+
+@lru_cache(maxsize=8)
+def aggregation_matrix(date=None, start=CROSSWALK_START, scale="jp_city_dc", quality="coarse"):
+    """Sparse matrix taking every code since `start` to the municipalities in effect at `date`.
+
+    Row i gives the shares of code i in each target municipality, chaining its successions up to
+    `date`. Codes created after `date` have no row.
+
+    Args:
+        date (datetime64, str, or int, optional): target date or year. Defaults to the last map.
+        start (datetime64, str, or int, optional): first date or year. Defaults to CROSSWALK_START.
+        scale (str, optional): "jp_city_dc" (designated cities split into wards) or "jp_city".
+        quality (str, optional): quality of the maps compared. Defaults to "coarse".
+
+    Returns:
+        tuple: (scipy.sparse.csr_matrix, codes of its rows, codes of its columns)
+    """
+    import scipy.sparse
+
+    successions = load_succession(start, None, scale, quality)
+    history = load_code_history(start, None, scale, quality)
+    target_date = pd.Timestamp(resolve_map_date(date if date is not None else "9999"))
+
+    current = (history["valid_from"] <= target_date) & ~(history["valid_until"] <= target_date)
+    targets = history.loc[current, "code"].to_numpy()
+    rows = {code: {column: 1.0} for column, code in enumerate(targets)}
+
+    # latest successions first, so that the successors' rows are already chained
+    successions = successions.loc[successions["date"] <= target_date]
+    for _, changes in sorted(successions.groupby("date"), key=lambda item: item[0], reverse=True):
+        for predecessor, successors in changes.groupby("predecessor"):
+            if predecessor in rows:
+                # a code which disappeared and later came back, kept as at the target date
+                continue
+            row = {}
+            for successor, weight in successors[["successor", "weight"]].itertuples(index=False):
+                for column, share in rows.get(successor, {}).items():
+                    row[column] = row.get(column, 0) + weight * share
+            rows[predecessor] = row
+
+    codes = np.array(sorted(rows))
+    entries = [
+        (i, column, share) for i, code in enumerate(codes) for column, share in rows[code].items()
+    ]
+    i, j, shares = zip(*entries) if entries else ((), (), ())
+    matrix = scipy.sparse.csr_matrix((shares, (i, j)), shape=(len(codes), len(targets)))
+    return matrix, codes, targets
+
+
+def reaggregate(
+    df,
+    date=None,
+    columns=None,
+    code_column="code",
+    year_column="year",
+    by=None,
+    start=CROSSWALK_START,
+    scale="jp_city_dc",
+    quality="coarse",
+):
+    """Re-aggregates a code-keyed table to the municipalities in effect at a date.
+
+    The values of every code are summed into the target municipalities which succeeded it, split
+    in proportion to area where a code was divided. This suits counts such as populations, not
+    ratios or per-capita values. The whole table is converted in one sparse product.
+
+    Args:
+        df (pd.DataFrame): table keyed by code and year, e.g. population.city_pop
+        date (datetime64, str, or int, optional): target date or year. Defaults to the last map.
+        columns (list, optional): columns to aggregate. Defaults to the numeric columns.
+        code_column (str, optional): column of municipality codes. Defaults to "code".
+        year_column (str, optional): column of years, or None if the table has none.
+        by (list, optional): other columns keying the rows of a code in a year, aggregated
+            separately and kept in the output, e.g. ["nationality"] for city_pop or ["gender",
+            "nationality"] for city_age.
+        start (datetime64, str, or int, optional): first date of the crosswalk.
+        scale (str, optional): "jp_city_dc" for tables with designated-city wards, "jp_city" for
+            tables with whole designated cities. Defaults to "jp_city_dc".
+        quality (str, optional): quality of the maps compared. Defaults to "coarse".
+
+    Returns:
+        pd.DataFrame: year, the `by` columns, code, prefecture, city, and the aggregated columns,
+            one row per year, `by` key, and target municipality
+    """
+    import scipy.sparse
+
+    by = [] if by is None else list(by)
+    keys = ([year_column] if year_column is not None else []) + by
+    if columns is None:
+        columns = [
+            column
+            for column in df.select_dtypes("number").columns
+            if column not in [code_column] + keys
+        ]
+    matrix, codes, targets = aggregation_matrix(date, start, scale, quality)
+
+    df_codes = df[code_column]
+    if pd.api.types.is_numeric_dtype(df_codes.dtype):
+        df_codes = df_codes.astype("Int64").astype(str).str.zfill(5)
+    code_index = pd.Index(codes).get_indexer(df_codes.astype(str))
+    known = code_index >= 0
+    if not known.all():
+        unknown = pd.unique(df_codes[~known].dropna().astype(str))
+        logger.warning(
+            f"Dropped {(~known).sum()} rows of {len(unknown)} codes absent from the {scale} maps,"
+            f" e.g. {list(unknown[:5])}"
+        )
+
+    # rows repeating a code under the same keys would be summed together
+    repeated = df.loc[known, [code_column] + keys]
+    repeated = repeated.loc[repeated.duplicated(keep=False)]
+    if not repeated.empty:
+        raise Exception(
+            f"{len(repeated)} rows repeat a ({', '.join([code_column] + keys)}), e.g."
+            f" ({', '.join(map(str, repeated.iloc[0]))}). Pass the other columns keying the rows as `by`."
+        )
+
+    if keys:
+        group_index = df.groupby(keys, sort=True, dropna=False).ngroup().to_numpy()
+        groups = df[keys].iloc[np.unique(group_index, return_index=True)[1]]
+        groups = groups.reset_index(drop=True)
+    else:
+        group_index, groups = np.zeros(len(df), dtype=int), pd.DataFrame(index=[0])
+
+    # (group x target) rows gathering the shares of each input row
+    shares = matrix[code_index[known]].tocoo()
+    input_rows = np.flatnonzero(known)[shares.row]
+    gather = scipy.sparse.csr_matrix(
+        (shares.data, (group_index[input_rows] * len(targets) + shares.col, input_rows)),
+        shape=(len(groups) * len(targets), len(df)),
+    )
+
+    values = df[columns].to_numpy(dtype=np.float64)
+    missing = np.isnan(values)
+    aggregated = gather @ np.where(missing, 0, values)
+    # an aggregate with a missing part is missing
+    aggregated[(gather @ missing.astype(np.float64)) > 0] = np.nan
+
+    covered = np.flatnonzero(gather.getnnz(axis=1))
+    history = load_code_history(start, None, scale, quality).set_index("code")
+    out = groups.iloc[covered // len(targets)].reset_index(drop=True)
+    out["code"] = targets[covered % len(targets)]
+    out["prefecture"] = history["prefecture"].reindex(out["code"]).to_numpy()
+    out["city"] = history["city"].reindex(out["code"]).to_numpy()
+    out[columns] = aggregated[covered]
+    return out
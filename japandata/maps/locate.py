@@ -0,0 +1,158 @@
+"""
+maps/locate.py
+
+Reverse geocoding of points to the municipalities containing them.
+
+The municipalities of a map vintage are indexed once in an STRtree of prepared geometries, kept for
+later calls, and points are located in batches by one vectorized query of the tree, so that
+millions of points take seconds. Files too large for memory are located chunk by chunk.
+
+Author: Sam Passaglia
+"""
+
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from japandata.maps.maps import QUALITY_ALIASES, load_map, resolve_map_date
+from japandata.utils import logger
+
+# points located per tree query, bounding the memory of the query results
+BATCH_SIZE = 1_000_000
+
+
+def _build_tree(map_df):
+    import shapely
+
+    map_df = map_df.loc[map_df["code"].notna() & ~map_df["geometry"].is_empty]
+    geometries = np.asarray(map_df.geometry.values)
+    shapely.prepare(geometries)
+    return shapely.STRtree(geometries), map_df["code"].to_numpy(dtype=object)
+
+
+@lru_cache(maxsize=8)
+def _tree(map_date, scale, quality):
+    logger.debug(f"Indexing the municipalities of {map_date} {scale}")
+    return _build_tree(load_map(map_date, scale, quality))
+
+
+def locate(
+    lats,
+    lons,
+    date=2022,
+    scale="jp_city_dc",
+    quality="coarse",
+    map_df=None,
+    batch_size=BATCH_SIZE,
+):
+    """Finds the municipality containing each point.
+
+    Args:
+        lats (array): latitudes, in degrees
+        lons (array): longitudes, in degrees
+        date (datetime64, str, or int, optional): date of the map. Defaults to 2022.
+        scale (str, optional): map scale, e.g. "jp_city" for whole designated cities. Defaults to
+            "jp_city_dc".
+        quality (str, optional): map quality. Finer maps place points near borders more exactly.
+            Defaults to "coarse".
+        map_df (GeoDataFrame, optional): map with a code column in which to locate the points
+            instead, indexed anew on each call.
+        batch_size (int, optional): points per tree query.
+
+    Returns:
+        np.ndarray: code of each point, None for points outside every municipality. A point on a
+            border is given one of the municipalities it touches.
+    """
+    import shapely
+
+    if map_df is None:
+        quality = QUALITY_ALIASES.get(quality, quality)
+        tree, codes = _tree(resolve_map_date(date), scale, quality)
+    else:
+        tree, codes = _build_tree(map_df)
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if lats.shape != lons.shape:
+        raise Exception(f"lats and lons have different shapes {lats.shape} and {lons.shape}")
+
+    found = np.full(lats.size, None, dtype=object)
+    for start in range(0, lats.size, batch_size):
+        points = shapely.points(
+            lons.ravel()[start : start + batch_size], lats.ravel()[start : start + batch_size]
+        )
+        point_index, geometry_index = tree.query(points, predicate="intersects")
+        # the first municipality of each point, for points on a border
+        first = np.unique(point_index, return_index=True)[1]
+        found[start + point_index[first]] = codes[geometry_index[first]]
+    return found.reshape(lats.shape)
+
+
+def _read_chunks(source, chunk_size):
+    """Chunks of a CSV or Parquet file as dataframes."""
+    source = Path(source)
+    if source.suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        import pandas as pd
+
+        yield from pd.read_csv(source, chunksize=chunk_size)
+
+
+def locate_file(
+    source,
+    destination,
+    lat_column="lat",
+    lon_column="lon",
+    code_column="code",
+    date=2022,
+    scale="jp_city_dc",
+    quality="coarse",
+    chunk_size=BATCH_SIZE,
+):
+    """Locates the points of a CSV or Parquet file chunk by chunk, for files larger than memory.
+
+    Args:
+        source (Path): .csv or .parquet file of points
+        destination (Path): .csv or .parquet file written, the source with a code column
+        lat_column (str, optional): latitude column. Defaults to "lat".
+        lon_column (str, optional): longitude column. Defaults to "lon".
+        code_column (str, optional): code column added. Defaults to "code".
+        date (datetime64, str, or int, optional): date of the map, see `locate`.
+        scale (str, optional): map scale, see `locate`.
+        quality (str, optional): map quality, see `locate`.
+        chunk_size (int, optional): rows read at a time.
+
+    Returns:
+        int: number of points located
+    """
+    destination = Path(destination)
+    writer = None
+    rows = 0
+    try:
+        for chunk in _read_chunks(source, chunk_size):
+            codes = locate(
+                chunk[lat_column], chunk[lon_column], date, scale, quality, batch_size=chunk_size
+            )
+            if destination.suffix == ".parquet":
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                # typed explicitly, as a chunk may have no located point
+                table = table.append_column(code_column, pa.array(codes, type=pa.string()))
+                if writer is None:
+                    writer = pq.ParquetWriter(destination, table.schema)
+                writer.write_table(table.cast(writer.schema))
+            else:
+                chunk[code_column] = codes
+                chunk.to_csv(destination, mode="a" if rows else "w", header=not rows, index=False)
+            rows += len(chunk)
+            logger.debug(f"Located {rows} points of {source}")
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
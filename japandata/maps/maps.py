@@ -7,16 +7,26 @@ Maps from https://geoshape.ex.nii.ac.jp/city/choropleth/
 Author: Sam Passaglia
 """
 
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 
-from japandata.utils import load_dict, logger
-
-CACHE_FOLDER = Path(Path(__file__).parent, "cache/")
-
+from japandata.cache import (
+    _parse_size,
+    atomic_path,
+    cache_dir,
+    cache_lock,
+    get_index,
+    json_is_readable,
+)
+from japandata.query import as_list, filter_expression
+from japandata.utils import lazy_module_attributes, load_dict, logger
 
 """
 File fetching and caching
@@ -33,19 +43,39 @@ def fetch_file(fname):
         Path: cached filepath.
     """
 
-    cached = Path(CACHE_FOLDER, fname)
-    if not cached.exists():
-        cached.parent.mkdir(
-            parents=True, exist_ok=True
-        )  # recreate any required subdirectories locally
-        logger.info(f"Fetching {fname} for japandata.maps")
-        from japandata.download import DOWNLOAD_INFO, download_progress
-
-        url = DOWNLOAD_INFO["maps"]["latest"]["url"] + fname
-        download_progress(url, cached)
+    cache_folder = cache_dir("maps")
+    cached = Path(cache_folder, fname)
+    index = get_index(cache_folder)
+    # map files can be refetched at any time, unlike the manifest which every load needs
+    evictable = fname != "manifest.json"
+    if not index.is_valid(fname, adopt=json_is_readable, evictable=evictable):
+        with cache_lock(cache_folder, fname):
+            # another process may have fetched it while we waited for the lock
+            if index.is_valid(fname, adopt=json_is_readable, evictable=evictable, count=False):
+                return cached
+            cached.parent.mkdir(
+                parents=True, exist_ok=True
+            )  # recreate any required subdirectories locally
+            logger.info(f"Fetching {fname} for japandata.maps")
+            from japandata.download import download_progress, get_url
+
+            url = get_url("maps") + fname
+            download_progress(url, cached)
+            index.record(fname, evictable=evictable)
     return cached
 
 
+def refetch(key):
+    """Refetches a cache entry, e.g. after it was found corrupted and discarded.
+
+    Args:
+        key (str): cache entry
+    """
+    # the cleaned maps, attribute tables, and crosswalk are regenerated when next loaded
+    if not key.startswith(("cleaned/", "attributes/", "crosswalk/")):
+        fetch_file(key)
+
+
 def fetch_manifest():
     """Fetches and caches the map manifest file.
 
@@ -57,19 +87,17 @@ def fetch_manifest():
     return fetch_file("manifest.json")
 
 
-def fetch_map(map_date, scale, quality):
-    """Fetches and caches maps of japan at a given scale and quality.
-    Does NOT check if map exists in manifest.
+def map_filename(map_date, scale, quality):
+    """Name of a map file, relative to the cache and to the remote maps folder.
 
     Args:
-        map_date (datetime64 or str): exact date to fetch
-        scale (str): scale of map to fetch
-        quality (str): quality of map to fetch
+        map_date (str): exact date of the map
+        scale (str): scale of the map
+        quality (str): quality of the map
 
     Returns:
-        Path: cached map filepath
+        str: filename
     """
-
     if quality == "s":
         extension = ".json"
     else:
@@ -81,9 +109,99 @@ def fetch_map(map_date, scale, quality):
         }
         extension = extension_dict[scale]
 
-    fname = map_date.replace("-", "") + "/" + scale + "." + quality + extension
+    return map_date.replace("-", "") + "/" + scale + "." + quality + extension
 
-    return fetch_file(fname)
+
+def fetch_map(map_date, scale, quality):
+    """Fetches and caches maps of japan at a given scale and quality.
+    Does NOT check if map exists in manifest.
+
+    Args:
+        map_date (datetime64 or str): exact date to fetch
+        scale (str): scale of map to fetch
+        quality (str): quality of map to fetch
+
+    Returns:
+        Path: cached map filepath
+    """
+
+    return fetch_file(map_filename(map_date, scale, quality))
+
+
+def prefetch(start=None, end=None, scales=None, qualities=None, jobs=8):
+    """Downloads the map files in effect between two dates, concurrently.
+
+    Files already in the cache are skipped and interrupted downloads are resumed, so an interrupted
+    prefetch can simply be rerun.
+
+    Args:
+        start (datetime64, str, or int, optional): first date or year. Defaults to the first map.
+        end (datetime64, str, or int, optional): last date or year. Defaults to the last map.
+        scales (list, optional): scales to fetch. Defaults to all.
+        qualities (list, optional): qualities to fetch, short or longhand. Defaults to all.
+        jobs (int, optional): number of concurrent downloads. Defaults to 8.
+
+    Returns:
+        list: cached filepaths of the selected maps
+    """
+    from japandata.download import download_many, get_url
+
+    available_maps, available_dates = load_manifest()
+
+    map_dates = [str(date) for date in available_dates]
+    if start is not None:
+        # a bare start year means the beginning of that year
+        try:
+            start = np.datetime64(start)
+        except ValueError:
+            start = np.datetime64(str(start) + "-01-01")
+        # the map in effect at the start, or the first map if the start precedes them all
+        in_effect = [map_date for map_date in map_dates if np.datetime64(map_date) <= start]
+        first = in_effect[-1] if in_effect else map_dates[0]
+        map_dates = [map_date for map_date in map_dates if map_date >= first]
+    if end is not None:
+        last = parse_date(end)
+        map_dates = [map_date for map_date in map_dates if np.datetime64(map_date) <= last]
+    if qualities is not None:
+        qualities = [QUALITY_ALIASES.get(quality, quality) for quality in qualities]
+
+    fnames = [
+        map_filename(map_date, scale, quality)
+        for map_date in map_dates
+        for scale in available_maps[map_date]
+        if scales is None or scale in scales
+        for quality in available_maps[map_date][scale]
+        if qualities is None or quality in qualities
+    ]
+
+    cache_folder = cache_dir("maps")
+    index = get_index(cache_folder)
+    missing = [
+        fname
+        for fname in fnames
+        if not index.is_valid(fname, adopt=json_is_readable, evictable=True)
+    ]
+    logger.info(
+        f"Prefetching {len(missing)} of {len(fnames)} selected map files for japandata.maps"
+    )
+    if missing:
+        url = get_url("maps")
+        for fname in missing:
+            cached = Path(cache_folder, fname)
+            cached.parent.mkdir(parents=True, exist_ok=True)
+            # corrupted, since complete files downloaded by other processes are adopted above
+            cached.unlink(missing_ok=True)
+        download_many(
+            [(url + fname, Path(cache_folder, fname)) for fname in missing],
+            jobs=jobs,
+            desc="japandata.maps",
+            lock=lambda cached: cache_lock(
+                cache_folder, cached.relative_to(cache_folder).as_posix()
+            ),
+        )
+        index.record_many(missing, evictable=True)
+
+    return [Path(cache_folder, fname) for fname in fnames]
 
 
 """
@@ -271,16 +389,83 @@ Map Loading Functions
 """
 
 
-manifest_file = fetch_manifest()
-AVAILABLE_MAPS = load_dict(manifest_file)
-AVAILABLE_DATES = [np.datetime64(date) for date in list(AVAILABLE_MAPS.keys())]
+@lru_cache(maxsize=None)
+def load_manifest():
+    """Loads the map manifest, fetching it on first use.
+
+    Returns:
+        tuple: (dict of available scales and qualities keyed by map date, list of map dates)
+    """
+    available_maps = load_dict(fetch_manifest())
+    available_dates = [np.datetime64(date) for date in list(available_maps.keys())]
+    return available_maps, available_dates
+
+
+__getattr__ = lazy_module_attributes(
+    __name__,
+    {
+        "AVAILABLE_MAPS": lambda: load_manifest()[0],
+        "AVAILABLE_DATES": lambda: load_manifest()[1],
+    },
+    dynamic={"CACHE_FOLDER": lambda: cache_dir("maps")},
+)
+
+
+# longhand quality arguments
+QUALITY_ALIASES = {
+    "stylized": "s",
+    "coarse": "c",
+    "low": "l",
+    "medium": "i",
+    "high": "h",
+}
+
+
+def parse_date(date):
+    """Parses a date or a year. A bare year, as an int or a string of digits, means the end of
+    that year.
+
+    Args:
+        date (datetime64, str, or int): date or year
+
+    Returns:
+        datetime64: date
+    """
+    # numpy would read a year string as the first day of that year
+    if isinstance(date, str) and date.strip().isdigit():
+        date = int(date)
+    try:
+        return np.datetime64(date)
+    except ValueError:
+        return np.datetime64(str(date) + "-12-31")
+
+
+def resolve_map_date(date):
+    """Finds the date of the map in effect at a given date.
+
+    Args:
+        date (datetime64, str, or int): date or year
+
+    Returns:
+        str: map date, a key of AVAILABLE_MAPS
+    """
+    _, available_dates = load_manifest()
+    date = parse_date(date)
+    try:
+        return str(np.array(available_dates)[np.where(date >= np.array(available_dates))][-1])
+    except IndexError as e:
+        raise Exception(f"date must be >= than {str(np.min(available_dates))}") from e
 
 
-def load_and_clean_map_file(map_file):
+def load_and_clean_map_file(map_file, geometry=True):
     # cleaning the map files
 
-    map_df = gpd.read_file(map_file)
-    map_df.crs = "EPSG:6668"
+    if geometry:
+        map_df = gpd.read_file(map_file)
+        map_df.crs = "EPSG:6668"
+    else:
+        # the attribute table alone, without decoding the geometries
+        map_df = gpd.read_file(map_file, ignore_geometry=True)
 
     # column headers are explained at https://nlftp.mlit.go.jp/ksj/gml/datalist/KsjTmplt-N03-v2_2.html
     map_df.rename(
@@ -321,42 +506,249 @@ def load_and_clean_map_file(map_file):
     return map_df
 
 
-def load_map(date=2022, scale="jp_city_dc", quality="coarse"):
+"""
+In-memory cache of loaded maps
+"""
+
+# bump to regenerate the cleaned maps cached as GeoParquet after changing how maps are cleaned,
+# derived, or written
+CLEANED_VERSION = 2
+# municipalities per row group of the cached maps: a few per prefecture, so that a filtered load
+# skips the row groups of the other prefectures
+MAP_ROW_GROUP_SIZE = 64
+# default bounds, overridden by set_map_cache or the environment variables
+MAP_CACHE_ENTRIES = 32
+MAP_CACHE_ENTRIES_ENV = "JAPANDATA_MAP_CACHE_ENTRIES"
+MAP_CACHE_BYTES_ENV = "JAPANDATA_MAP_CACHE_MAX_BYTES"
+
+_map_cache = OrderedDict()
+_map_cache_lock = threading.Lock()
+_map_cache_limits = {}
+_map_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def set_map_cache(max_entries=None, max_bytes=None):
+    """Bounds the in-memory cache of loaded maps, evicting the least recently used to meet it.
+
+    Args:
+        max_entries (int, optional): maps kept. 0 disables the cache. Defaults to the
+            JAPANDATA_MAP_CACHE_ENTRIES environment variable, else MAP_CACHE_ENTRIES.
+        max_bytes (int or str, optional): estimated size of the maps kept, in bytes or with a
+            K/M/G suffix, e.g. "2G". Defaults to JAPANDATA_MAP_CACHE_MAX_BYTES, else unbounded.
+    """
+    with _map_cache_lock:
+        _map_cache_limits.update(entries=max_entries, bytes=_parse_size(max_bytes))
+        _evict_maps()
+
+
+def _map_cache_bounds():
+    max_entries = _map_cache_limits.get("entries")
+    if max_entries is None:
+        max_entries = int(os.environ.get(MAP_CACHE_ENTRIES_ENV) or MAP_CACHE_ENTRIES)
+    max_bytes = _map_cache_limits.get("bytes")
+    if max_bytes is None:
+        max_bytes = _parse_size(os.environ.get(MAP_CACHE_BYTES_ENV) or None)
+    return max_entries, max_bytes
+
+
+def _evict_maps():
+    max_entries, max_bytes = _map_cache_bounds()
+    while _map_cache and (
+        len(_map_cache) > max_entries
+        or (max_bytes is not None and sum(size for _, size in _map_cache.values()) > max_bytes)
+    ):
+        _map_cache.popitem(last=False)
+        _map_cache_stats["evictions"] += 1
+
+
+def clear_map_cache():
+    """Empties the in-memory cache of loaded maps and attribute tables."""
+    with _map_cache_lock:
+        _map_cache.clear()
+    _load_attributes.cache_clear()
+
+
+def map_cache_stats():
+    """Statistics of the in-memory cache of loaded maps.
+
+    Returns:
+        dict: entries, their estimated bytes, the bounds, and the hits, misses, and evictions
+    """
+    with _map_cache_lock:
+        max_entries, max_bytes = _map_cache_bounds()
+        return {
+            "entries": len(_map_cache),
+            "bytes": sum(size for _, size in _map_cache.values()),
+            "max_entries": max_entries,
+            "max_bytes": max_bytes,
+            **_map_cache_stats,
+        }
+
+
+def _map_nbytes(map_df):
+    """Estimated memory of a map: its columns, and 16 bytes per coordinate of its geometries."""
+    import shapely
+
+    coordinates = shapely.get_num_coordinates(np.asarray(map_df.geometry.values)).sum()
+    return int(map_df.memory_usage(deep=True).sum() + 16 * coordinates)
+
+
+def load_map(
+    date=2022, scale="jp_city_dc", quality="coarse", bbox=None, prefectures=None, codes=None
+):
     """Load a map of japan at a given scale and quality.
+
+    Cleaned maps, and those derived from other maps such as stylized maps, are cached as
+    GeoParquet on first use, so that later processes read them rather than parse or derive them
+    again. Maps are also kept in an in-memory cache, bounded by `set_map_cache`. Each call returns
+    a copy, which the caller may modify. The geometries are shared rather than copied, being
+    immutable.
+
+    The bbox, prefectures, and codes filters are pushed down to the GeoParquet reader, which skips
+    the row groups which cannot match them and decodes only the matching geometries. Filtered
+    maps are served from the in-memory cache when the whole map is in it, but are not added to it.
+    Their rows are numbered anew.
+
     Args:
         map_date (datetime64 or str): approximate date of desired map
         scale (str): scale of map to fetch
         quality (str): quality of map to fetch
+        bbox (tuple, optional): (min lon, min lat, max lon, max lat). Only the features whose
+            bounding box intersects it are loaded.
+        prefectures (str or list, optional): prefectures to load, e.g. "東京都".
+        codes (str or list, optional): municipality codes to load, e.g. ["13101", "13102"].
 
     Returns:
         geopandas dataframe: topojson map
     """
 
     # allow for longhand quality arguments
-    quality_arg_dict = {
-        "stylized": "s",
-        "coarse": "c",
-        "low": "l",
-        "medium": "i",
-        "high": "h",
-    }
-    try:
-        quality = quality_arg_dict[quality]
-    except KeyError:
-        pass
+    quality = QUALITY_ALIASES.get(quality, quality)
 
     # determine the map date to use
-    try:
-        date = np.datetime64(date)
-    except ValueError:
-        date = np.datetime64(str(date) + "-12-31")
+    date = parse_date(date)
+    map_date = resolve_map_date(date)
+
+    filters = {"bbox": bbox, "prefecture": prefectures, "code": codes}
+    filtered = any(value is not None for value in filters.values())
+
+    key = (map_date, scale, quality)
+    with _map_cache_lock:
+        cached = _map_cache.get(key)
+        if cached is not None:
+            _map_cache.move_to_end(key)
+            _map_cache_stats["hits"] += 1
+        else:
+            _map_cache_stats["misses"] += 1
+    if cached is not None:
+        return _filter_map(cached[0], **filters).copy()
+
+    map_df = _load_cleaned(date, map_date, scale, quality, **filters)
+    if filtered:
+        return map_df
+    max_entries, _ = _map_cache_bounds()
+    if max_entries > 0:
+        with _map_cache_lock:
+            _map_cache[key] = (map_df, _map_nbytes(map_df))
+            _evict_maps()
+        map_df = map_df.copy()
+    return map_df
 
-    try:
-        map_date = str(
-            np.array(AVAILABLE_DATES)[np.where(date >= np.array(AVAILABLE_DATES))][-1]
+
+def _cleaned_key(map_date, scale, quality):
+    return f"cleaned/{map_date}.{scale}.{quality}.v{CLEANED_VERSION}.parquet"
+
+
+def _load_cleaned(date, map_date, scale, quality, **filters):
+    """Loads a cleaned or derived map from its GeoParquet cache, generating it on first use.
+
+    Args:
+        **filters: bbox, prefecture, and code filters of `load_map`
+
+    Returns:
+        GeoDataFrame: matching rows of the map
+    """
+    cache_folder = cache_dir("maps")
+    index = get_index(cache_folder)
+    key = _cleaned_key(map_date, scale, quality)
+    cached = Path(cache_folder, key)
+
+    if not index.is_valid(key, evictable=True):
+        with cache_lock(cache_folder, key):
+            # another process may have generated it while we waited for the lock
+            if not index.is_valid(key, evictable=True, count=False):
+                map_df = _load_map(date, map_date, scale, quality)
+                cached.parent.mkdir(parents=True, exist_ok=True)
+                with atomic_path(cached) as tmp:
+                    _write_cleaned(map_df, tmp)
+                index.record(key, evictable=True)
+                return _filter_map(map_df, **filters)
+
+    return _read_cleaned(cached, **filters)
+
+
+def _write_cleaned(map_df, path):
+    """Writes a map as GeoParquet, with the bounding box of each feature in a covering column
+    whose row group statistics let a filtered read skip the row groups outside a bbox."""
+    map_df.to_parquet(path, write_covering_bbox=True, row_group_size=MAP_ROW_GROUP_SIZE)
+
+
+def _bbox_expression(bbox):
+    import pyarrow.compute as pc
+
+    min_lon, min_lat, max_lon, max_lat = bbox
+    return (
+        (pc.field(("bbox", "xmin")) <= max_lon)
+        & (pc.field(("bbox", "xmax")) >= min_lon)
+        & (pc.field(("bbox", "ymin")) <= max_lat)
+        & (pc.field(("bbox", "ymax")) >= min_lat)
+    )
+
+
+def _read_cleaned(path, bbox=None, **filters):
+    """Reads the rows of a cached map matching the filters of `load_map`."""
+    if bbox is None and all(value is None for value in filters.values()):
+        return gpd.read_parquet(path)
+
+    import pyarrow.parquet as pq
+
+    names = pq.read_schema(path).names
+    for column, values in filters.items():
+        if values is not None and column not in names:
+            raise Exception(f"Cannot filter on {column}, which is not a column of {path}")
+    expression = filter_expression(**filters)
+    if bbox is not None:
+        expression = (
+            _bbox_expression(bbox) if expression is None else expression & _bbox_expression(bbox)
         )
-    except IndexError as e:
-        raise Exception(f"date must be >= than {str(np.min(AVAILABLE_DATES))}") from e
+    return gpd.read_parquet(path, filters=expression).reset_index(drop=True)
+
+
+def _filter_map(map_df, bbox=None, **filters):
+    """Rows of a loaded map matching the filters of `load_map`."""
+    if bbox is None and all(value is None for value in filters.values()):
+        return map_df
+    keep = np.ones(len(map_df), dtype=bool)
+    for column, values in filters.items():
+        if values is not None:
+            if column not in map_df.columns:
+                raise Exception(f"Cannot filter on {column}, which is not a column of the map")
+            keep &= map_df[column].isin(as_list(values)).to_numpy()
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        bounds = map_df.bounds
+        keep &= (
+            (bounds["minx"] <= max_lon)
+            & (bounds["maxx"] >= min_lon)
+            & (bounds["miny"] <= max_lat)
+            & (bounds["maxy"] >= min_lat)
+        ).to_numpy()
+    return map_df.loc[keep].reset_index(drop=True)
+
+
+def _load_map(date, map_date, scale, quality):
+    """Loads a map, deriving it from other maps if it is not available itself."""
+    AVAILABLE_MAPS, _ = load_manifest()
 
     # check if desired map scale exists in manifest
     try:
@@ -393,6 +785,78 @@ def load_map(date=2022, scale="jp_city_dc", quality="coarse"):
     return map_df
 
 
+"""
+Attribute tables without geometry
+"""
+
+
+def load_attributes(date=2022, scale="jp_city_dc", quality="coarse"):
+    """Load the attribute table of a map, its prefecture, county, city, code, special, and
+    founding and extinction dates columns, without its geometries.
+
+    The table is read from the map file without decoding the geometries, or from the cleaned
+    GeoParquet map when already cached, and cached itself as a small Parquet file, so that code
+    and name lookups across every vintage load in milliseconds.
+
+    Args:
+        date (datetime64, str, or int, optional): approximate date of desired map. Defaults to 2022.
+        scale (str, optional): scale of map. Defaults to "jp_city_dc".
+        quality (str, optional): quality of map. Defaults to "coarse".
+
+    Returns:
+        pd.DataFrame: the rows and columns of `load_map`, without geometry
+    """
+    quality = QUALITY_ALIASES.get(quality, quality)
+    map_date = resolve_map_date(parse_date(date))
+    return _load_attributes(map_date, scale, quality).copy()
+
+
+def _attributes_key(map_date, scale, quality):
+    return f"attributes/{map_date}.{scale}.{quality}.v{CLEANED_VERSION}.parquet"
+
+
+@lru_cache(maxsize=None)
+def _load_attributes(map_date, scale, quality):
+    cache_folder = cache_dir("maps")
+    index = get_index(cache_folder)
+    key = _attributes_key(map_date, scale, quality)
+    cached = Path(cache_folder, key)
+
+    if not index.is_valid(key, evictable=True):
+        with cache_lock(cache_folder, key):
+            # another process may have generated it while we waited for the lock
+            if not index.is_valid(key, evictable=True, count=False):
+                attributes_df = _read_attributes(map_date, scale, quality)
+                cached.parent.mkdir(parents=True, exist_ok=True)
+                with atomic_path(cached) as tmp:
+                    attributes_df.to_parquet(tmp)
+                index.record(key, evictable=True)
+                return attributes_df
+
+    return pd.read_parquet(cached)
+
+
+def _read_attributes(map_date, scale, quality):
+    """Reads the attribute table of a map from the cheapest available source."""
+    cache_folder = cache_dir("maps")
+    cleaned_key = _cleaned_key(map_date, scale, quality)
+    if get_index(cache_folder).is_valid(cleaned_key, evictable=True, count=False):
+        import pyarrow.parquet as pq
+
+        cleaned = Path(cache_folder, cleaned_key)
+        columns = [
+            name for name in pq.read_schema(cleaned).names if name not in ["geometry", "bbox"]
+        ]
+        return pd.read_parquet(cleaned, columns=columns)
+
+    AVAILABLE_MAPS, _ = load_manifest()
+    if quality in AVAILABLE_MAPS[map_date].get(scale, []):
+        return load_and_clean_map_file(fetch_map(map_date, scale, quality), geometry=False)
+
+    # derived maps, e.g. stylized ones, are derived from geometries
+    return pd.DataFrame(load_map(map_date, scale, quality).drop(columns="geometry"))
+
+
 # Helper function to merge a DataFrame to a map
 def add_df_to_map(
     df,
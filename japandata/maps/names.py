@@ -0,0 +1,112 @@
+"""
+maps/names.py
+
+Resolution of municipality names to codes, for tables which list names without codes.
+
+Names are matched within their prefecture after normalizing spelling variants, e.g. ケ and ヶ or
+桧 and 檜, against a hashed index of the names in a map: the name of each municipality, prefixed
+with its county for towns and villages, and the county itself, which holds the whole city for the
+wards of designated cities. A whole column of names is resolved with one join.
+
+Author: Sam Passaglia
+"""
+
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from japandata.maps.maps import load_attributes, resolve_map_date
+from japandata.utils import logger
+
+# spelling variants, each mapped to the form used by the maps
+NAME_VARIANTS = str.maketrans({"ケ": "ヶ", "桧": "檜", "竜": "龍", "曾": "曽"})
+
+
+def normalize_names(names):
+    """Normalizes municipality names for matching.
+
+    Args:
+        names (pd.Series): names
+
+    Returns:
+        pd.Series: names with surrounding spaces removed and spelling variants unified
+    """
+    return names.str.strip().str.translate(NAME_VARIANTS)
+
+
+@lru_cache(maxsize=None)
+def _name_index(map_date, scale, quality):
+    map_df = load_attributes(map_date, scale, quality)
+    map_df = map_df.loc[map_df["code"].notna()]
+    county = map_df["county"] if "county" in map_df else pd.Series(np.nan, index=map_df.index)
+    # in order of precedence when names collide
+    names = [map_df["city"], county.fillna("") + map_df["city"], county]
+    index = pd.concat(
+        [
+            pd.DataFrame({"prefecture": map_df["prefecture"], "name": name, "code": map_df["code"]})
+            for name in names
+        ],
+        ignore_index=True,
+    ).dropna()
+    index["name"] = normalize_names(index["name"])
+    index = index.drop_duplicates(["prefecture", "name"])
+    return index.set_index(["prefecture", "name"])["code"]
+
+
+def name_index(date, scale="jp_city_dc", quality="coarse"):
+    """Index of the municipality codes of the map in effect at a date by prefecture and name.
+
+    Args:
+        date (datetime64, str, or int): date or year
+        scale (str, optional): map scale. Defaults to "jp_city_dc".
+        quality (str, optional): map quality. Defaults to "coarse".
+
+    Returns:
+        pd.Series: codes indexed by prefecture and normalized name
+    """
+    return _name_index(resolve_map_date(date), scale, quality)
+
+
+def resolve_codes(
+    df,
+    dates,
+    prefecture_column="prefecture",
+    name_column="city",
+    scale="jp_city_dc",
+    quality="coarse",
+):
+    """Finds the codes of the municipalities of a table from their prefecture and name.
+
+    The names are looked up in the map of each date in turn, those not found in one map being
+    looked up in the next. Names found in none are logged and given no code.
+
+    Args:
+        df (pd.DataFrame): table
+        dates (list): dates or years of the maps to look up, in order of preference
+        prefecture_column (str, optional): column of prefecture names. Defaults to "prefecture".
+        name_column (str, optional): column of municipality names. Defaults to "city".
+        scale (str, optional): map scale. Defaults to "jp_city_dc".
+        quality (str, optional): map quality. Defaults to "coarse".
+
+    Returns:
+        pd.Series: codes, aligned with df
+    """
+    keys = pd.MultiIndex.from_arrays([df[prefecture_column], normalize_names(df[name_column])])
+    codes = pd.Series(np.nan, index=df.index, dtype=object)
+    for date in dates:
+        missing = codes.isna().to_numpy()
+        if not missing.any():
+            break
+        found = name_index(date, scale, quality).reindex(keys[missing]).to_numpy()
+        codes.loc[missing] = found
+
+    unmatched = df.loc[codes.isna(), [prefecture_column, name_column]]
+    if len(unmatched):
+        names = [f"{pref} {name}" for pref, name in unmatched.itertuples(index=False)]
+        logger.warning(
+            f"{len(unmatched)} municipalities not found in the maps of {list(dates)}: "
+            + ", ".join(names[:10])
+            + ("..." if len(names) > 10 else "")
+        )
+    return codes
@@ -1,8 +1,22 @@
+from .cube import (  # noqa: F401
+    AgeCube,
+    bracket_labels,
+    cube_from_frame,
+    load_age_cube,
+)
 from .population import (  # noqa: F401
-    city_age,
-    city_pop,
-    japan_age,
-    japan_pop,
-    pref_age,
-    pref_pop,
+    DATAFRAME_NAMES,
+    __getattr__,
+    fetch_data,
+    fetch_dataframes,
+    load_age,
+    load_age_year,
+    load_pop,
+    load_pop_year,
+    query,
+    refetch,
+    source_file,
+    source_years,
 )
+from .projection import CohortModel, fit_cohort_model, project  # noqa: F401
+from .validation import ValidationError, Validator  # noqa: F401
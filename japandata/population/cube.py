@@ -0,0 +1,299 @@
+"""
+population/cube.py
+
+Dense array view of the age tables, for pyramids, dependency ratios, and cohort calculations over
+every municipality and year at once.
+
+The long-format age tables are reshaped into an ndarray indexed by (code, year, gender,
+nationality, age bracket). Until 2014 the tables stop at 80+, later at 100+, so every year is
+rebinned onto a common set of brackets.
+
+Author: Sam Passaglia
+"""
+
+import re
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from japandata.utils import logger
+
+AXES = ("code", "year", "gender", "nationality", "age")
+BRACKET_PATTERN = re.compile(r"\d+-\d+|>\d+")
+
+
+def _bracket_bounds(label):
+    """Lower and upper (exclusive) age of a bracket label such as "5-9" or ">79"."""
+    if label.startswith(">"):
+        return int(label[1:]) + 1, np.inf
+    lower, upper = label.split("-")
+    return int(lower), int(upper) + 1
+
+
+def bracket_labels(edges):
+    """Labels of the age brackets starting at each edge, the last one open-ended.
+
+    Args:
+        edges (list): lower age of each bracket, e.g. [0, 15, 65]
+
+    Returns:
+        list: labels, e.g. ["0-14", "15-64", ">64"]
+    """
+    edges = [int(edge) for edge in edges]
+    labels = [f"{lower}-{upper - 1}" for lower, upper in zip(edges, edges[1:])]
+    return labels + [f">{edges[-1] - 1}"]
+
+
+def rebin_matrix(from_edges, to_edges):
+    """Matrix summing brackets into coarser ones, such that `values @ matrix` is rebinned.
+
+    Args:
+        from_edges (list): lower ages of the current brackets
+        to_edges (list): lower ages of the coarser brackets. Each must be a current edge.
+
+    Returns:
+        np.ndarray: (len(from_edges), len(to_edges)) matrix of zeros and ones
+    """
+    from_edges = np.asarray(from_edges)
+    to_edges = np.asarray(to_edges)
+    if to_edges[0] != from_edges[0] or not np.isin(to_edges, from_edges).all():
+        raise Exception(
+            f"Cannot rebin age brackets starting at {from_edges.tolist()} into brackets starting at"
+            f" {to_edges.tolist()}: every new bracket must start where a current one does."
+        )
+    target = np.searchsorted(to_edges, from_edges, side="right") - 1
+    matrix = np.zeros((len(from_edges), len(to_edges)))
+    matrix[np.arange(len(from_edges)), target] = 1
+    return matrix
+
+
+class AgeCube:
+    """Age distributions as a dense array indexed by (code, year, gender, nationality, age).
+
+    Combinations absent from the tables, e.g. a municipality in the years before it was created,
+    are NaN.
+
+    Attributes:
+        values (np.ndarray): population counts
+        codes, years, genders, nationalities (np.ndarray): labels of the first four axes
+        edges (np.ndarray): lower age of each bracket of the last axis, the last bracket open-ended
+        prefectures, cities (np.ndarray): latest prefecture and municipality name of each code
+    """
+
+    def __init__(
+        self, values, codes, years, genders, nationalities, edges, prefectures=None, cities=None
+    ):
+        self.values = values
+        self.codes = np.asarray(codes)
+        self.years = np.asarray(years)
+        self.genders = np.asarray(genders)
+        self.nationalities = np.asarray(nationalities)
+        self.edges = np.asarray(edges)
+        self.prefectures = prefectures
+        self.cities = cities
+
+    def __repr__(self):
+        shape = " x ".join(f"{axis} ({n})" for axis, n in zip(AXES, self.values.shape))
+        return f"AgeCube({shape})"
+
+    @property
+    def brackets(self):
+        """Labels of the age brackets."""
+        return np.array(bracket_labels(self.edges))
+
+    def labels(self, axis):
+        """Labels along an axis.
+
+        Args:
+            axis (str): one of "code", "year", "gender", "nationality", "age"
+
+        Returns:
+            np.ndarray: labels
+        """
+        return {
+            "code": self.codes,
+            "year": self.years,
+            "gender": self.genders,
+            "nationality": self.nationalities,
+            "age": self.brackets,
+        }[axis]
+
+    def locate(self, axis, labels):
+        """Positions of labels along an axis.
+
+        Args:
+            axis (str): one of "code", "year", "gender", "nationality", "age"
+            labels (list): labels to locate
+
+        Returns:
+            np.ndarray: positions, usable to index `values` along the axis
+        """
+        positions = pd.Index(self.labels(axis)).get_indexer(np.asarray(labels).ravel())
+        if (positions == -1).any():
+            missing = np.asarray(labels).ravel()[positions == -1]
+            raise Exception(f"{missing.tolist()} not found along the {axis} axis")
+        return positions
+
+    def sel(self, **labels):
+        """Selects labels along some axes.
+
+        A single label drops its axis, a list of labels keeps it.
+
+        Args:
+            **labels: axis name to label(s), e.g. year=2020, gender="total", code=["13101"]
+
+        Returns:
+            np.ndarray: selected values
+        """
+        values = self.values
+        squeeze = []
+        for position, axis in enumerate(AXES):
+            if axis not in labels:
+                continue
+            values = np.take(values, self.locate(axis, labels[axis]), axis=position)
+            if np.ndim(labels[axis]) == 0:
+                squeeze.append(position)
+        return values.squeeze(axis=tuple(squeeze)) if squeeze else values
+
+    def copy(self):
+        """Copy of the cube, whose values can be modified without affecting this one.
+
+        Returns:
+            AgeCube: copied cube
+        """
+        return AgeCube(
+            self.values.copy(),
+            self.codes.copy(),
+            self.years.copy(),
+            self.genders.copy(),
+            self.nationalities.copy(),
+            self.edges.copy(),
+            None if self.prefectures is None else self.prefectures.copy(),
+            None if self.cities is None else self.cities.copy(),
+        )
+
+    def rebin(self, edges):
+        """Sums the age brackets into coarser ones.
+
+        Args:
+            edges (list): lower age of each new bracket, e.g. [0, 15, 65] for the brackets used in
+                dependency ratios. Each must start a current bracket.
+
+        Returns:
+            AgeCube: rebinned cube
+        """
+        matrix = rebin_matrix(self.edges, edges).astype(self.values.dtype)
+        return AgeCube(
+            self.values @ matrix,
+            self.codes,
+            self.years,
+            self.genders,
+            self.nationalities,
+            edges,
+            self.prefectures,
+            self.cities,
+        )
+
+
+def _axis_labels(df, column, known):
+    """Labels of an axis present in a column, in the order of `known`, and each row's position."""
+    present = set(df[column])
+    unknown = present.difference(known)
+    if unknown:
+        raise Exception(f"Unknown {column} labels {sorted(map(str, unknown))}. Expected {known}.")
+    labels = np.array([label for label in known if label in present])
+    return labels, pd.Index(labels).get_indexer(df[column])
+
+
+def cube_from_frame(df, edges=None, dtype=np.float64):
+    """Reshapes a long-format age table into an AgeCube.
+
+    Args:
+        df (pd.DataFrame): age table, e.g. city_age or pref_age
+        edges (list, optional): lower age of each bracket of the cube. Defaults to the finest
+            brackets into which every year of the table can be rebinned.
+        dtype (optional): floating point dtype of the cube, e.g. float32, in which missing cells
+            are NaN. Defaults to float64.
+
+    Returns:
+        AgeCube: the table as a cube
+    """
+    if not np.issubdtype(np.dtype(dtype), np.floating):
+        raise Exception(
+            f"dtype must be a floating point type, in which missing cells are NaN, not"
+            f" {np.dtype(dtype)}"
+        )
+    df = df[df["code"].notna()]
+    bracket_columns = [column for column in df.columns if BRACKET_PATTERN.fullmatch(column)]
+
+    # each year reports its own set of brackets
+    present = df[bracket_columns].notna().to_numpy()
+    schemes = {}
+    for row_scheme in np.unique(present, axis=0):
+        columns = [column for column, used in zip(bracket_columns, row_scheme) if used]
+        schemes[tuple(row_scheme)] = (columns, [_bracket_bounds(column)[0] for column in columns])
+    if edges is None:
+        common = set.intersection(*[set(lowers) for _, lowers in schemes.values()])
+        edges = sorted(common)
+
+    codes, code_index = np.unique(df["code"].astype(str).to_numpy(), return_inverse=True)
+    years, year_index = np.unique(df["year"].to_numpy(), return_inverse=True)
+    genders, gender_index = _axis_labels(df, "gender", ["total", "men", "women"])
+    nationalities, nationality_index = _axis_labels(
+        df, "nationality", ["all", "japanese", "non-japanese"]
+    )
+
+    shape = (len(codes), len(years), len(genders), len(nationalities), len(edges))
+    values = np.zeros(shape, dtype=dtype)
+    filled = np.zeros(shape[:-1], dtype=bool)
+    keys = (code_index, year_index, gender_index, nationality_index)
+
+    for row_scheme, (columns, lowers) in schemes.items():
+        rows = (present == np.array(row_scheme)).all(axis=1)
+        order = np.argsort(lowers)
+        native = df.loc[rows, columns].to_numpy(dtype=dtype)[:, order]
+        rebinned = native @ rebin_matrix(np.asarray(lowers)[order], edges).astype(dtype)
+        # np.add.at so that rows repeating a key are summed rather than overwritten
+        np.add.at(values, tuple(key[rows] for key in keys), rebinned)
+        filled[tuple(key[rows] for key in keys)] = True
+
+    duplicates = df.duplicated(["code", "year", "gender", "nationality"]).sum()
+    if duplicates:
+        logger.warning(f"Summed {duplicates} rows repeating a (code, year, gender, nationality)")
+    values[~filled] = np.nan
+
+    # latest names of each code
+    latest = df.sort_values("year").drop_duplicates("code", keep="last").set_index("code")
+    latest.index = latest.index.astype(str)
+    prefectures = latest["prefecture"].reindex(codes).to_numpy()
+    cities = latest["city"].reindex(codes).to_numpy() if "city" in latest else None
+
+    return AgeCube(values, codes, years, genders, nationalities, edges, prefectures, cities)
+
+
+def load_age_cube(datalevel="city", edges=None, dtype=np.float64):
+    """Loads the age tables as an AgeCube, cached in memory. Each call returns its own copy.
+
+    Args:
+        datalevel (str, optional): "city" or "prefecture". Defaults to "city".
+        edges (list, optional): lower age of each bracket. Defaults to the finest brackets common
+            to every year, 0-4 to 75-79 and 80+.
+        dtype (optional): floating point dtype of the cube. Defaults to float64.
+
+    Returns:
+        AgeCube: age distributions
+    """
+    if edges is not None:
+        edges = tuple(edges)
+    return _load_age_cube(datalevel, edges, np.dtype(dtype)).copy()
+
+
+@lru_cache(maxsize=8)
+def _load_age_cube(datalevel, edges, dtype):
+    from japandata.population.population import query
+
+    if datalevel not in ["city", "prefecture"]:
+        raise Exception(f"Unknown datalevel {datalevel}. Expected city or prefecture.")
+    df = query("city_age" if datalevel == "city" else "pref_age")
+    return cube_from_frame(df, edges=None if edges is None else list(edges), dtype=dtype)
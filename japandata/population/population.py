@@ -6,16 +6,38 @@ Module which loads, caches, and provides access to population data
 Author: Sam Passaglia
 """
 
-import os
-import tarfile
+import json
+import shutil
+from functools import lru_cache, partial
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
-from japandata.utils import logger
-
-CACHE_FOLDER = Path(Path(__file__).parent, "cache/")
+from japandata.cache import (
+    atomic_path,
+    cache_dir,
+    cache_lock,
+    get_index,
+    source_info,
+    sources_current,
+)
+from japandata.dtypes import compact_dtypes
+from japandata.population.schema import POPTYPES, SCHEMAS
+from japandata.population.validation import Validator, as_validator
+from japandata.query import ROW_GROUP_SIZE, as_list, cache_order, read_parquet
+from japandata.utils import lazy_module_attributes, logger
+
+DATAFRAME_NAMES = ["japan_pop", "japan_age", "pref_pop", "pref_age", "city_pop", "city_age"]
+# (table, level) of each dataframe
+DATAFRAME_TABLES = {
+    "japan_pop": ("pop", "japan"),
+    "japan_age": ("age", "japan"),
+    "pref_pop": ("pop", "prefecture"),
+    "pref_age": ("age", "prefecture"),
+    "city_pop": ("pop", "city"),
+    "city_age": ("age", "city"),
+}
 
 """
 Data fetching and caching
@@ -29,107 +51,102 @@ def fetch_data():
         Path: cached filepath.
     """
 
-    cached = Path(CACHE_FOLDER, "population/")
-    archive = Path(CACHE_FOLDER, "indices.tar.gz")
-    if not cached.exists():
-        cached.parent.mkdir(parents=True, exist_ok=True)  # recreate any required subdirectories
+    cached = Path(cache_dir("population"), "population/")
+    index = get_index(cached.parent)
+    if not index.is_valid("population"):
+        with cache_lock(cached.parent, "population"):
+            # another process may have fetched it while we waited for the lock
+            if index.is_valid("population", count=False):
+                return cached
+            cached.parent.mkdir(parents=True, exist_ok=True)  # recreate any required subdirectories
+            if cached.exists():
+                shutil.rmtree(cached)  # unverifiable, e.g. extracted before the cache was indexed
+
+            logger.info("Fetching data for japandata.population")
+
+            from japandata.download import (
+                extract_progress,
+                get_checksum,
+                get_url,
+            )
 
-        logger.info("Fetching data for japandata.population")
+            extract_progress(get_url("population"), cached, sha256=get_checksum("population"))
+            index.record("population")
+    return cached
 
-        from japandata.download import DOWNLOAD_INFO, download_progress
 
-        url = DOWNLOAD_INFO["population"]["latest"]["url"]
-        download_progress(url, archive)
+# folder and file label of the source tables, per (table, datalevel) and poptype
+SOURCE_LABELS = {
+    ("pop", "prefecture"): ("tjin", {"resident": "01", "japanese": "05n", "non-japanese": "09g"}),
+    ("pop", "city"): ("sjin", {"resident": "03", "japanese": "07n", "non-japanese": "11g"}),
+    ("age", "prefecture"): ("tnen", {"resident": "02", "japanese": "06n", "non-japanese": "10g"}),
+    ("age", "city"): ("snen", {"resident": "04", "japanese": "08n", "non-japanese": "12g"}),
+}
+FIRST_YEARS = {
+    "pop": {"resident": 1968, "japanese": 2013, "non-japanese": 2013},
+    "age": {"resident": 1994, "japanese": 2013, "non-japanese": 2013},
+}
+FIRST_CITY_YEAR = 1995
+
+
+def source_file(table, year, datalevel="prefecture", poptype="resident"):
+    """Path of a source table relative to DATA_FOLDER.
+
+    Args:
+        table (str): "pop" or "age"
+        year (int): year of the table
+        datalevel (str, optional): "prefecture" or "city"
+        poptype (str, optional): "resident", "japanese", or "non-japanese"
+
+    Returns:
+        Path: relative path of the .xls(x) file
+    """
+    folder, labels = SOURCE_LABELS[(table, datalevel)]
+    layout = SCHEMAS[table].layout(year, datalevel, poptype)
+    filelabel = str(year)[-2:] + labels[poptype] + layout["label_suffix"]
+    return Path(folder, filelabel + folder + layout["extension"])
 
-        with tarfile.open(archive, "r") as tf:
-            tf.extractall(cached.parent)
-        os.remove(archive)
-    return cached
 
+def source_years(table, poptype="resident"):
+    """Years for which a source table is available in DATA_FOLDER, so that newly published years
+    are picked up when they are added.
+
+    Args:
+        table (str): "pop" or "age"
+        poptype (str, optional): "resident", "japanese", or "non-japanese"
+
+    Returns:
+        list: years
+    """
+    data_folder = fetch_data()
+    first_year = FIRST_YEARS[table][poptype]
+    # file names carry two-digit years, starting from 1968
+    return [
+        year
+        for year in range(first_year, 2068)
+        if Path(data_folder, source_file(table, year, "prefecture", poptype)).exists()
+    ]
 
-DATA_FOLDER = fetch_data()
 
 """
 """
 
 
-def load_age_year(year, datalevel="prefecture", poptype="resident"):
+def load_age_year(year, datalevel="prefecture", poptype="resident", validate="strict"):
     assert datalevel in ["prefecture", "city"]
     assert poptype in ["resident", "japanese", "non-japanese"]
     logger.info(f"Processing age data for {year} {datalevel} {poptype}")
 
-    fileextension = ".xls"
-    skiprows = 2
-    if year >= 2021:
-        fileextension = ".xlsx"
-        skiprows = 3
-
-    forced_coltypes = {"code6digit": str, "prefecture": str}
-    cols = ["code6digit", "prefecture"]
-    if datalevel == "city":
-        cols += ["city"]
-    cols += ["gender", "total-pop"]
-    if year == 2005:
-        cols += ["total-pop-corrected"]
-    agebracketmin = 0
-    if year < 2015:
-        agebracketmax = 80
-    else:
-        agebracketmax = 100
-    while agebracketmin < agebracketmax:
-        cols += [(str(int(agebracketmin)) + "-" + str(agebracketmin + 4))]
-        agebracketmin += 5
-    cols += [">" + str(int(agebracketmax - 1))]
-
-    if datalevel == "prefecture":
-        if poptype == "resident":
-            filelabel = str(year)[-2:] + "02"
-            if year >= 2013:
-                filelabel += "s"
-        elif poptype == "japanese":
-            filelabel = str(year)[-2:] + "06n"
-        elif poptype == "non-japanese":
-            filelabel = str(year)[-2:] + "10g"
-
-        df = pd.read_excel(
-            Path(DATA_FOLDER, "tnen", filelabel + "tnen" + fileextension),
-            skiprows=skiprows,
-            header=None,
-            names=cols,
-            dtype=forced_coltypes,
-        )
-    elif datalevel == "city":
-        if poptype == "resident":
-            filelabel = str(year)[-2:] + "04"
-            if year >= 2013:
-                filelabel += "s"
-        elif poptype == "japanese":
-            filelabel = str(year)[-2:] + "08n"
-        elif poptype == "non-japanese":
-            filelabel = str(year)[-2:] + "12g"
-        df = pd.read_excel(
-            Path(DATA_FOLDER, "snen", filelabel + "snen" + fileextension),
-            skiprows=skiprows,
-            header=None,
-            names=cols,
-            dtype=forced_coltypes,
-        )
-
-    if (year >= 2021) and (poptype != "japanese"):
-        df = df[:-2]
+    df = SCHEMAS["age"].read(
+        Path(fetch_data(), source_file("age", year, datalevel, poptype)), year, datalevel, poptype
+    )
 
     if datalevel == "city":
-        df["city"].replace("\x1f", np.nan, inplace=True)
-        df["city"].replace("-", np.nan, inplace=True)
+        df["city"] = df["city"].replace("\x1f", np.nan)
+        df["city"] = df["city"].replace("-", np.nan)
         df["city"] = df["city"].str.strip()
         df["city"] = df["city"].str.replace("*", "", regex=False)
-        df["city"].replace("", np.nan, inplace=True)
-
-    df.loc[:, ~df.columns.isin(["city", "code"])] = df.loc[
-        :, ~df.columns.isin(["city", "code"])
-    ].fillna(0)
-
-    df = df.replace("X", 0)
+        df["city"] = df["city"].replace("", np.nan)
 
     df["prefecture"] = df["prefecture"].str.strip()
     df["prefecture"] = df["prefecture"].str.replace("*", "", regex=False)
@@ -151,24 +168,30 @@ def load_age_year(year, datalevel="prefecture", poptype="resident"):
     if datalevel == "city":
         df["code"] = df["code6digit"].apply(lambda s: s if pd.isna(s) else s[:-1])
 
-    if year == 2005:
-        df = df.drop("total-pop-corrected", axis=1)
-
     # SELF-CONSISTENCY TESTS #
-    # men+women = total
-    grouped = df.drop(
-        ["code6digit", "prefecture", "city", "gender"],
-        axis=1,
-        errors="ignore",
-    ).groupby("code")
-
-    def testfunc(group):
-        # print(group)
-        assert (
-            group.iloc[0, :-1] == group.iloc[1, :-1] + group.iloc[2, :-1]
-        ).all()  # TODO this probably needs to be fixed
-
-    grouped.apply(testfunc)
+    validator = as_validator(validate)
+    if validator.enabled:
+        # men+women = total, in every column, pairing the rows of each code by gender
+        values = [
+            column
+            for column in df.columns
+            if column not in ["code6digit", "code", "prefecture", "city", "gender"]
+        ]
+        keyed = df.loc[df["code"].notna()].copy()
+        keyed["occurrence"] = keyed.groupby(["code", "gender"]).cumcount()
+        total, men, women = (
+            keyed.loc[keyed["gender"] == gender].set_index(["code", "occurrence"])
+            for gender in ["計", "男", "女"]
+        )
+        validator.check_equal(
+            "men + women = total",
+            total.reset_index(),
+            men[values].reindex(total.index).to_numpy(dtype=np.float64)
+            + women[values].reindex(total.index).to_numpy(dtype=np.float64),
+            total[values].to_numpy(dtype=np.float64),
+            values,
+            {"table": "age", "year": year, "datalevel": datalevel, "poptype": poptype},
+        )
     # SELF-CONSISTENCY TESTS #
 
     df["unknown"] = df["total-pop"] - df.drop(
@@ -184,7 +207,7 @@ def load_age_year(year, datalevel="prefecture", poptype="resident"):
         errors="ignore",
     ).sum(axis=1)
 
-    df["gender"].replace({"計": "total", "男": "men", "女": "women"}, inplace=True)
+    df["gender"] = df["gender"].replace({"計": "total", "男": "men", "女": "women"})
 
     df["year"] = year
 
@@ -203,134 +226,24 @@ def load_age_year(year, datalevel="prefecture", poptype="resident"):
     sorted_cols = ["year", "nationality"]
     df = df.reindex(columns=(sorted_cols + list([a for a in df.columns if a not in sorted_cols])))
 
-    # Clean up types
-    type_dict = {
-        col: int
-        for col in df.columns
-        if col
-        not in [
-            "year",
-            "gender",
-            "nationality",
-            "code6digit",
-            "code",
-            "prefecture",
-            "city",
-        ]
-    }
-    for key in type_dict.keys():
-        if key in df.columns:
-            df[key] = df[key].astype(type_dict[key])
-
     return df
 
 
-def load_pop_year(year, datalevel="prefecture", poptype="resident"):
+def load_pop_year(year, datalevel="prefecture", poptype="resident", validate="strict"):
     assert datalevel in ["prefecture", "city"]
     assert poptype in ["resident", "japanese", "non-japanese"]
 
     logger.info(f"Processing pop data for {year} {datalevel} {poptype}")
-    fileextension = ".xls"
-    skiprows = 4
-    if year >= 2021:
-        fileextension = ".xlsx"
-        skiprows = 6
-
-    forced_coltypes = {"code6digit": str, "prefecture": str, "city": str}
-
-    cols = ["code6digit", "prefecture"]
-    if datalevel == "city":
-        cols += ["city"]
-    cols += ["men", "women", "total-pop"]
-    if year == 2005:
-        cols += ["total-pop-corrected"]
-    if poptype == "japanese":
-        cols += ["households-singlecitizenship", "households-multicitizenship"]
-    cols += ["households"]
-    if year == 2005:
-        cols += ["households-corrected"]
-    if 1980 <= year:
-        if 2013 <= year:
-            cols += ["moved-in-domestic", "moved-in-international"]
-        cols += ["moved-in", "births"]
-        if poptype == "japanese":
-            cols += ["naturalization", "other-in-other"]
-        if poptype == "non-japanese":
-            if year == 2013:
-                cols += ["other-30-47"]
-            cols += ["denaturalization", "other-in-other"]
-        cols += ["other-in", "total-in"]
-        if 2013 <= year:
-            cols += ["moved-out-domestic", "moved-out-international"]
-        cols += ["moved-out", "deaths"]
-        if poptype == "japanese":
-            cols += ["denaturalization", "other-out-other"]
-        if poptype == "non-japanese":
-            cols += ["naturalization", "other-out-other"]
-        cols += ["other-out", "total-out", "in-minus-out"]
-        if 1994 <= year:
-            cols += ["in-minus-out-rate"]
-        cols += [
-            "births-minus-deaths",
-            "births-minus-deaths-rate",
-            "social-in-minus-social-out",
-            "social-in-minus-social-out-rate",
-        ]
-
-    if datalevel == "prefecture":
-        if poptype == "resident":
-            filelabel = str(year)[-2:] + "01"
-            if year >= 2013:
-                filelabel += "s"
-        elif poptype == "japanese":
-            filelabel = str(year)[-2:] + "05n"
-        elif poptype == "non-japanese":
-            filelabel = str(year)[-2:] + "09g"
-        df = pd.read_excel(
-            Path(DATA_FOLDER, "tjin", filelabel + "tjin" + fileextension),
-            skiprows=skiprows,
-            header=None,
-            names=cols,
-            dtype=forced_coltypes,
-        )
-    elif datalevel == "city":
-        if poptype == "resident":
-            filelabel = str(year)[-2:] + "03"
-            if year >= 2013:
-                filelabel += "s"
-        elif poptype == "japanese":
-            filelabel = str(year)[-2:] + "07n"
-        elif poptype == "non-japanese":
-            filelabel = str(year)[-2:] + "11g"
-        df = pd.read_excel(
-            Path(DATA_FOLDER, "sjin", filelabel + "sjin" + fileextension),
-            skiprows=skiprows,
-            header=None,
-            names=cols,
-            dtype=forced_coltypes,
-        )
-
-    df = df.drop(
-        [
-            "total-pop-corrected",
-            "households-corrected",
-            "in-minus-out-rate",
-            "births-minus-deaths-rate",
-            "social-in-minus-social-out-rate",
-        ],
-        axis=1,
-        errors="ignore",
+    df = SCHEMAS["pop"].read(
+        Path(fetch_data(), source_file("pop", year, datalevel, poptype)), year, datalevel, poptype
     )
 
-    if year >= 2021:
-        df = df[:-1]
-
     df["prefecture"] = df["prefecture"].str.strip()
     df.loc[df["prefecture"] == "合計", "code6digit"] = np.nan
 
     if datalevel == "city":
-        df["city"].replace("\x1f", np.nan, inplace=True)
-        df["city"].replace("-", np.nan, inplace=True)
+        df["city"] = df["city"].replace("\x1f", np.nan)
+        df["city"] = df["city"].replace("-", np.nan)
         df["city"] = df["city"].str.strip()
         df.loc[df["city"] == "島しょ", "code6digit"] = "133604"
         df.loc[df["city"] == "色丹郡色丹村", "code6digit"] = "016951"
@@ -347,46 +260,39 @@ def load_pop_year(year, datalevel="prefecture", poptype="resident"):
         df["code"] = df["code6digit"].apply(lambda s: s if pd.isna(s) else s[:-1])
 
     # SELF-CONSISTENCY TESTS #
-    assert (df["men"] + df["women"] == df["total-pop"]).all()
+    validator = as_validator(validate)
+    context = {"table": "pop", "year": year, "datalevel": datalevel, "poptype": poptype}
+    identities = [(["men", "women"], "total-pop")]
     if year >= 1980:
-        assert (df["moved-in"] + df["births"] + df["other-in"] == df["total-in"]).all()
+        identities.append((["moved-in", "births", "other-in"], "total-in"))
         if year != 1996 and datalevel != "city":
-            assert (df["moved-out"] + df["deaths"] + df["other-out"] == df["total-out"]).all()
-        assert (df["total-in"] - df["total-out"] == df["in-minus-out"]).all()
-        assert (df["births"] - df["deaths"] == df["births-minus-deaths"]).all()
-        assert (
-            df["moved-in"] + df["other-in"] - df["moved-out"] - df["other-out"]
-            == df["social-in-minus-social-out"]
-        ).all()
+            identities.append((["moved-out", "deaths", "other-out"], "total-out"))
+        identities += [
+            (["total-in", "-total-out"], "in-minus-out"),
+            (["births", "-deaths"], "births-minus-deaths"),
+            (["moved-in", "other-in", "-moved-out", "-other-out"], "social-in-minus-social-out"),
+        ]
     if year >= 2013:
-        assert (df["moved-in-domestic"] + df["moved-in-international"] == df["moved-in"]).all()
-        assert (df["moved-out-domestic"] + df["moved-out-international"] == df["moved-out"]).all()
-    if datalevel == "prefecture":
-        assert (
-            df.drop(df.loc[df["prefecture"] == "合計"].index)
-            .drop(
-                [
-                    "code6digit",
-                    "code",
-                    "prefecture",
-                ],
-                axis=1,
-                errors="ignore",
-            )
-            .sum()
-            .values
-            == df.loc[df["prefecture"] == "合計"]
-            .drop(
-                [
-                    "code6digit",
-                    "code",
-                    "prefecture",
-                ],
-                axis=1,
-                errors="ignore",
-            )
-            .values
-        ).all()
+        identities += [
+            (["moved-in-domestic", "moved-in-international"], "moved-in"),
+            (["moved-out-domestic", "moved-out-international"], "moved-out"),
+        ]
+    for terms, total in identities:
+        validator.check_sum(df, terms, total, context)
+    if datalevel == "prefecture" and validator.enabled:
+        # the prefectures sum to the national total
+        japan = df["prefecture"] == "合計"
+        values = [
+            column for column in df.columns if column not in ["code6digit", "code", "prefecture"]
+        ]
+        validator.check_equal(
+            "sum of prefectures = 合計",
+            df.loc[japan],
+            df.loc[~japan, values].to_numpy(dtype=np.float64).sum(axis=0, keepdims=True),
+            df.loc[japan, values].to_numpy(dtype=np.float64),
+            values,
+            context,
+        )
     # SELF-CONSISTENCY TESTS #
 
     df["year"] = year
@@ -405,95 +311,73 @@ def load_pop_year(year, datalevel="prefecture", poptype="resident"):
     sorted_cols = ["year", "nationality"]
     df = df.reindex(columns=(sorted_cols + list([a for a in df.columns if a not in sorted_cols])))
 
-    # Clean up types
-    type_dict = {
-        col: int
-        for col in df.columns
-        if col
-        not in [
-            "year",
-            "nationality",
-            "code6digit",
-            "code",
-            "prefecture",
-            "city",
-        ]
-    }
-    for key in type_dict.keys():
-        if key in df.columns:
-            df[key] = df[key].astype(type_dict[key])
-
     return df
 
 
-def load_pop():
-    poptypes = ["resident", "japanese", "non-japanese"]
+def _check_city_summary(validator, japan_df_year, pref_df_year, city_df_year, context):
+    """Checks that the summary rows of the city table, japan then each prefecture, repeat the
+    japan and prefecture tables."""
+    if not validator.enabled:
+        return
+    summary = city_df_year.loc[pd.isna(city_df_year["city"])].reset_index(drop=True)
+    values = [
+        column
+        for column in japan_df_year.columns
+        if column in summary.columns and column not in ["year", "nationality", "gender"]
+    ]
+    japan_rows = len(japan_df_year)
+    validator.check_equal(
+        "japan table = city table summary",
+        japan_df_year,
+        summary.iloc[:japan_rows][values].to_numpy(dtype=np.float64),
+        japan_df_year[values].to_numpy(dtype=np.float64),
+        values,
+        context,
+    )
+    validator.check_equal(
+        "prefecture table = city table summary",
+        pref_df_year,
+        summary.iloc[japan_rows:][values].to_numpy(dtype=np.float64),
+        pref_df_year[values].to_numpy(dtype=np.float64),
+        values,
+        context,
+    )
 
-    complete_japan_df = pd.DataFrame()
-    complete_pref_df = pd.DataFrame()
-    complete_city_df = pd.DataFrame()
 
-    for poptype in poptypes:
-        if poptype == "resident":
-            years = np.arange(1968, 2023)
-        else:
-            years = np.arange(2013, 2023)
-
-        japan_df = pd.DataFrame()
-        pref_df = pd.DataFrame()
-        city_df = pd.DataFrame()
-        for year in years:
-            pref_df_year = load_pop_year(year, poptype=poptype, datalevel="prefecture")
-            japan_df_year = (
-                pref_df_year[pref_df_year["prefecture"] == "合計"]
-                .copy()
-                .drop(
-                    ["prefecture", "code"],
-                    axis=1,
-                    errors="ignore",
-                )
-            )
-            pref_df_year.drop(
-                pref_df_year.loc[pref_df_year["prefecture"] == "合計"].index, inplace=True
-            )
+def _split_pop_year(pref_df_year, city_df_year=None, validate="strict", poptype=None):
+    """Splits the population tables of one year into japan, prefecture, and city dataframes,
+    checking their consistency."""
+    japan_df_year = (
+        pref_df_year[pref_df_year["prefecture"] == "合計"]
+        .copy()
+        .drop(
+            ["prefecture", "code"],
+            axis=1,
+            errors="ignore",
+        )
+    )
+    pref_df_year = pref_df_year.drop(pref_df_year.loc[pref_df_year["prefecture"] == "合計"].index)
+
+    if city_df_year is not None:
+        context = {
+            "table": "pop",
+            "year": int(pref_df_year["year"].iloc[0]),
+            "datalevel": "city",
+            "poptype": poptype,
+        }
+        _check_city_summary(
+            as_validator(validate), japan_df_year, pref_df_year, city_df_year, context
+        )
 
-            japan_df = pd.concat([japan_df, japan_df_year], ignore_index=True)
-            pref_df = pd.concat([pref_df, pref_df_year], ignore_index=True)
+        # dropping the summary rows
+        city_df_year = city_df_year.loc[~pd.isna(city_df_year["city"])]
 
-            if year >= 1995:
-                city_df_year = load_pop_year(year, poptype=poptype, datalevel="city")
+    return japan_df_year, pref_df_year, city_df_year
 
-                # the summary rows of the city table
-                city_df_year_prefrows = (
-                    city_df_year.loc[pd.isna(city_df_year["city"])]
-                    .drop(["city", "code", "code6digit", "prefecture"], axis=1)
-                    .reset_index(drop=True)
-                )
-                # checking consistency of the japan table and the city table
-                assert (japan_df_year.values == city_df_year_prefrows.iloc[0].values).all()
-                # checking consistency of the prefecture table and the city table
-                assert (
-                    pref_df_year.drop(
-                        [
-                            "code",
-                            "prefecture",
-                        ],
-                        axis=1,
-                    ).values
-                    == city_df_year_prefrows.iloc[1:].values
-                ).all()
-
-                # dropping the summary rows
-                city_df_year = city_df_year.loc[~pd.isna(city_df_year["city"])]
-
-                city_df = pd.concat([city_df, city_df_year], ignore_index=True)
-
-        complete_japan_df = pd.concat([complete_japan_df, japan_df], ignore_index=True)
-        complete_pref_df = pd.concat([complete_pref_df, pref_df], ignore_index=True)
-        complete_city_df = pd.concat([complete_city_df, city_df], ignore_index=True)
 
+def _finish_pop(japan_df, pref_df, city_df=None):
     # dropping columns that I don't have confidence in
-    complete_japan_df = complete_japan_df.drop(
+    japan_df = japan_df.drop(
         [
             "moved-in",
             "other-in",
@@ -513,131 +397,398 @@ def load_pop():
             "other-30-47",
         ],
         axis=1,
+        errors="ignore",
     )
+    return _shift_years(japan_df, pref_df, city_df)
+
+
+def _split_age_year(pref_df_year, city_df_year=None, validate="strict", poptype=None):
+    """Splits the age tables of one year into japan, prefecture, and city dataframes, checking
+    their consistency."""
+    japan_df_year = (
+        pref_df_year[pref_df_year["prefecture"] == "合計"]
+        .copy()
+        .reset_index(drop=True)
+        .drop(["code", "prefecture"], axis=1)
+    )
+    pref_df_year = pref_df_year.drop(pref_df_year.loc[pref_df_year["prefecture"] == "合計"].index)
+
+    if city_df_year is not None:
+        context = {
+            "table": "age",
+            "year": int(pref_df_year["year"].iloc[0]),
+            "datalevel": "city",
+            "poptype": poptype,
+        }
+        _check_city_summary(
+            as_validator(validate), japan_df_year, pref_df_year, city_df_year, context
+        )
+
+        # dropping the summary rows
+        city_df_year = city_df_year.loc[~pd.isna(city_df_year["city"])]
 
+    return japan_df_year, pref_df_year, city_df_year
+
+
+def _finish_age(japan_df, pref_df, city_df=None):
+    return _shift_years(japan_df, pref_df, city_df)
+
+
+def _shift_years(*dfs):
     # Until now, population in a given year means the value at the beginning of the year and the population flows are the flows in the previous year.
     # Here we subtract 1 and so we have the population at the end of the year and the flows in the year.
-    complete_japan_df["year"] = complete_japan_df["year"] - 1
-    complete_pref_df["year"] = complete_pref_df["year"] - 1
-    complete_city_df["year"] = complete_city_df["year"] - 1
+    dfs = [df.copy() if df is not None else None for df in dfs]
+    for df in dfs:
+        if df is not None:
+            df["year"] = df["year"] - 1
+    return dfs
 
-    return complete_japan_df, complete_pref_df, complete_city_df
 
+LEVELS = ["japan", "prefecture", "city"]
+TABLE_STEPS = {
+    "pop": (load_pop_year, _split_pop_year, _finish_pop),
+    "age": (load_age_year, _split_age_year, _finish_age),
+}
 
-def load_age():
-    poptypes = ["resident", "japanese", "non-japanese"]
 
-    complete_japan_df = pd.DataFrame()
-    complete_pref_df = pd.DataFrame()
-    complete_city_df = pd.DataFrame()
+def _load_source(table, year, datalevel, poptype, validate="strict"):
+    """Loads a source table, returning it with the failures of its checks."""
+    loader, _, _ = TABLE_STEPS[table]
+    validator = Validator(validate)
+    df = loader(year, datalevel=datalevel, poptype=poptype, validate=validator)
+    return df, validator.report
 
-    for poptype in poptypes:
-        if poptype == "resident":
-            years = np.arange(1994, 2023)
-        else:
-            years = np.arange(2013, 2023)
-
-        japan_df = pd.DataFrame()
-        pref_df = pd.DataFrame()
-        city_df = pd.DataFrame()
-        for year in years:
-            pref_df_year = load_age_year(year, poptype=poptype, datalevel="prefecture")
-            japan_df_year = (
-                pref_df_year[pref_df_year["prefecture"] == "合計"]
-                .copy()
-                .reset_index(drop=True)
-                .drop(["code", "prefecture"], axis=1)
-            )
-            pref_df_year.drop(
-                pref_df_year.loc[pref_df_year["prefecture"] == "合計"].index, inplace=True
-            )
 
-            japan_df = pd.concat([japan_df, japan_df_year], ignore_index=True)
-            pref_df = pd.concat([pref_df, pref_df_year], ignore_index=True)
+def _load_sources(tasks, jobs=1, validate="strict"):
+    """Loads source tables, optionally in a process pool.
 
-            if year >= 1995:
-                city_df_year = load_age_year(year, poptype=poptype, datalevel="city")
+    Args:
+        tasks (list): (table, year, datalevel, poptype) tuples
+        jobs (int, optional): number of worker processes. 1 runs serially in this process, None
+            uses every core.
+        validate (str or Validator, optional): validation mode, or a Validator collecting the
+            failures. Defaults to "strict".
 
-                # the summary rows of the city table
-                city_df_year_prefrows = (
-                    city_df_year.loc[pd.isna(city_df_year["city"])]
-                    .drop(["city", "code", "code6digit", "prefecture"], axis=1)
-                    .reset_index(drop=True)
-                )
+    Returns:
+        dict: loaded dataframe for each task
+    """
+    validator = as_validator(validate)
+    # the mode is passed rather than the validator, whose failures are returned from the workers
+    load = partial(_load_source, validate=validator.mode)
+    if jobs == 1:
+        results = [load(*task) for task in tasks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
 
-                # checking consistency of the japan table and the city table
-                assert (japan_df_year.values == city_df_year_prefrows.iloc[0:3].values).all()
+        fetch_data()  # fetch once here rather than racing in every worker
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            # map returns results in task order, so merging them below is deterministic
+            results = list(executor.map(load, *zip(*tasks)))
+    for _, report in results:
+        validator.extend(report)
+    return {task: df for task, (df, _) in zip(tasks, results)}
 
-                # checking consistency of the prefecture table and the city table
-                assert (
-                    pref_df_year.drop(
-                        [
-                            "code",
-                            "prefecture",
-                        ],
-                        axis=1,
-                    ).values
-                    == city_df_year_prefrows.iloc[3:].values
-                ).all()
 
-                # dropping the summary rows
-                city_df_year = city_df_year.loc[~pd.isna(city_df_year["city"])]
+def _units(table):
+    """Units of processing of a table, (table, poptype, year) in output order."""
+    return [(table, poptype, year) for poptype in POPTYPES for year in source_years(table, poptype)]
 
-                city_df = pd.concat([city_df, city_df_year], ignore_index=True)
 
-        complete_japan_df = pd.concat([complete_japan_df, japan_df], ignore_index=True)
-        complete_pref_df = pd.concat([complete_pref_df, pref_df], ignore_index=True)
-        complete_city_df = pd.concat([complete_city_df, city_df], ignore_index=True)
+def _unit_sources(unit):
+    table, poptype, year = unit
+    datalevels = ["prefecture", "city"] if year >= FIRST_CITY_YEAR else ["prefecture"]
+    return [source_file(table, year, datalevel, poptype) for datalevel in datalevels]
 
-    # Until now, population in a given year means the value at the beginning of the year and the population flows are the flows in the previous year.
-    # Here we subtract 1 and so we have the population at the end of the year and the flows in the year.
-    complete_japan_df["year"] = complete_japan_df["year"] - 1
-    complete_pref_df["year"] = complete_pref_df["year"] - 1
-    complete_city_df["year"] = complete_city_df["year"] - 1
 
-    return complete_japan_df, complete_pref_df, complete_city_df
+def _build_units(units, jobs=1, validate="strict"):
+    """Loads, checks, and cleans the source tables of some units.
+
+    Args:
+        units (list): (table, poptype, year) tuples
+        jobs (int, optional): number of worker processes parsing the Excel files.
+        validate (str or Validator, optional): validation mode, or a Validator collecting the
+            failures. Defaults to "strict".
+
+    Returns:
+        dict: for each unit, its japan, prefecture, and city dataframes (None before 1995)
+    """
+    tasks = [
+        (table, year, datalevel, poptype)
+        for table, poptype, year in units
+        for datalevel in ["prefecture", "city"]
+        if datalevel == "prefecture" or year >= FIRST_CITY_YEAR
+    ]
+    validator = as_validator(validate)
+    year_dfs = _load_sources(tasks, jobs=jobs, validate=validator)
+
+    built = {}
+    for unit in units:
+        table, poptype, year = unit
+        _, split, finish = TABLE_STEPS[table]
+        dfs = split(
+            year_dfs[(table, year, "prefecture", poptype)],
+            year_dfs.get((table, year, "city", poptype)),
+            validate=validator,
+            poptype=poptype,
+        )
+        built[unit] = dict(zip(LEVELS, finish(*dfs)))
+    return built
+
+
+def _concat_units(built):
+    return tuple(
+        pd.concat(
+            [dfs[level] for dfs in built.values() if dfs[level] is not None], ignore_index=True
+        )
+        for level in LEVELS
+    )
+
+
+def load_pop(jobs=1, validate="strict"):
+    """Loads the population tables of every year, level, and population type.
+
+    Args:
+        jobs (int, optional): number of worker processes parsing the Excel files. 1 parses them
+            serially, None uses every core. The result does not depend on it.
+        validate (str or Validator, optional): "strict" raises a ValidationError listing the
+            failing cells of the first failing self-consistency check, "report" logs the failures,
+            and "off" skips the checks. Pass a Validator to collect the failures in its `report`.
+            Defaults to "strict".
+
+    Returns:
+        tuple: japan, prefecture, and city dataframes
+    """
+    return _concat_units(_build_units(_units("pop"), jobs=jobs, validate=validate))
+
+
+def load_age(jobs=1, validate="strict"):
+    """Loads the age tables of every year, level, and population type.
+
+    Args:
+        jobs (int, optional): number of worker processes parsing the Excel files. 1 parses them
+            serially, None uses every core. The result does not depend on it.
+        validate (str or Validator, optional): "strict" raises a ValidationError listing the
+            failing cells of the first failing self-consistency check, "report" logs the failures,
+            and "off" skips the checks. Pass a Validator to collect the failures in its `report`.
+            Defaults to "strict".
+
+    Returns:
+        tuple: japan, prefecture, and city dataframes
+    """
+    return _concat_units(_build_units(_units("age"), jobs=jobs, validate=validate))
 
 
 """
 Loading and caching of the cleaned data
 """
 
+# bump to regenerate every partition after changing how the source tables are processed or how
+# the partitions are laid out
+CACHE_VERSION = 4
+MANIFEST_NAME = "build.json"
+
+
+def _unit_name(unit):
+    return "/".join(str(part) for part in unit)
+
+
+def _partition_key(unit, level):
+    table, poptype, year = unit
+    # named by the year of the data, which ends the year before that of the source table
+    return f"partitions/{table}/{level}/{poptype}/{year - 1}.parquet"
+
+
+def _read_manifest(cache_folder):
+    try:
+        with open(Path(cache_folder, MANIFEST_NAME)) as fp:
+            manifest = json.load(fp)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+    if manifest.get("version") != CACHE_VERSION:
+        manifest = {"version": CACHE_VERSION, "units": {}}
+    return manifest
+
+
+def _stale_units(units, manifest, index, data_folder, count=True):
+    """Units whose sources or schema changed since their partitions were generated, or whose
+    partitions are missing."""
+    stale = []
+    for unit in units:
+        entry = manifest["units"].get(_unit_name(unit))
+        if (
+            entry is None
+            or entry.get("schema") != SCHEMAS[unit[0]].version
+            or set(entry["sources"]) != {source.as_posix() for source in _unit_sources(unit)}
+            or not sources_current(entry["sources"], data_folder)
+            or not all(
+                index.is_valid(key, evictable=True, count=count) for key in entry["partitions"]
+            )
+        ):
+            stale.append(unit)
+    return stale
+
+
+def _build_partitions(units, manifest, jobs=1, validate="strict"):
+    cache_folder = cache_dir("population")
+    index = get_index(cache_folder)
+    data_folder = fetch_data()
+    logger.info(f"Generating {len(units)} cache partitions for japandata.population")
+
+    # hash before parsing, so that a source changing meanwhile is caught next time
+    sources = {
+        unit: {
+            source.as_posix(): source_info(Path(data_folder, source))
+            for source in _unit_sources(unit)
+        }
+        for unit in units
+    }
+    keys = []
+    for unit, dfs in _build_units(units, jobs=jobs, validate=validate).items():
+        partitions = []
+        for level, df in dfs.items():
+            if df is None:
+                continue
+            key = _partition_key(unit, level)
+            Path(cache_folder, key).parent.mkdir(parents=True, exist_ok=True)
+            with atomic_path(Path(cache_folder, key)) as tmp:
+                compact_dtypes(cache_order(df)).to_parquet(
+                    tmp, index=False, row_group_size=ROW_GROUP_SIZE
+                )
+            partitions.append(key)
+        manifest["units"][_unit_name(unit)] = {
+            "schema": SCHEMAS[unit[0]].version,
+            "sources": sources[unit],
+            "partitions": partitions,
+        }
+        keys += partitions
+    index.record_many(keys, evictable=True)
+
+    with atomic_path(Path(cache_folder, MANIFEST_NAME)) as tmp:
+        with open(tmp, "w") as fp:
+            json.dump(manifest, fp, indent=1)
+
+    # the unpartitioned tables cached by earlier versions
+    for name in DATAFRAME_NAMES:
+        if name + ".parquet" in index.entries:
+            index.discard(name + ".parquet")
+
+
+def _ensure_partitions(jobs=1, validate="strict"):
+    """Generates the missing or outdated cache partitions.
+
+    Returns:
+        tuple: units in output order, and the build manifest
+    """
+    cache_folder = cache_dir("population")
+    index = get_index(cache_folder)
+    data_folder = fetch_data()
+    units = _units("pop") + _units("age")
+
+    manifest = _read_manifest(cache_folder)
+    if _stale_units(units, manifest, index, data_folder):
+        with cache_lock(cache_folder, "dataframes"):
+            # another process may have generated them while we waited for the lock
+            manifest = _read_manifest(cache_folder)
+            stale = _stale_units(units, manifest, index, data_folder, count=False)
+            if stale:
+                _build_partitions(stale, manifest, jobs=jobs, validate=validate)
+    return units, manifest
+
+
+def _partition_paths(name, units, manifest, years=None):
+    table, level = DATAFRAME_TABLES[name]
+    paths = []
+    for unit in units:
+        key = _partition_key(unit, level)
+        if unit[0] != table or key not in manifest["units"][_unit_name(unit)]["partitions"]:
+            continue
+        if years is not None and unit[2] - 1 not in years:
+            continue
+        paths.append(Path(cache_dir("population"), key))
+    return paths
+
+
+def fetch_dataframes(jobs=1, compact=False, validate="strict"):
+    """Loads the cleaned dataframes, generating and caching them on first use.
+
+    The cache is partitioned by table, level, population type, and year, and a manifest records
+    the hash of the source files of each partition. Only the partitions whose source files were
+    added or changed in DATA_FOLDER, or which are missing from the cache, are generated again.
+
+    Args:
+        jobs (int, optional): number of worker processes parsing the Excel files when generating
+            partitions. 1 parses them serially, None uses every core.
+        compact (bool, optional): return the dataframes in the compact layout of
+            `japandata.dtypes`, with categorical names, integer codes, and int32 counts.
+        validate (str or Validator, optional): self-consistency checks of the partitions being
+            generated, see `load_pop`. Defaults to "strict".
+
+    Returns:
+        tuple: dataframes named in DATAFRAME_NAMES
+    """
+    units, manifest = _ensure_partitions(jobs=jobs, validate=validate)
+    return tuple(
+        read_parquet(_partition_paths(name, units, manifest), compact=compact)
+        for name in DATAFRAME_NAMES
+    )
+
+
+def query(
+    name, years=None, codes=None, prefectures=None, nationality=None, columns=None, compact=False
+):
+    """Reads the matching rows and columns of a dataframe, without loading all of it.
+
+    Only the partitions of the requested years are opened, and within them only the requested
+    columns and the row groups which can match the filters are read.
+
+    Args:
+        name (str): dataframe, one of DATAFRAME_NAMES, e.g. "city_pop"
+        years (int or list, optional): years, e.g. range(2015, 2023). Defaults to all.
+        codes (str or list, optional): municipality or prefecture codes, e.g. "13101".
+        prefectures (str or list, optional): prefecture names, e.g. "東京都".
+        nationality (str or list, optional): "all", "japanese", or "non-japanese".
+        columns (list, optional): columns to return. Defaults to all.
+        compact (bool, optional): return the compact layout of `japandata.dtypes`.
+
+    Returns:
+        pd.DataFrame: matching rows
+    """
+    if name not in DATAFRAME_NAMES:
+        raise Exception(f"Unknown dataframe {name}. Expected one of {DATAFRAME_NAMES}")
+    years = as_list(years)
+    units, manifest = _ensure_partitions()
+    return read_parquet(
+        _partition_paths(name, units, manifest, years=years),
+        columns=columns,
+        compact=compact,
+        code=codes,
+        prefecture=prefectures,
+        nationality=nationality,
+    )
+
+
+def refetch(key):
+    """Refetches a cache entry, e.g. after it was found corrupted and discarded.
+
+    Args:
+        key (str): cache entry
+    """
+    if key == "population":
+        fetch_data()
+    else:
+        fetch_dataframes()
+
+
+@lru_cache(maxsize=None)
+def _load_dataframes():
+    return dict(zip(DATAFRAME_NAMES, fetch_dataframes()))
+
 
-def fetch_dataframes():
-    JAPAN_POP_CACHE = Path(CACHE_FOLDER, "japan_pop.parquet")
-    JAPAN_AGE_CACHE = Path(CACHE_FOLDER, "japan_age.parquet")
-    PREF_POP_CACHE = Path(CACHE_FOLDER, "pref_pop.parquet")
-    PREF_AGE_CACHE = Path(CACHE_FOLDER, "pref_age.parquet")
-    CITY_POP_CACHE = Path(CACHE_FOLDER, "city_pop.parquet")
-    CITY_AGE_CACHE = Path(CACHE_FOLDER, "city_age.parquet")
-
-    if not (
-        JAPAN_POP_CACHE.exists()
-        and JAPAN_AGE_CACHE.exists()
-        and PREF_POP_CACHE.exists()
-        and PREF_AGE_CACHE.exists()
-        and CITY_POP_CACHE.exists()
-        and CITY_AGE_CACHE.exists()
-    ):
-        logger.info("Generating cache for japandata.population")
-        japan_age, pref_age, city_age = load_age()
-        japan_pop, pref_pop, city_pop = load_pop()
-
-        japan_pop.to_parquet(JAPAN_POP_CACHE)
-        japan_age.to_parquet(JAPAN_AGE_CACHE)
-        pref_pop.to_parquet(PREF_POP_CACHE)
-        pref_age.to_parquet(PREF_AGE_CACHE)
-        city_pop.to_parquet(CITY_POP_CACHE)
-        city_age.to_parquet(CITY_AGE_CACHE)
-
-    japan_pop = pd.read_parquet(JAPAN_POP_CACHE)
-    japan_age = pd.read_parquet(JAPAN_AGE_CACHE)
-    pref_pop = pd.read_parquet(PREF_POP_CACHE)
-    pref_age = pd.read_parquet(PREF_AGE_CACHE)
-    city_pop = pd.read_parquet(CITY_POP_CACHE)
-    city_age = pd.read_parquet(CITY_AGE_CACHE)
-
-    return japan_pop, japan_age, pref_pop, pref_age, city_pop, city_age
-
-
-japan_pop, japan_age, pref_pop, pref_age, city_pop, city_age = fetch_dataframes()
+__getattr__ = lazy_module_attributes(
+    __name__,
+    {
+        "DATA_FOLDER": fetch_data,
+        **{name: (lambda name=name: _load_dataframes()[name]) for name in DATAFRAME_NAMES},
+    },
+    dynamic={"CACHE_FOLDER": lambda: cache_dir("population")},
+)
@@ -0,0 +1,247 @@
+"""
+population/projection.py
+
+Cohort-component projection of the population of every municipality at once.
+
+The tables give population by 5-year age bracket every year, but births, deaths, and migrations
+only as municipal totals. The model is therefore estimated over one 5-year interval, in which each
+cohort moves up one bracket, in the manner of the Hamilton-Perry method:
+
+- survival: the national cohort survival ratios, scaled for each municipality so that its
+  expected deaths over the interval match its recorded deaths,
+- migration: the remainder of each cohort's change, as a net rate per bracket and municipality,
+- births: the ratio of children aged 0-4 to women aged 15-49, split by the sex ratio at birth.
+
+Projections are computed for many scenarios at once, as (scenario x municipality x gender x age)
+arrays, each scenario scaling the fertility, mortality, and migration of the model.
+
+Author: Sam Passaglia
+"""
+
+import numpy as np
+
+from japandata.utils import logger
+
+GENDERS = ["men", "women"]
+
+
+class CohortModel:
+    """Fitted rates of a cohort-component projection.
+
+    Attributes:
+        codes (np.ndarray): municipality codes
+        edges (np.ndarray): lower age of each bracket, 5 years apart, the last open-ended
+        base_year (int): year of the base population
+        interval (int): years per projection step, the width of the brackets
+        base (np.ndarray): (municipality, gender, age) population in base_year
+        survival (np.ndarray): (municipality, gender, age) probability of surviving the interval,
+            for the cohort starting in each bracket
+        migration (np.ndarray): (municipality, gender, age) net migrants over the interval into
+            each bracket, per member of its source cohort. The first bracket is covered by births.
+        child_ratio (np.ndarray): (municipality,) children aged 0-4 per woman aged 15-49
+        male_share (np.ndarray): (municipality,) share of boys among children aged 0-4
+    """
+
+    def __init__(
+        self,
+        codes,
+        edges,
+        base_year,
+        interval,
+        base,
+        survival,
+        migration,
+        child_ratio,
+        male_share,
+    ):
+        self.codes = codes
+        self.edges = np.asarray(edges)
+        self.base_year = base_year
+        self.interval = interval
+        self.base = base
+        self.survival = survival
+        self.migration = migration
+        self.child_ratio = child_ratio
+        self.male_share = male_share
+
+    def __repr__(self):
+        return (
+            f"CohortModel({len(self.codes)} municipalities, {len(self.edges)} age brackets,"
+            f" base year {self.base_year})"
+        )
+
+    def years(self, steps):
+        """Years reached after each of `steps` projection steps."""
+        return self.base_year + self.interval * np.arange(1, steps + 1)
+
+
+def _shift(values):
+    """Moves each cohort up one bracket, the last bracket accumulating."""
+    shifted = np.zeros_like(values)
+    shifted[..., 1:] = values[..., :-1]
+    shifted[..., -1] += values[..., -1]
+    return shifted
+
+
+def fit_cohort_model(cube=None, base_year=None, nationality="all", interval=5):
+    """Estimates survival, migration, and birth rates over the interval ending in base_year.
+
+    Args:
+        cube (AgeCube, optional): city age cube. Defaults to `load_age_cube()`.
+        base_year (int, optional): year of the base population. Defaults to the latest year.
+        nationality (str, optional): "all", "japanese", or "non-japanese". Defaults to "all".
+        interval (int, optional): years per step, which must be the width of the age brackets.
+
+    Returns:
+        CohortModel: fitted model, covering the municipalities present throughout the interval
+    """
+    from japandata.population.cube import load_age_cube
+    from japandata.population.population import query
+
+    if cube is None:
+        cube = load_age_cube()
+    if not (np.diff(cube.edges) == interval).all():
+        raise Exception(f"The age brackets {cube.brackets} are not all {interval} years wide.")
+    if base_year is None:
+        base_year = int(cube.years.max())
+    start_year = base_year - interval
+
+    end = cube.sel(year=base_year, nationality=nationality, gender=GENDERS)
+    start = cube.sel(year=start_year, nationality=nationality, gender=GENDERS)
+
+    # deaths recorded over the interval, i.e. in the years after start_year up to base_year
+    deaths = query(
+        "city_pop",
+        years=range(start_year + 1, base_year + 1),
+        nationality=nationality,
+        columns=["code", "deaths"],
+    )
+    deaths = deaths.groupby("code")["deaths"].sum().reindex(cube.codes).to_numpy(dtype=float)
+
+    # municipalities present throughout, e.g. not created or merged during the interval
+    keep = (
+        ~np.isnan(end).any(axis=(1, 2))
+        & ~np.isnan(start).any(axis=(1, 2))
+        & ~np.isnan(deaths)
+        & (start.sum(axis=(1, 2)) > 0)
+    )
+    logger.info(
+        f"Fitting cohort model on {keep.sum()} of {len(keep)} municipalities present from"
+        f" {start_year} to {base_year}"
+    )
+    codes, start, end, deaths = cube.codes[keep], start[keep], end[keep], deaths[keep]
+
+    # national cohort survival, assuming negligible net international migration
+    national_start = start.sum(axis=0)
+    national_survival = np.minimum(
+        end.sum(axis=0)[:, 1:] / np.maximum(national_start[:, :-1], 1), 1
+    )
+    open_survival = end.sum(axis=0)[:, -1] / np.maximum(national_start[:, -2:].sum(axis=1), 1)
+    national_survival = np.concatenate(
+        [national_survival[:, :-1], np.minimum(open_survival, 1)[:, None].repeat(2, axis=1)],
+        axis=1,
+    )
+
+    # scaled to the deaths recorded in each municipality
+    expected_deaths = (start * (1 - national_survival)).sum(axis=(1, 2))
+    mortality_scale = np.where(expected_deaths > 0, deaths / np.maximum(expected_deaths, 1), 1)
+    survival = np.clip(1 - mortality_scale[:, None, None] * (1 - national_survival), 0, 1)
+
+    # net migration is the rest of the change of each cohort
+    source = _shift(start)
+    survivors = _shift(start * survival)
+    migration = np.where(source > 0, (end - survivors) / np.maximum(source, 1), 0)
+    migration[..., 0] = 0
+
+    women = end[:, GENDERS.index("women"), :]
+    childbearing = (cube.edges >= 15) & (cube.edges < 50)
+    children = end[:, :, 0].sum(axis=1)
+    child_ratio = children / np.maximum(women[:, childbearing].sum(axis=1), 1)
+    male_share = np.where(
+        children > 0, end[:, GENDERS.index("men"), 0] / np.maximum(children, 1), 0.5
+    )
+
+    return CohortModel(
+        codes,
+        cube.edges,
+        base_year,
+        interval,
+        end,
+        survival,
+        migration,
+        child_ratio,
+        male_share,
+    )
+
+
+def _project_batch(model, steps, fertility, mortality, migration, dtype):
+    """Projects a batch of scenarios. Scenario parameters are (batch,) arrays."""
+    fertility = fertility.astype(dtype)[:, None]
+    mortality = mortality.astype(dtype)[:, None, None, None]
+    migration = migration.astype(dtype)[:, None, None, None]
+    survival = np.clip(1 - mortality * (1 - model.survival.astype(dtype)), 0, 1)
+    migration_rate = migration * model.migration.astype(dtype)
+    childbearing = (model.edges >= 15) & (model.edges < 50)
+    men, women = GENDERS.index("men"), GENDERS.index("women")
+    male_share = model.male_share.astype(dtype)
+
+    population = np.broadcast_to(
+        model.base.astype(dtype), (len(fertility),) + model.base.shape
+    ).copy()
+    projected = np.empty((steps,) + population.shape, dtype=dtype)
+    for step in range(steps):
+        population = np.maximum(
+            _shift(population * survival) + migration_rate * _shift(population), 0
+        )
+        children = fertility * model.child_ratio * population[:, :, women, childbearing].sum(-1)
+        population[:, :, men, 0] = children * male_share
+        population[:, :, women, 0] = children * (1 - male_share)
+        projected[step] = population
+    return np.moveaxis(projected, 0, 1)
+
+
+def project(
+    model,
+    steps=1,
+    fertility=1.0,
+    mortality=1.0,
+    migration=1.0,
+    batch_size=256,
+    by_age=True,
+    dtype=np.float32,
+):
+    """Projects the population of every municipality under many scenarios.
+
+    Each scenario scales the fitted rates: fertility scales the child ratio, mortality the death
+    probabilities, and migration the net migration rates. Scalars apply to every scenario.
+
+    Args:
+        model (CohortModel): fitted model
+        steps (int, optional): number of steps of model.interval years. Defaults to 1.
+        fertility (float or array, optional): fertility scale of each scenario.
+        mortality (float or array, optional): mortality scale of each scenario.
+        migration (float or array, optional): migration scale of each scenario.
+        batch_size (int, optional): scenarios computed at once, bounding memory use.
+        by_age (bool, optional): return populations by gender and age, rather than totals.
+        dtype (optional): dtype of the computation. Defaults to float32.
+
+    Returns:
+        np.ndarray: (scenario, step, municipality, gender, age) populations, or (scenario, step,
+            municipality) totals if not by_age
+    """
+    fertility, mortality, migration = np.broadcast_arrays(
+        np.atleast_1d(fertility), np.atleast_1d(mortality), np.atleast_1d(migration)
+    )
+    n_scenarios = len(fertility)
+    shape = (n_scenarios, steps, len(model.codes))
+    if by_age:
+        shape += model.base.shape[1:]
+    projected = np.empty(shape, dtype=dtype)
+
+    for batch in range(0, n_scenarios, batch_size):
+        scenarios = slice(batch, batch + batch_size)
+        result = _project_batch(
+            model, steps, fertility[scenarios], mortality[scenarios], migration[scenarios], dtype
+        )
+        projected[scenarios] = result if by_age else result.sum(axis=(-2, -1))
+    return projected
@@ -0,0 +1,112 @@
+"""
+population/schema.py
+
+Layouts of the population and age source tables, per year, level, and population type.
+
+Author: Sam Passaglia
+"""
+
+from japandata.schema import Column, Rule, Schema
+
+LEVELS = ["prefecture", "city"]
+POPTYPES = ["resident", "japanese", "non-japanese"]
+# file names carry two-digit years, starting from 1968
+YEARS = (1968, 2067)
+
+JAPANESE = ["japanese"]
+NON_JAPANESE = ["non-japanese"]
+
+# file label suffix, extension, and skipped rows shared by both tables
+FILE_SETTINGS = {
+    "label_suffix": [Rule(""), Rule("s", years=(2013, None), poptypes=["resident"])],
+    "extension": [Rule(".xls"), Rule(".xlsx", years=(2021, None))],
+}
+
+POP_SCHEMA = Schema(
+    "pop",
+    version=1,
+    columns=[
+        Column("code6digit", "str"),
+        Column("prefecture", "str"),
+        Column("city", "str", levels=["city"]),
+        Column("men", "int64"),
+        Column("women", "int64"),
+        Column("total-pop", "int64"),
+        Column("total-pop-corrected", keep=False, years=(2005, 2005)),
+        Column("households-singlecitizenship", "int64", poptypes=JAPANESE),
+        Column("households-multicitizenship", "int64", poptypes=JAPANESE),
+        Column("households", "int64"),
+        Column("households-corrected", keep=False, years=(2005, 2005)),
+        # flows, from 1980
+        Column("moved-in-domestic", "int64", years=(2013, None)),
+        Column("moved-in-international", "int64", years=(2013, None)),
+        Column("moved-in", "int64", years=(1980, None)),
+        Column("births", "int64", years=(1980, None)),
+        Column("naturalization", "int64", years=(1980, None), poptypes=JAPANESE),
+        Column("other-30-47", "int64", years=(2013, 2013), poptypes=NON_JAPANESE),
+        Column("denaturalization", "int64", years=(1980, None), poptypes=NON_JAPANESE),
+        Column("other-in-other", "int64", years=(1980, None), poptypes=JAPANESE + NON_JAPANESE),
+        Column("other-in", "int64", years=(1980, None)),
+        Column("total-in", "int64", years=(1980, None)),
+        Column("moved-out-domestic", "int64", years=(2013, None)),
+        Column("moved-out-international", "int64", years=(2013, None)),
+        Column("moved-out", "int64", years=(1980, None)),
+        Column("deaths", "int64", years=(1980, None)),
+        Column("denaturalization", "int64", years=(1980, None), poptypes=JAPANESE),
+        Column("naturalization", "int64", years=(1980, None), poptypes=NON_JAPANESE),
+        Column("other-out-other", "int64", years=(1980, None), poptypes=JAPANESE + NON_JAPANESE),
+        Column("other-out", "int64", years=(1980, None)),
+        Column("total-out", "int64", years=(1980, None)),
+        Column("in-minus-out", "int64", years=(1980, None)),
+        Column("in-minus-out-rate", keep=False, years=(1994, None)),
+        Column("births-minus-deaths", "int64", years=(1980, None)),
+        Column("births-minus-deaths-rate", keep=False, years=(1980, None)),
+        Column("social-in-minus-social-out", "int64", years=(1980, None)),
+        Column("social-in-minus-social-out-rate", keep=False, years=(1980, None)),
+    ],
+    settings={
+        **FILE_SETTINGS,
+        "skiprows": [Rule(4), Rule(6, years=(2021, None))],
+        # a note under the table
+        "skipfooter": [Rule(0), Rule(1, years=(2021, None))],
+    },
+    years=YEARS,
+    levels=LEVELS,
+    poptypes=POPTYPES,
+)
+
+# 5-year brackets up to 79, or up to 99 from 2015, then an open bracket
+AGE_BRACKETS = [
+    Column(f"{low}-{low + 4}", "int64", years=None if low < 80 else (2015, None))
+    for low in range(0, 100, 5)
+]
+
+AGE_SCHEMA = Schema(
+    "age",
+    version=1,
+    columns=[
+        Column("code6digit", "str"),
+        Column("prefecture", "str"),
+        Column("city", "str", levels=["city"]),
+        Column("gender", "str"),
+        Column("total-pop", "int64"),
+        Column("total-pop-corrected", keep=False, years=(2005, 2005)),
+        *AGE_BRACKETS,
+        Column(">79", "int64", years=(None, 2014)),
+        Column(">99", "int64", years=(2015, None)),
+    ],
+    settings={
+        **FILE_SETTINGS,
+        "skiprows": [Rule(2), Rule(3, years=(2021, None))],
+        # notes under the tables, except the japanese one
+        "skipfooter": [Rule(0), Rule(2, years=(2021, None), poptypes=["resident", "non-japanese"])],
+    },
+    years=YEARS,
+    levels=LEVELS,
+    poptypes=POPTYPES,
+    # cells are empty, or X when withheld
+    missing=0,
+    na_values=["X"],
+)
+
+SCHEMAS = {"pop": POP_SCHEMA, "age": AGE_SCHEMA}
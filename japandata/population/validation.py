@@ -0,0 +1,150 @@
+"""
+population/validation.py
+
+Self-consistency checks of the population source tables.
+
+The tables satisfy accounting identities, e.g. men + women = total and the flow identities, and the
+prefecture and city tables repeat each other's totals. Each check compares whole columns at once
+and reports every failing cell, by code, year, and column, rather than stopping at the first.
+
+Author: Sam Passaglia
+"""
+
+import numpy as np
+import pandas as pd
+
+from japandata.utils import logger
+
+# strict: raise on the first failing check, report: log and collect failures, off: skip the checks
+VALIDATE_MODES = ["strict", "report", "off"]
+REPORT_COLUMNS = [
+    "check",
+    "table",
+    "year",
+    "datalevel",
+    "poptype",
+    "code",
+    "prefecture",
+    "city",
+    "column",
+    "actual",
+    "expected",
+]
+
+
+class ValidationError(Exception):
+    """Raised by strict validation. Its `report` lists the failing cells."""
+
+    def __init__(self, message, report):
+        # both in args, so that it survives being pickled back from a worker process
+        super().__init__(message, report)
+        self.message = message
+        self.report = report
+
+    def __str__(self):
+        return self.message
+
+
+class Validator:
+    """Runs checks and collects their failures.
+
+    Args:
+        mode (str, optional): "strict" raises a ValidationError on the first failing check,
+            "report" logs failures and collects them in `report`, and "off" skips the checks.
+            Defaults to "strict".
+    """
+
+    def __init__(self, mode="strict"):
+        if mode not in VALIDATE_MODES:
+            raise Exception(f"Unknown validate mode {mode}. Expected one of {VALIDATE_MODES}")
+        self.mode = mode
+        self._failures = []
+
+    @property
+    def enabled(self):
+        return self.mode != "off"
+
+    @property
+    def report(self):
+        """Failing cells of every check so far, one row per cell."""
+        if not self._failures:
+            return pd.DataFrame(columns=REPORT_COLUMNS)
+        return pd.concat(self._failures, ignore_index=True)
+
+    def extend(self, report):
+        """Adds the failures collected by another validator, e.g. in a worker process."""
+        if len(report):
+            self._failures.append(report)
+
+    def _fail(self, check, failures, context):
+        for key, value in context.items():
+            failures[key] = value
+        failures["check"] = check
+        failures = failures.reindex(columns=REPORT_COLUMNS)
+
+        where = " ".join(str(context[key]) for key in ["table", "year", "datalevel", "poptype"])
+        message = f"{len(failures)} cells fail {check} in the {where} table"
+        codes = pd.unique(failures["code"].dropna())
+        if len(codes):
+            message += f", codes {list(codes[:10])}" + ("..." if len(codes) > 10 else "")
+        if self.mode == "strict":
+            raise ValidationError(message, failures)
+        logger.warning(message)
+        self._failures.append(failures)
+
+    def check_equal(self, check, rows, actual, expected, columns, context):
+        """Checks that two arrays are equal, cell by cell.
+
+        Args:
+            check (str): description of the check, e.g. "men + women = total-pop"
+            rows (pd.DataFrame): rows of `expected`, giving their code, prefecture, and city
+            actual (np.ndarray): (row, column) values
+            expected (np.ndarray): (row, column) values they should equal
+            columns (list): names of the columns of the arrays
+            context (dict): table, year, datalevel, and poptype of the rows
+        """
+        if not self.enabled:
+            return
+        actual = np.asarray(actual, dtype=np.float64)
+        expected = np.asarray(expected, dtype=np.float64)
+        if expected.shape != actual.shape:
+            failures = pd.DataFrame(
+                {"column": ["(rows)"], "actual": [len(actual)], "expected": [len(expected)]}
+            )
+            self._fail(check, failures, context)
+            return
+
+        row_index, column_index = np.nonzero(actual != expected)
+        if len(row_index) == 0:
+            return
+        failures = rows.reindex(columns=["code", "prefecture", "city"]).iloc[row_index]
+        failures = failures.reset_index(drop=True)
+        failures["column"] = np.asarray(columns)[column_index]
+        failures["actual"] = actual[row_index, column_index]
+        failures["expected"] = expected[row_index, column_index]
+        self._fail(check, failures, context)
+
+    def check_sum(self, df, terms, total, context):
+        """Checks that signed columns of a table sum to another of its columns.
+
+        Args:
+            df (pd.DataFrame): table
+            terms (list): columns summed, prefixed with "-" if subtracted
+            total (str): column equal to the sum
+            context (dict): table, year, datalevel, and poptype of the table
+        """
+        if not self.enabled:
+            return
+        actual = np.zeros(len(df))
+        for term in terms:
+            sign, column = (-1, term[1:]) if term.startswith("-") else (1, term)
+            actual += sign * df[column].to_numpy(dtype=np.float64)
+        check = " + ".join(terms).replace("+ -", "- ") + f" = {total}"
+        self.check_equal(
+            check, df, actual[:, None], df[[total]].to_numpy(dtype=np.float64), [total], context
+        )
+
+
+def as_validator(validate):
+    """A Validator from a mode, or the Validator itself."""
+    return validate if isinstance(validate, Validator) else Validator(validate)
@@ -0,0 +1,138 @@
+"""
+query.py
+
+Reading of parts of the cached parquet tables, shared by the `query` functions of the modules.
+
+Only the requested columns are read, and filters are pushed down to the parquet reader, which skips
+the row groups whose statistics cannot match them. The caches are written in small row groups
+ordered by year and code, so that a narrow query reads little more than the rows it returns.
+
+Author: Sam Passaglia
+"""
+
+from japandata.dtypes import CODE_COLUMNS, compact_dtypes, expand_dtypes
+from japandata.utils import logger
+
+# rows per parquet row group in the caches: small enough for the statistics of a row group to
+# cover a few prefectures, large enough to keep the per-group overhead negligible
+ROW_GROUP_SIZE = 1024
+
+
+def as_list(value):
+    """Normalizes a filter value: None (no filter), a single value, or an iterable of values.
+
+    Args:
+        value: filter value
+
+    Returns:
+        list or None: accepted values
+    """
+    if value is None:
+        return None
+    if isinstance(value, (str, int)):
+        return [value]
+    return list(value)
+
+
+def cache_order(df):
+    """Sorts a table in the order in which it is cached: by year, then by code with null codes
+    last, keeping the source order otherwise. The statistics of each row group then cover a narrow
+    range of codes.
+
+    Args:
+        df (pd.DataFrame): table
+
+    Returns:
+        pd.DataFrame: sorted table, with a fresh index
+    """
+    keys = [column for column in ["year", "code"] if column in df.columns]
+    if not keys:
+        return df
+    return df.sort_values(keys, na_position="last", kind="stable").reset_index(drop=True)
+
+
+def filter_expression(**filters):
+    """Builds a pyarrow filter expression accepting rows whose columns take one of the given values.
+
+    Args:
+        **filters: column name to value, as accepted by `as_list`. None values do not filter.
+
+    Returns:
+        pyarrow.compute.Expression or None: the conjunction of the filters, or None if none is set
+    """
+    import pyarrow.compute as pc
+
+    expression = None
+    for column, values in filters.items():
+        values = as_list(values)
+        if values is None:
+            continue
+        condition = pc.field(column).isin(values)
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def read_parquet(paths, columns=None, compact=False, **filters):
+    """Reads and concatenates parquet files, reading only the requested columns and rows.
+
+    Files may lack some columns, e.g. ones added in later years, which are then filled with nulls.
+
+    Args:
+        paths (list): parquet files, in output order
+        columns (list, optional): columns to return. Defaults to all.
+        compact (bool, optional): return the compact layout of `japandata.dtypes` rather than the
+            default one.
+        **filters: column name to accepted value(s), see `filter_expression`.
+
+    Returns:
+        pd.DataFrame: matching rows
+    """
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    datasets = [ds.dataset(path, format="parquet") for path in paths]
+
+    # codes may be cached as integers, in the compact layout
+    for column in CODE_COLUMNS:
+        if filters.get(column) is not None and datasets:
+            field = datasets[0].schema.field(column) if column in datasets[0].schema.names else None
+            if field is not None and pa.types.is_integer(field.type):
+                filters[column] = [int(code) for code in as_list(filters[column])]
+
+    expression = filter_expression(**filters)
+    filtered = [column for column, values in filters.items() if values is not None]
+
+    available = []
+    for path, dataset in zip(paths, datasets):
+        names = dataset.schema.names
+        for column in filtered:
+            if column not in names:
+                raise Exception(f"Cannot filter on {column}, which is not a column of {path}")
+        available += [name for name in names if name not in available]
+    if columns is not None:
+        unknown = [column for column in columns if column not in available]
+        if unknown and datasets:
+            raise Exception(f"Unknown columns {unknown}. Available: {available}")
+
+    tables = [
+        dataset.to_table(
+            columns=(
+                None if columns is None else [c for c in columns if c in dataset.schema.names]
+            ),
+            filter=expression,
+        )
+        for dataset in datasets
+    ]
+    del datasets
+    logger.debug(f"Read {sum(len(table) for table in tables)} rows from {len(tables)} files")
+
+    if not tables:
+        return pd.DataFrame(columns=columns)
+    table = pa.concat_tables(tables, promote_options="permissive")
+    del tables
+    if columns is not None:
+        table = table.select(columns)
+    # converted once, releasing the arrow buffers as it goes
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    return compact_dtypes(df) if compact else expand_dtypes(df)
@@ -1 +1,6 @@
-from .readings import city_names, pref_names  # noqa: F401
+from .readings import (  # noqa: F401
+    __getattr__,
+    fetch_data,
+    load_readings_R2file,
+    refetch,
+)
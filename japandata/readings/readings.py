@@ -6,15 +6,16 @@ Module which provides readings for place names.
 Author: Sam Passaglia
 """
 
+from functools import lru_cache
 from pathlib import Path
 
 import jaconv
 import pandas as pd
 import romkan
 
-from japandata.utils import logger
-
-CACHE_FOLDER = Path(Path(__file__).parent, "cache/")
+from japandata.cache import cache_dir, cache_lock, get_index, xlsx_is_readable
+from japandata.excel import read_excel
+from japandata.utils import lazy_module_attributes, logger
 
 
 def fetch_data():
@@ -24,23 +25,42 @@ def fetch_data():
         Path: cached filepath.
     """
 
-    cached = Path(CACHE_FOLDER, "R2_loss.xlsx")
-    if not cached.exists():
-        cached.parent.mkdir(
-            parents=True, exist_ok=True
-        )  # recreate any required subdirectories locally
-        logger.info("Fetching data for japandata.readings")
-        from japandata.download import DOWNLOAD_INFO, download_progress
-
-        url = DOWNLOAD_INFO["readings"]["latest"]["url"]
-        download_progress(url, cached)
+    cached = Path(cache_dir("readings"), "R2_loss.xlsx")
+    index = get_index(cached.parent)
+    if not index.is_valid("R2_loss.xlsx", adopt=xlsx_is_readable):
+        with cache_lock(cached.parent, "R2_loss.xlsx"):
+            # another process may have fetched it while we waited for the lock
+            if index.is_valid("R2_loss.xlsx", adopt=xlsx_is_readable, count=False):
+                return cached
+            cached.parent.mkdir(
+                parents=True, exist_ok=True
+            )  # recreate any required subdirectories locally
+            logger.info("Fetching data for japandata.readings")
+            from japandata.download import (
+                download_progress,
+                get_checksum,
+                get_url,
+            )
+
+            url = get_url("readings")
+            download_progress(url, cached, sha256=get_checksum("readings"))
+            index.record("R2_loss.xlsx")
     return cached
 
 
+def refetch(key):
+    """Refetches a cache entry, e.g. after it was found corrupted and discarded.
+
+    Args:
+        key (str): cache entry
+    """
+    fetch_data()
+
+
 def load_readings_R2file(fpath):
     colnames = ["code6digit", "prefecture", "city", "prefecture-kana", "city-kana"]
 
-    df = pd.read_excel(fpath, names=colnames, dtype={"code6digit": str})
+    df = read_excel(fpath, names=colnames, dtype={"code6digit": str})
     df["code"] = df["code6digit"].apply(lambda s: s if pd.isna(s) else s[:-1])
     df.drop(["code6digit"], inplace=True, axis=1)
 
@@ -89,4 +109,16 @@ def load_readings_R2file(fpath):
     return df, prefecture_df
 
 
-city_names, pref_names = load_readings_R2file(fetch_data())
+@lru_cache(maxsize=None)
+def _load_readings():
+    return load_readings_R2file(fetch_data())
+
+
+__getattr__ = lazy_module_attributes(
+    __name__,
+    {
+        "city_names": lambda: _load_readings()[0],
+        "pref_names": lambda: _load_readings()[1],
+    },
+    dynamic={"CACHE_FOLDER": lambda: cache_dir("readings")},
+)
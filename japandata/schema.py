@@ -0,0 +1,207 @@
+"""
+schema.py
+
+Declarative layouts of the source spreadsheets, shared by the loaders of the modules.
+
+The layout of a sheet, its columns in order, the rows to skip, and its file extension, depends on
+its year, level, and population type. A schema declares it as rules, each applying to a range of
+years and to some levels and population types, and is validated once, when it is defined. Loaders
+read only the columns they keep, with their dtypes, so that a new year's layout is a change to the
+rules rather than to the code.
+
+Author: Sam Passaglia
+"""
+
+import numpy as np
+
+from japandata.excel import read_excel
+
+
+class Rule:
+    """A value applying to the sheets of some years, levels, and population types.
+
+    Args:
+        value: value of the rule
+        years (tuple, optional): first and last year, inclusive, either of which may be None.
+            Defaults to every year.
+        levels (list, optional): levels. Defaults to every level.
+        poptypes (list, optional): population types. Defaults to every type.
+    """
+
+    def __init__(self, value, years=None, levels=None, poptypes=None):
+        self.value = value
+        self.years = years
+        self.levels = levels
+        self.poptypes = poptypes
+
+    def applies(self, year, level, poptype):
+        if self.years is not None:
+            first, last = self.years
+            if (first is not None and year < first) or (last is not None and year > last):
+                return False
+        if self.levels is not None and level not in self.levels:
+            return False
+        if self.poptypes is not None and poptype not in self.poptypes:
+            return False
+        return True
+
+
+class Column(Rule):
+    """A column of the sheets of some years, levels, and population types.
+
+    Args:
+        name (str): column name
+        dtype (str, optional): dtype in which the column is parsed, e.g. "str" or "int64". None
+            leaves it to inference, for columns which the loader cleans before casting them.
+        keep (bool, optional): whether the column is read. Defaults to True.
+        **conditions: years, levels, and poptypes, as in Rule
+    """
+
+    def __init__(self, name, dtype=None, keep=True, **conditions):
+        super().__init__(name, **conditions)
+        self.dtype = dtype
+        self.keep = keep
+
+
+class Layout:
+    """Layout of one sheet.
+
+    Attributes:
+        names (list): every column of the sheet, in order
+        columns (list): the columns read
+        usecols (list): positions of the columns read
+        dtypes (dict): dtype of the columns read, those left to inference omitted
+        settings (dict): settings of the sheet, e.g. skiprows
+    """
+
+    def __init__(self, columns, settings):
+        self.names = [column.value for column in columns]
+        self.columns = [column.value for column in columns if column.keep]
+        self.usecols = [position for position, column in enumerate(columns) if column.keep]
+        self.dtypes = {
+            column.value: column.dtype
+            for column in columns
+            if column.keep and column.dtype is not None
+        }
+        self.settings = settings
+
+    def __getitem__(self, setting):
+        return self.settings[setting]
+
+
+class Schema:
+    """Layouts of the sheets of a table, validated when defined.
+
+    Args:
+        table (str): table name
+        version (int): version of the layouts. Bump it after changing them so that caches
+            generated from the previous layouts are regenerated.
+        columns (list): Column rules, in sheet order
+        settings (dict): setting name to Rule list. The last rule applying to a sheet wins, so
+            defaults come first.
+        years (tuple): first and last year of the sheets, over which the schema is validated
+        levels (list): levels of the sheets
+        poptypes (list, optional): population types of the sheets. Defaults to [None].
+        missing (float, optional): value of empty numeric cells. Defaults to None, in which case
+            numeric columns may not have empty cells.
+        na_values (list, optional): cell values, besides empty cells, meaning missing
+    """
+
+    def __init__(
+        self,
+        table,
+        version,
+        columns,
+        settings,
+        years,
+        levels,
+        poptypes=None,
+        missing=None,
+        na_values=None,
+    ):
+        self.table = table
+        self.version = version
+        self.columns = columns
+        self.settings = settings
+        self.years = years
+        self.levels = levels
+        self.poptypes = poptypes or [None]
+        self.missing = missing
+        self.na_values = na_values or []
+        self._layouts = {}
+        self.validate()
+
+    def layout(self, year, level, poptype=None):
+        """Layout of the sheet of a year, level, and population type.
+
+        Returns:
+            Layout: layout
+        """
+        key = (year, level, poptype)
+        if key not in self._layouts:
+            columns = [column for column in self.columns if column.applies(*key)]
+            settings = {}
+            for name, rules in self.settings.items():
+                applying = [rule for rule in rules if rule.applies(*key)]
+                settings[name] = applying[-1].value if applying else None
+            self._layouts[key] = Layout(columns, settings)
+        return self._layouts[key]
+
+    def validate(self):
+        """Checks that every sheet has distinct column names, known dtypes, and every setting."""
+        first, last = self.years
+        for year in range(first, last + 1):
+            for level in self.levels:
+                for poptype in self.poptypes:
+                    layout = self.layout(year, level, poptype)
+                    where = f"{self.table} {year} {level} {poptype}"
+                    if len(set(layout.names)) != len(layout.names):
+                        duplicates = {name for name in layout.names if layout.names.count(name) > 1}
+                        raise Exception(f"Columns {sorted(duplicates)} repeated in {where}")
+                    for setting, value in layout.settings.items():
+                        if value is None:
+                            raise Exception(f"No {setting} rule applies to {where}")
+                    for dtype in layout.dtypes.values():
+                        if dtype != "str":
+                            np.dtype(dtype)
+
+    def read(self, path, year, level, poptype=None):
+        """Reads the columns kept from a sheet, with their dtypes.
+
+        Numeric columns with empty cells are filled with `missing` before being cast.
+
+        Args:
+            path (Path): spreadsheet
+            year (int): year of the sheet
+            level (str): level of the sheet
+            poptype (str, optional): population type of the sheet
+
+        Returns:
+            pd.DataFrame: sheet
+        """
+        layout = self.layout(year, level, poptype)
+        dtypes = layout.dtypes
+        filled = []
+        if self.missing is not None:
+            # parsed as floats, which hold missing values, then filled and cast
+            filled = [column for column, dtype in dtypes.items() if dtype != "str"]
+            dtypes = {
+                column: "float64" if column in filled else dtype for column, dtype in dtypes.items()
+            }
+        df = read_excel(
+            path,
+            skiprows=layout["skiprows"],
+            skipfooter=layout.settings.get("skipfooter", 0),
+            header=None,
+            names=layout.columns,
+            usecols=layout.usecols,
+            dtype=dtypes,
+            na_values=self.na_values,
+        )
+        if filled:
+            df[filled] = (
+                df[filled]
+                .fillna(self.missing)
+                .astype({column: layout.dtypes[column] for column in filled})
+            )
+        return df
@@ -1,6 +1,7 @@
 import json
 import logging.config
 import sys
+import threading
 
 from rich.logging import RichHandler
 
@@ -19,6 +20,42 @@ def load_dict(filepath: str) -> dict:
     return d
 
 
+def lazy_module_attributes(module_name, loaders, dynamic=None):
+    """Build a module-level ``__getattr__`` (PEP 562) which materializes attributes on first access.
+
+    Importing a module which uses this is free of side effects: each attribute is only loaded the
+    first time it is accessed, and the result is then set on the module so that later accesses are
+    plain attribute lookups.
+
+    Args:
+        module_name (str): ``__name__`` of the module which owns the attributes.
+        loaders (dict): maps attribute names to zero-argument callables returning their value.
+        dynamic (dict, optional): like `loaders`, for attributes which are recomputed on every
+            access instead of memoized, e.g. because they depend on configuration.
+
+    Returns:
+        function: ``__getattr__`` to be assigned at module level.
+    """
+    lock = threading.RLock()
+    dynamic = dynamic or {}
+
+    def __getattr__(name):
+        if name in dynamic:
+            return dynamic[name]()
+        try:
+            loader = loaders[name]
+        except KeyError:
+            raise AttributeError(f"module {module_name!r} has no attribute {name!r}") from None
+        module = sys.modules[module_name]
+        with lock:
+            # another thread, or an access through a re-exporting package, may have loaded it
+            if name not in module.__dict__:
+                setattr(module, name, loader())
+        return module.__dict__[name]
+
+    return __getattr__
+
+
 def japanese_to_western(year):
     """
     Convert Japanese year to Western year.
@@ -0,0 +1,145 @@
+"""
+tests/test_download.py
+
+Checks that interrupted downloads are resumed with a Range request and never leave a partial file
+at their final path, against a local HTTP server standing in for the remote.
+
+Author: Sam Passaglia
+"""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import japandata.download
+from japandata.cache import set_cache_root
+from japandata.download import download_many
+
+
+class RangeServer(ThreadingHTTPServer):
+    """Serves `files` by path, honouring Range requests.
+
+    Attributes:
+        files (dict): body of each path
+        cut (dict): bytes after which the next response for a path is cut off
+        requests (list): (path, Range header) of each request received
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), RangeHandler)
+        self.files = {}
+        self.cut = {}
+        self.requests = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, self.headers.get("Range")))
+        if self.path not in server.files:
+            self.send_error(404)
+            return
+        body = server.files[self.path]
+
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"][len("bytes=") :].split("-")[0])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(body)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+
+        # a cut response stops short of its Content-Length, as a dropped connection does
+        end = server.cut.pop(self.path, len(body))
+        self.wfile.write(body[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = RangeServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_interrupted_download_resumes(tmp_path, server):
+    body = np.random.default_rng(0).bytes(200_000)
+    server.files["/data.bin"] = body
+    server.cut["/data.bin"] = 80_000
+    fname = Path(tmp_path, "data.bin")
+    part = Path(tmp_path, "data.bin.part")
+
+    with pytest.raises(Exception, match="1 of 1 downloads failed"):
+        download_many([(server.url + "/data.bin", fname)], jobs=1)
+    assert not fname.exists()
+    offset = part.stat().st_size
+    assert 0 < offset < len(body)
+    assert body.startswith(part.read_bytes())
+
+    assert download_many([(server.url + "/data.bin", fname)], jobs=1) == [fname]
+    assert server.requests[-1] == ("/data.bin", f"bytes={offset}-")
+    assert fname.read_bytes() == body
+    assert not part.exists()
+
+
+def test_complete_part_is_renamed(tmp_path, server):
+    body = b"x" * 1000
+    server.files["/data.bin"] = body
+    fname = Path(tmp_path, "data.bin")
+    Path(tmp_path, "data.bin.part").write_bytes(body)
+
+    download_many([(server.url + "/data.bin", fname)], jobs=1)
+    assert server.requests == [("/data.bin", "bytes=1000-")]
+    assert fname.read_bytes() == body
+    assert not Path(tmp_path, "data.bin.part").exists()
+
+
+def test_prefetch_resumes(tmp_path, server, monkeypatch):
+    pytest.importorskip("geopandas")
+    from japandata.maps import maps
+
+    map_date, scale, quality = "2020-01-01", "jp_city", "s"
+    fname = maps.map_filename(map_date, scale, quality)
+    body = json.dumps({"features": list(range(20_000))}).encode()
+    server.files["/maps/" + fname] = body
+
+    set_cache_root(Path(tmp_path, "cache"))
+    monkeypatch.setattr(
+        maps,
+        "load_manifest",
+        lambda: ({map_date: {scale: [quality]}}, [np.datetime64(map_date)]),
+    )
+    monkeypatch.setattr(japandata.download, "get_url", lambda dataset: server.url + "/maps/")
+    try:
+        cached = Path(maps.cache_dir("maps"), fname)
+        part = cached.with_name(cached.name + ".part")
+        part.parent.mkdir(parents=True, exist_ok=True)
+        part.write_bytes(body[:5000])
+
+        assert maps.prefetch(scales=[scale], qualities=[quality]) == [cached]
+        assert server.requests == [("/maps/" + fname, "bytes=5000-")]
+        assert cached.read_bytes() == body
+        assert not part.exists()
+    finally:
+        set_cache_root(None)
@@ -0,0 +1,125 @@
+"""
+tests/test_population_ingest.py
+
+Checks that parsing the population source tables over a process pool gives the same dataframes,
+and the same validation failures, as parsing them serially. The source sheets are small synthetic
+ones in the layout of each year, so the test runs without the data.
+
+Author: Sam Passaglia
+"""
+
+import multiprocessing
+import random
+from concurrent import futures
+from functools import partial
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+import japandata.excel
+from japandata.cache import set_cache_root
+from japandata.population import population
+from japandata.population.schema import POPTYPES, SCHEMAS
+from japandata.population.validation import Validator
+
+# years covering every layout of the tables
+YEARS = [1979, 1996, 2005, 2013, 2015, 2022]
+PREFECTURES = ["北海道", "青森県"]
+
+
+def source_tables():
+    """(table, year, datalevel, poptype) of each synthetic source file, by file name."""
+    tables = {}
+    for table in SCHEMAS:
+        for poptype in POPTYPES:
+            for year in YEARS:
+                if year < population.FIRST_YEARS[table][poptype]:
+                    continue
+                for datalevel in ["prefecture", "city"]:
+                    if datalevel == "city" and year < population.FIRST_CITY_YEAR:
+                        continue
+                    path = population.source_file(table, year, datalevel, poptype)
+                    tables[path.name] = (table, year, datalevel, poptype)
+    return tables
+
+
+def synthetic_sheet(path, engine=None):
+    """Rows of a small sheet in the layout of a source table, the same for each file name."""
+    table, year, datalevel, poptype = source_tables()[Path(path).name]
+    layout = SCHEMAS[table].layout(year, datalevel, poptype)
+    rng = random.Random(Path(path).name)
+    blank = [""] * (len(layout.names) - 1)
+
+    # (code, prefecture, city) of the japan, prefecture, and municipality rows
+    entities = [(None, "合計", None)]
+    entities += [(f"0{i + 1}0006", prefecture, None) for i, prefecture in enumerate(PREFECTURES)]
+    if datalevel == "city":
+        entities += [
+            (f"0{i + 1}1002", prefecture, f"市{i}") for i, prefecture in enumerate(PREFECTURES)
+        ]
+
+    rows = [["title"] + blank for _ in range(layout["skiprows"])]
+    for code, prefecture, city in entities:
+        for gender in ["計", "男", "女"] if table == "age" else [None]:
+            row = []
+            for name in layout.names:
+                if name == "code6digit":
+                    row.append(code or "")
+                elif name == "prefecture":
+                    row.append(" " + prefecture)
+                elif name == "city":
+                    row.append(city or "")
+                elif name == "gender":
+                    row.append(gender)
+                elif name.endswith("rate"):
+                    row.append(rng.random())
+                elif table == "age" and rng.random() < 0.1:
+                    row.append(rng.choice(["X", ""]))
+                else:
+                    row.append(rng.randint(0, 999))
+            rows.append(row)
+    return rows + [["注"] + blank for _ in range(layout["skipfooter"])]
+
+
+@pytest.fixture
+def synthetic_sources(tmp_path, monkeypatch):
+    if "fork" not in multiprocessing.get_all_start_methods():
+        pytest.skip("the patched sheet reader only reaches the workers through fork")
+
+    data_folder = Path(tmp_path, "data")
+    for name, (table, year, datalevel, poptype) in source_tables().items():
+        path = Path(data_folder, population.source_file(table, year, datalevel, poptype))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(name)
+
+    set_cache_root(Path(tmp_path, "cache"))
+    monkeypatch.setattr(population, "fetch_data", lambda: data_folder)
+    monkeypatch.setattr(japandata.excel, "read_sheet", synthetic_sheet)
+    # forked workers inherit the patches
+    pool = partial(futures.ProcessPoolExecutor, mp_context=multiprocessing.get_context("fork"))
+    monkeypatch.setattr(futures, "ProcessPoolExecutor", pool)
+    yield
+    set_cache_root(None)
+
+
+@pytest.mark.parametrize("loader", [population.load_pop, population.load_age])
+def test_parallel_matches_serial(synthetic_sources, loader):
+    serial = loader(jobs=1, validate="off")
+    parallel = loader(jobs=2, validate="off")
+
+    assert len(serial) == len(parallel) == 3
+    for serial_df, parallel_df in zip(serial, parallel):
+        assert len(serial_df) > 0
+        pd.testing.assert_frame_equal(serial_df, parallel_df, check_exact=True)
+
+
+def test_parallel_validation_matches_serial(synthetic_sources):
+    serial = Validator("report")
+    parallel = Validator("report")
+    population.load_pop(jobs=1, validate=serial)
+    population.load_pop(jobs=2, validate=parallel)
+
+    # the random counts break the accounting identities
+    assert len(serial.report) > 0
+    pd.testing.assert_frame_equal(serial.report, parallel.report, check_exact=True)